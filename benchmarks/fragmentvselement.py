@@ -1,8 +1,15 @@
 
+import sys
+from time import time
+
+from zope.interface import implements
+
 from twisted.internet import reactor
 from twisted.internet.defer import succeed
 
+from nevow.inevow import IRenderable
 from nevow.appserver import NevowSite
+from nevow._flat import flatten
 
 from nevow.rend import Page, Fragment
 from nevow.page import Element, renderer
@@ -142,6 +149,59 @@ class Root(Page):
 
 
 
+class Uncompiled(object):
+    """
+    Render the document of an Element as a plain list, bypassing the compiled
+    form L{Element.render} returns, for comparison.
+    """
+    implements(IRenderable)
+
+    def __init__(self, element):
+        self.element = element
+
+
+    def render(self, request):
+        return list(self.element.render(request))
+
+
+    def renderer(self, name):
+        return self.element.renderer(name)
+
+
+
+def timeFlatten(root, iterations):
+    """
+    Return the mean time taken to flatten C{root}.
+    """
+    write = lambda s: None
+    before = time()
+    for i in xrange(iterations):
+        for _ in flatten(None, write, root, False, True):
+            pass
+    return (time() - before) / iterations
+
+
+
+def compare(iterations=1000):
+    """
+    Print the time taken to flatten each kind of Element with and without
+    compiling its document.
+    """
+    for name, element in [('static', StaticElement()),
+                          ('tiny', TinyElement()),
+                          ('huge', HugeElement()),
+                          ('nested', NestedElement()),
+                          ('deferred', DeferredElement())]:
+        compiled = timeFlatten(element, iterations)
+        uncompiled = timeFlatten(Uncompiled(element), iterations)
+        print '%-10s compiled %.6f s  uncompiled %.6f s  (%.2fx)' % (
+            name, compiled, uncompiled, uncompiled / compiled)
+
+
+
 if __name__ == '__main__':
-    reactor.listenTCP(8080, NevowSite(Root()))
-    reactor.run()
+    if sys.argv[1:] == ['--compare']:
+        compare()
+    else:
+        reactor.listenTCP(8080, NevowSite(Root()))
+        reactor.run()
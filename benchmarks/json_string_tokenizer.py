@@ -12,6 +12,10 @@ if __name__ == '__main__':
 
 
 class StringTokenizer(Options):
+    optFlags = [
+        ('scaling', None,
+         'Measure parse time for payloads from 1 KB to 10 MB instead.')]
+
     optParameters = [
         ('iterations', 'i', '1000', 'Number of iterations for which to run the benchmark.'),
         ('scale', 's', '100', 'Factor determining the overall input size.')]
@@ -39,10 +43,38 @@ def benchmark(iterations, scale):
 
 
 
+SIZES = [2 ** 10, 2 ** 14, 2 ** 17, 2 ** 20, 10 * 2 ** 20]
+def scaling(sizes=SIZES):
+    """
+    Deserialize a string and a list of mixed values for each payload size in
+    C{sizes}.
+
+    Prints the time per parse call and per kilobyte of input for each size.
+    If parsing is linear in the size of its input, the time per kilobyte
+    stays roughly constant as the payload grows.
+    """
+    item = [BASE, 12345, 1.5, True, None, {u'key': [BASE]}]
+    for size in sizes:
+        for kind, value in [
+            ('string', BASE * (size // len(serialize(BASE)) + 1)),
+            ('list', item * (size // len(serialize(item)) + 1))]:
+            s = serialize(value)
+            before = time()
+            parse(s)
+            after = time()
+            print '%-6s %10d bytes %10.4f s %10.6f s/KB' % (
+                kind, len(s), after - before,
+                (after - before) / (len(s) / 1024.0))
+
+
+
 def main(args=None):
     """
     Benchmark nevow.json string parsing, maybe with some parameters.
     """
     options = StringTokenizer()
     options.parseOptions(args)
-    benchmark(options['iterations'], options['scale'])
+    if options['scaling']:
+        scaling()
+    else:
+        benchmark(options['iterations'], options['scale'])
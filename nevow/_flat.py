@@ -18,6 +18,7 @@ Immediate future plans:
 from sys import exc_info
 from types import GeneratorType
 from traceback import extract_tb, format_list
+from weakref import WeakKeyDictionary
 
 from twisted.internet.defer import Deferred
 
@@ -130,10 +131,18 @@ class UnsupportedType(Exception):
 
 
 
+# Strings shorter than this are checked for characters which need escaping
+# before any replacement is attempted.  For longer strings the membership
+# tests cost more than the (memchr-backed) no-op replacements they would skip.
+_PRECHECK_LENGTH = 128
+
 def escapedData(data, inAttribute, inXML):
     """
     Escape a string for inclusion in a document.
 
+    Short strings which contain no characters needing escaping are returned
+    unchanged without being copied.
+
     @type data: C{str}
     @param data: The string to escape.
 
@@ -148,10 +157,15 @@ def escapedData(data, inAttribute, inXML):
     @rtype: C{str}
     @return: The quoted form of C{data}.
     """
-    if inXML or inAttribute:
-        data = data.replace('&', '&amp;'
-            ).replace('<', '&lt;'
-            ).replace('>', '&gt;')
+    if not (inXML or inAttribute):
+        return data
+    if len(data) < _PRECHECK_LENGTH:
+        if ('&' not in data and '<' not in data and '>' not in data and
+                (not inAttribute or '"' not in data)):
+            return data
+    data = data.replace('&', '&amp;'
+        ).replace('<', '&lt;'
+        ).replace('>', '&gt;')
     if inAttribute:
         data = data.replace('"', '&quot;')
     return data
@@ -277,8 +291,11 @@ def _flatten(request, write, root, slotData, renderFactory, inAttribute, inXML):
                         if isinstance(k, unicode):
                             k = k.encode('ascii')
                         write(" " + k + "=\"")
-                        yield _flatten(request, write, v, slotData,
-                                       renderFactory, True, True)
+                        if type(v) is str:
+                            write(escapedData(v, True, True))
+                        else:
+                            yield _flatten(request, write, v, slotData,
+                                           renderFactory, True, True)
                         write("\"")
                     if root.children or tagName not in allowSingleton:
                         write('>')
@@ -301,10 +318,20 @@ def _flatten(request, write, root, slotData, renderFactory, inAttribute, inXML):
             slotData.pop()
     elif isinstance(root, URL):
         write(escapedData(str(root), inAttribute, inXML))
+    elif type(root) is _CompiledDocument:
+        yield _flattenCompiled(request, write, root, slotData, renderFactory,
+                               inAttribute, inXML)
     elif isinstance(root, (tuple, list, GeneratorType)):
         for element in root:
-            yield _flatten(request, write, element, slotData, renderFactory,
-                           inAttribute, inXML)
+            # Plain strings are common and cannot fail to flatten, so write
+            # them here rather than setting up another generator for them.
+            if type(element) is str:
+                write(escapedData(element, inAttribute, inXML))
+            elif type(element) is unicode:
+                write(escapedData(element.encode('utf-8'), inAttribute, inXML))
+            else:
+                yield _flatten(request, write, element, slotData,
+                               renderFactory, inAttribute, inXML)
     elif isinstance(root, Entity):
         write('&#')
         write(root.num)
@@ -358,6 +385,234 @@ def _flatten(request, write, root, slotData, renderFactory, inAttribute, inXML):
 
 
 
+# Instructions which make up the programs run by _flattenCompiled.  Each
+# instruction is a two-tuple of one of these opcodes and an argument.
+_LITERAL = 0    # Write the argument, a str.
+_SLOT = 1       # Flatten the value of a slot; (name, inAttribute, inXML).
+_RENDER = 2     # Call a render method; (template tag, name, inXML).
+_FLATTEN = 3    # Flatten anything else; (object, inAttribute, inXML).
+_PUSH_SLOTS = 4 # Push the argument, a dict, onto the slot data stack.
+_POP_SLOTS = 5  # Pop the slot data stack.  The argument is None.
+
+
+def _compile(root, inAttribute, inXML):
+    """
+    Return a list of instructions which, when run by L{_flattenCompiled}, will
+    produce the same output as L{_flatten} would for C{root}.
+
+    Only the parts of C{root} which cannot change between renders are turned
+    into literal output: strings, markers such as L{raw} and L{Entity}, and the
+    tags and attributes of L{Tag}s without render directives.  Slots, render
+    directives and everything else are left to be handled when the program is
+    run.  Like L{flatten}, this keeps its own stack rather than recursing, so
+    that deeply nested structures can be compiled.
+    """
+    program = []
+    # Each element is a two-tuple of a flag and either an instruction, if the
+    # flag is set, or an (object, inAttribute, inXML) three-tuple.  Elements
+    # are pushed in the reverse of the order in which they are needed.
+    stack = [(False, (root, inAttribute, inXML))]
+    while stack:
+        isInstruction, item = stack.pop()
+        if isInstruction:
+            program.append(item)
+            continue
+
+        root, inAttribute, inXML = item
+        if isinstance(root, unicode):
+            root = root.encode('utf-8')
+        elif isinstance(root, WovenContext):
+            inAttribute = root.isAttrib
+            inXML = True
+            root = root.tag
+
+        if isinstance(root, raw):
+            root = str(root)
+            if inAttribute:
+                root = root.replace('"', '&quot;')
+            program.append((_LITERAL, root))
+        elif isinstance(root, Proto):
+            root = str(root)
+            if root:
+                if root in allowSingleton:
+                    program.append((_LITERAL, '<' + root + ' />'))
+                else:
+                    program.append(
+                        (_LITERAL, '<' + root + '></' + root + '>'))
+        elif isinstance(root, str):
+            program.append((_LITERAL, escapedData(root, inAttribute, inXML)))
+        elif isinstance(root, slot):
+            program.append((_SLOT, (root.name, inAttribute, inXML)))
+        elif isinstance(root, _PrecompiledSlot):
+            program.append((_SLOT, (root.name, root.isAttrib, inXML)))
+        elif isinstance(root, Tag):
+            if root.pattern is not Unset and root.pattern is not None:
+                continue
+            pending = []
+            if root.slotData is not None:
+                program.append((_PUSH_SLOTS, root.slotData))
+            if root.render is Unset:
+                if not root.tagName:
+                    pending.append((False, (root.children, False, True)))
+                else:
+                    if isinstance(root.tagName, unicode):
+                        tagName = root.tagName.encode('ascii')
+                    else:
+                        tagName = str(root.tagName)
+                    program.append((_LITERAL, '<' + tagName))
+                    for k, v in sorted(root.attributes.iteritems()):
+                        if isinstance(k, unicode):
+                            k = k.encode('ascii')
+                        pending.append((True, (_LITERAL, " " + k + "=\"")))
+                        pending.append((False, (v, True, True)))
+                        pending.append((True, (_LITERAL, "\"")))
+                    if root.children or tagName not in allowSingleton:
+                        pending.append((True, (_LITERAL, '>')))
+                        pending.append((False, (root.children, False, True)))
+                        pending.append((True, (_LITERAL, '</' + tagName + '>')))
+                    else:
+                        pending.append((True, (_LITERAL, ' />')))
+            else:
+                if isinstance(root.render, directive):
+                    rendererName = root.render.name
+                else:
+                    rendererName = root.render
+                template = root.clone(False)
+                del template._specials['render']
+                program.append((_RENDER, (template, rendererName, inXML)))
+            if root.slotData is not None:
+                pending.append((True, (_POP_SLOTS, None)))
+            pending.reverse()
+            stack.extend(pending)
+        elif isinstance(root, (tuple, list)):
+            stack.extend([(False, (element, inAttribute, inXML))
+                          for element in reversed(root)])
+        elif isinstance(root, Entity):
+            program.append((_LITERAL, '&#' + root.num + ';'))
+        elif isinstance(root, xml):
+            if isinstance(root.content, unicode):
+                program.append((_LITERAL, root.content.encode('utf-8')))
+            else:
+                program.append((_LITERAL, root.content))
+        else:
+            program.append((_FLATTEN, (root, inAttribute, inXML)))
+    return program
+
+
+
+def _optimize(program):
+    """
+    Return a copy of C{program} with each run of adjacent L{_LITERAL}
+    instructions joined into one, and empty literals removed.
+    """
+    optimized = []
+    literals = []
+    for op, arg in program:
+        if op == _LITERAL:
+            literals.append(arg)
+        else:
+            if literals:
+                optimized.append((_LITERAL, ''.join(literals)))
+                literals = []
+            optimized.append((op, arg))
+    if literals:
+        optimized.append((_LITERAL, ''.join(literals)))
+    return [(op, arg) for (op, arg) in optimized if op != _LITERAL or arg]
+
+
+
+class _CompiledDocument(list):
+    """
+    A document loaded from a docFactory, along with the programs compiled from
+    it for L{_flattenCompiled}.
+
+    This is a copy of the loaded document, so it can still be used anywhere a
+    document can.  The document must not be changed once it has been
+    flattened, though, because the programs are only compiled once.
+
+    @ivar document: The original document.
+    @ivar _programs: A C{dict} mapping C{(inAttribute, inXML)} to programs.
+    """
+    def __init__(self, document):
+        list.__init__(self, document)
+        self.document = document
+        self._programs = {}
+
+
+    def getProgram(self, inAttribute, inXML):
+        """
+        Get the program for flattening this document with the given quoting
+        flags, compiling it if this has not been done before.
+        """
+        key = (bool(inAttribute), bool(inXML))
+        program = self._programs.get(key)
+        if program is None:
+            program = self._programs[key] = _optimize(
+                _compile(self, inAttribute, inXML))
+        return program
+
+
+
+_compiledDocuments = WeakKeyDictionary()
+
+def _compiledDocument(docFactory, document):
+    """
+    Get the L{_CompiledDocument} for a document loaded from a docFactory.
+
+    One is kept for each docFactory, and replaced when the docFactory loads a
+    different document (for example, because its template file changed).
+    Documents which are not lists, such as a single pattern, are returned
+    unchanged.
+    """
+    if not isinstance(document, list):
+        return document
+    compiled = _compiledDocuments.get(docFactory)
+    if compiled is None or compiled.document is not document:
+        compiled = _compiledDocuments[docFactory] = _CompiledDocument(document)
+    return compiled
+
+
+
+def _flattenCompiled(request, write, root, slotData, renderFactory,
+                     inAttribute, inXML):
+    """
+    Flatten a L{_CompiledDocument} by running its program.
+
+    The parameters and return value are the same as those of L{_flatten}.
+    """
+    program = root.getProgram(inAttribute, inXML)
+    for op, arg in program:
+        if op == _LITERAL:
+            write(arg)
+        elif op == _SLOT:
+            name, slotInAttribute, slotInXML = arg
+            value = _getSlotValue(name, slotData)
+            if type(value) is str:
+                write(escapedData(value, slotInAttribute, slotInXML))
+            elif type(value) is unicode:
+                write(escapedData(
+                        value.encode('utf-8'), slotInAttribute, slotInXML))
+            else:
+                yield _flatten(request, write, value, slotData, renderFactory,
+                               slotInAttribute, slotInXML)
+        elif op == _RENDER:
+            template, rendererName, renderInXML = arg
+            # FlattenerError reports the root of each frame on the stack.
+            root = template.clone(False)
+            result = renderFactory.renderer(rendererName)(request, root)
+            yield _flatten(request, write, result, slotData, renderFactory,
+                           None, renderInXML)
+        elif op == _FLATTEN:
+            root, flattenInAttribute, flattenInXML = arg
+            yield _flatten(request, write, root, slotData, renderFactory,
+                           flattenInAttribute, flattenInXML)
+        elif op == _PUSH_SLOTS:
+            slotData.append(arg)
+        else:
+            slotData.pop()
+
+
+
 class _OldRendererFactory(object):
     """
     Adapter from L{IRenderable} to L{IRenderFactory}, used to provide support
@@ -432,6 +687,71 @@ def flatten(request, write, root, inAttribute, inXML):
 
 
 
+class _BufferedWriter(object):
+    """
+    Collect the small strings written by the flattener and pass them on to
+    another write function in larger chunks.
+
+    @ivar bufferSize: The number of bytes to collect before passing them on.
+    """
+    def __init__(self, write, bufferSize):
+        self._write = write
+        self.bufferSize = bufferSize
+        self._buffer = []
+        self._size = 0
+
+
+    def write(self, data):
+        """
+        Add C{data} to the buffer, flushing it if it has grown to
+        C{bufferSize} bytes or more.
+        """
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self.bufferSize:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Pass everything in the buffer on as a single string, if there is
+        anything in it.
+        """
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self._write(data)
+
+
+
+def _flushing(state, writer):
+    """
+    Iterate over the L{Deferred}s produced by L{flatten}, flushing a
+    L{_BufferedWriter} whenever one of them has not fired yet, so that output
+    does not sit in the buffer while the flattener waits, and when flattening
+    ends.
+
+    @param state: An iterator returned by L{flatten}.
+    @param writer: The L{_BufferedWriter} which C{state} is writing to.
+    @return: An iterator which produces the same objects as C{state}.
+    """
+    while True:
+        try:
+            element = state.next()
+        except StopIteration:
+            writer.flush()
+            return
+        except:
+            writer.flush()
+            raise
+        if isinstance(element, Deferred) and (
+            not element.called or element.paused):
+            writer.flush()
+        yield element
+
+
+
 def _flattensome(state, write, schedule, result):
     """
     Take strings from an iterator and pass them to a writer function.
@@ -444,9 +764,11 @@ def _flattensome(state, write, schedule, result):
         produced by iterating C{state}.
 
     @param schedule: A callable which will arrange for a function to be called
-        with some positional arguments I{later}.  This is used to avoid
-        unbounded call stack depth due to already-fired L{Deferred}s produced
-        by C{state}.
+        with some positional arguments I{later}.  This is used to resume
+        iteration of C{state} once a L{Deferred} which had not fired when it
+        was produced fires.  L{Deferred}s which have already fired do not
+        involve C{schedule}; iteration simply continues in this call, so call
+        stack depth stays bounded however many of them C{state} produces.
 
     @param result: A L{Deferred} which will be called back when C{state} has
         been completely flattened into C{write} or which will be errbacked if
@@ -466,10 +788,18 @@ def _flattensome(state, write, schedule, result):
                 write(element)
                 continue
             else:
+                fired = []
+                waiting = []
                 def cby(original):
-                    schedule(_flattensome, state, write, schedule, result)
+                    if waiting:
+                        schedule(_flattensome, state, write, schedule, result)
+                    else:
+                        fired.append(None)
                     return original
                 element.addCallbacks(cby, result.errback)
+                if fired:
+                    continue
+                waiting.append(None)
         break
 
 
@@ -477,16 +807,21 @@ def _flattensome(state, write, schedule, result):
 def _schedule(f, *a):
     """
     Scheduler for use with L{_flattensome} which uses L{IReactorTime.callLater}
-    to schedule calls.  This works around the fact that L{Deferred} can exceed
-    the stack limit in certain cases.
+    to schedule calls.  This ensures a L{Deferred} which fires once it has
+    been waited on does not resume flattening in the middle of whatever code
+    fired it.
     """
-    # XXX SUCKY
     from twisted.internet import reactor
     reactor.callLater(0, f, *a)
 
 
 
-def deferflatten(request, root, inAttribute, inXML, write):
+# A reasonable size for the buffer used by deferflatten, for callers which
+# want their output buffered, such as rend.Page.writeBufferSize.
+BUFFER_SIZE = 2 ** 15
+
+def deferflatten(request, root, inAttribute, inXML, write, bufferSize=None,
+                 schedule=None):
     """
     Incrementally write out a string representation of C{root} using C{write}.
 
@@ -516,11 +851,30 @@ def deferflatten(request, root, inAttribute, inXML, write):
     @param write: A callable which will be invoked with each C{str}
         produced by flattening C{root}.
 
+    @type bufferSize: C{int} or C{NoneType}
+    @param bufferSize: If not C{None}, the output is collected and passed to
+        C{write} in strings of about this many bytes (see L{BUFFER_SIZE}),
+        rather than a little at a time.  Whatever has been collected is also
+        passed on whenever flattening has to wait for a L{Deferred}, and
+        when flattening ends.
+
+    @param schedule: A callable which will arrange for a function to be called
+        with some positional arguments later, used to resume flattening after
+        waiting for a L{Deferred}.  If C{None}, the reactor is used.
+
     @return: A L{Deferred} which will be called back when C{root} has
         been completely flattened into C{write} or which will be errbacked if
         an unexpected exception occurs.
     """
+    if schedule is None:
+        schedule = _schedule
     result = Deferred()
-    state = flatten(request, write, root, inAttribute, inXML)
-    _flattensome(state, write, _schedule, result)
+    if bufferSize is None:
+        state = flatten(request, write, root, inAttribute, inXML)
+    else:
+        writer = _BufferedWriter(write, bufferSize)
+        write = writer.write
+        state = _flushing(
+            flatten(request, write, root, inAttribute, inXML), writer)
+    _flattensome(state, write, schedule, result)
     return result
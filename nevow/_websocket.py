@@ -0,0 +1,311 @@
+# -*- test-case-name: nevow.test.test_websocket -*-
+"""
+The server side of the WebSocket protocol (RFC 6455), as much of it as
+Athena's WebSocket transport needs.
+"""
+import struct
+from base64 import b64encode
+from binascii import hexlify, unhexlify
+from hashlib import sha1
+from urlparse import urlsplit
+
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol
+from twisted.protocols.policies import ProtocolWrapper
+
+
+
+# The GUID which the opening handshake combines with the client's key.
+_HANDSHAKE_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Frame opcodes.
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+# Close status codes.
+NORMAL_CLOSURE = 1000
+PROTOCOL_ERROR = 1002
+INVALID_PAYLOAD = 1007
+MESSAGE_TOO_BIG = 1009
+
+# The ports which are left out of origins and I{Host} headers.
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+
+def computeAcceptKey(key):
+    """
+    Compute the value of the I{Sec-WebSocket-Accept} response header for the
+    value of the I{Sec-WebSocket-Key} request header.
+
+    @type key: C{str}
+    @rtype: C{str}
+    """
+    return b64encode(sha1(key + _HANDSHAKE_GUID).digest())
+
+
+
+def isWebSocketRequest(request):
+    """
+    Determine whether C{request} asks to open a WebSocket connection of the
+    version implemented here.
+
+    @type request: L{nevow.inevow.IRequest}
+    @rtype: C{bool}
+    """
+    connection = (request.getHeader('connection') or '').lower()
+    return (
+        request.method == 'GET' and
+        (request.getHeader('upgrade') or '').lower() == 'websocket' and
+        'upgrade' in [token.strip() for token in connection.split(',')] and
+        request.getHeader('sec-websocket-version') == '13' and
+        request.getHeader('sec-websocket-key') is not None)
+
+
+
+def _hostAndPort(netloc, scheme):
+    """
+    Return the host and port of a I{Host} header or the network location of
+    an origin, filling in the default port for C{scheme}.
+
+    @rtype: two-tuple of C{str} and C{int}, or C{None} if C{netloc} is
+        malformed
+    """
+    parts = urlsplit('//' + netloc)
+    try:
+        port = parts.port
+    except ValueError:
+        return None
+    if not parts.hostname:
+        return None
+    return parts.hostname, port or _DEFAULT_PORTS[scheme]
+
+
+
+def isSameOrigin(request):
+    """
+    Determine whether C{request} comes from a page served by the host it is
+    addressed to, so that a page served by another site cannot open a
+    connection carrying the user's cookies.
+
+    Browsers send an I{Origin} header with every WebSocket request; requests
+    without one are not made by browsers and are allowed.
+
+    @type request: L{nevow.inevow.IRequest}
+    @rtype: C{bool}
+    """
+    origin = request.getHeader('origin')
+    if origin is None:
+        return True
+    host = request.getHeader('host')
+    if host is None:
+        return False
+    parts = urlsplit(origin)
+    if parts.scheme not in _DEFAULT_PORTS:
+        return False
+    expected = _hostAndPort(parts.netloc, parts.scheme)
+    return expected is not None and expected == _hostAndPort(
+        host, parts.scheme)
+
+
+
+def acceptWebSocket(request, protocol):
+    """
+    Complete the opening handshake for a request for which
+    L{isWebSocketRequest} is true, and hand its connection over to
+    C{protocol}.
+
+    The request itself is abandoned: nothing more may be written to it, and
+    it is never finished.  Only the public interfaces of the channel and the
+    transport are used, so anything the client sent after the request and
+    before the handshake completed is discarded; clients must not send
+    frames until then.
+
+    @type request: L{twisted.web.http.Request}
+    @type protocol: L{WebSocketProtocol}
+    """
+    channel = request.channel
+    transport = channel.transport
+    channel.setTimeout(None)
+    # The channel registers itself as the transport's producer, to stop
+    # reading while it handles a request.
+    transport.unregisterProducer()
+    channel.transport = None
+
+    if isinstance(transport, ProtocolWrapper):
+        transport.wrappedProtocol = protocol
+    else:
+        transport.protocol = protocol
+    transport.write(
+        'HTTP/1.1 101 Switching Protocols\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        'Sec-WebSocket-Accept: %s\r\n'
+        '\r\n' % (computeAcceptKey(request.getHeader('sec-websocket-key')),))
+    protocol.makeConnection(transport)
+    producer = IPushProducer(transport, None)
+    if producer is not None:
+        # The channel may have paused the transport; nothing else will
+        # resume it now.
+        producer.resumeProducing()
+
+
+
+def _makeFrame(opcode, payload):
+    """
+    Return an unmasked, final frame of the given type carrying C{payload}.
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+
+def _unmask(key, payload):
+    """
+    Apply the four byte masking C{key} to C{payload}, all at once rather than
+    byte by byte.
+    """
+    length = len(payload)
+    if not length:
+        return payload
+    key = (key * (length // 4 + 1))[:length]
+    unmasked = int(hexlify(payload), 16) ^ int(hexlify(key), 16)
+    return unhexlify('%0*x' % (length * 2, unmasked))
+
+
+
+class WebSocketProtocol(Protocol):
+    """
+    The server side of a WebSocket connection, once the opening handshake is
+    complete.
+
+    Subclasses override L{messageReceived} and send messages with
+    L{sendMessage}.  Pings are answered and closing handshakes completed
+    automatically.
+
+    @ivar maxMessageSize: The size in bytes of the largest message which will
+        be accepted.  The connection is closed if a client sends a larger
+        one.
+    """
+    maxMessageSize = 2 ** 22
+
+    _closing = False
+
+    def __init__(self):
+        self._buffer = ''
+        self._fragments = []
+        self._fragmentsSize = 0
+
+
+    def messageReceived(self, message):
+        """
+        Handle a complete message from the client.  Override this.
+
+        @type message: C{str}
+        """
+
+
+    def sendMessage(self, message):
+        """
+        Send a text message to the client.
+
+        @param message: UTF-8 encoded text.
+        @type message: C{str}
+        """
+        if not self._closing:
+            self.transport.write(_makeFrame(TEXT, message))
+
+
+    def close(self, code=NORMAL_CLOSURE):
+        """
+        Start the closing handshake, if it has not already started, and drop
+        the connection.
+        """
+        if not self._closing:
+            self._closing = True
+            self.transport.write(_makeFrame(CLOSE, struct.pack('!H', code)))
+            self.transport.loseConnection()
+
+
+    def dataReceived(self, data):
+        self._buffer += data
+        while not self._closing:
+            frame = self._parseFrame()
+            if frame is None:
+                break
+            self._frameReceived(*frame)
+
+
+    def _parseFrame(self):
+        """
+        Remove a complete frame from the start of the buffer and return a
+        three-tuple of whether it is final, its opcode and its unmasked
+        payload, or return C{None} if the buffer does not hold one.
+        """
+        buf = self._buffer
+        if len(buf) < 2:
+            return None
+        first, second = struct.unpack('!BB', buf[:2])
+        length = second & 0x7f
+        offset = 2
+        if length == 126:
+            if len(buf) < 4:
+                return None
+            length, = struct.unpack('!H', buf[2:4])
+            offset = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return None
+            length, = struct.unpack('!Q', buf[2:10])
+            offset = 10
+        if not second & 0x80:
+            # Clients must mask every frame.
+            self.close(PROTOCOL_ERROR)
+            return None
+        if length > self.maxMessageSize:
+            self.close(MESSAGE_TOO_BIG)
+            return None
+        end = offset + 4 + length
+        if len(buf) < end:
+            return None
+        payload = _unmask(buf[offset:offset + 4], buf[offset + 4:end])
+        self._buffer = buf[end:]
+        return bool(first & 0x80), first & 0x0f, payload
+
+
+    def _frameReceived(self, final, opcode, payload):
+        """
+        Handle a frame from the client.
+        """
+        if opcode == PING:
+            self.transport.write(_makeFrame(PONG, payload))
+        elif opcode == PONG:
+            pass
+        elif opcode == CLOSE:
+            self.close()
+        elif opcode in (TEXT, BINARY, CONTINUATION):
+            if (opcode == CONTINUATION) != bool(self._fragments):
+                self.close(PROTOCOL_ERROR)
+                return
+            self._fragments.append(payload)
+            self._fragmentsSize += len(payload)
+            if self._fragmentsSize > self.maxMessageSize:
+                self.close(MESSAGE_TOO_BIG)
+                return
+            if final:
+                message = ''.join(self._fragments)
+                self._fragments = []
+                self._fragmentsSize = 0
+                self.messageReceived(message)
+        else:
+            self.close(PROTOCOL_ERROR)
@@ -1,12 +1,18 @@
 # -*- test-case-name: nevow.test.test_athena -*-
 
-import itertools, os, re, warnings, StringIO
+import itertools, os, re, time, warnings, StringIO
+from hashlib import sha1
+from collections import deque
+from gzip import GzipFile
 
 from zope.interface import implements
 
-from twisted.internet import defer, error, reactor
+from twisted.internet import defer, error, reactor, endpoints
 from twisted.python import log, failure, context
 from twisted.python.util import sibpath
+from twisted.python.reflect import qual
+from twisted.python.filepath import FilePath
+from twisted.web import http, proxy, resource, server
 from twisted import plugin
 
 from nevow import inevow, plugins, flat, _flat
@@ -15,8 +21,13 @@ from nevow import json, util, tags, guard, stan
 from nevow.util import CachedFile
 from nevow.useragent import UserAgent, browsers
 from nevow.url import here, URL
+from nevow.compression import parseAcceptEncoding
+from nevow.athenametrics import AthenaMetrics
+from nevow._websocket import (
+    WebSocketProtocol, isWebSocketRequest, isSameOrigin, acceptWebSocket,
+    INVALID_PAYLOAD)
 
-from nevow.page import Element, renderer
+from nevow.page import Element, renderer, preventCaching
 
 ATHENA_XMLNS_URI = "http://divmod.org/ns/athena/0.7"
 ATHENA_RECONNECT = "__athena_reconnect__"
@@ -86,11 +97,148 @@ def activeChannel(request):
 
 
 
+# The number of seconds for which clients may keep a module or bundle fetched
+# from a URL which includes its digest, since the URL changes whenever the
+# content does.
+_IMMUTABLE_EXPIRES = 60 * 60 * 24 * 365
+
+class _ModuleContent(object):
+    """
+    The content of a module file or bundle of modules, kept in memory.
+
+    @ivar data: The content.
+    @type data: C{str}
+
+    @ivar type: The content type of C{data}.
+    @type type: C{str}
+
+    @ivar digest: The SHA-1 hex digest of C{data}, which identifies this
+        version of the content in URLs.
+    @type digest: C{str}
+    """
+    def __init__(self, data, type):
+        self.data = data
+        self.type = type
+        self.digest = sha1(data).hexdigest()
+        self._compressed = None
+
+
+    def compressed(self):
+        """
+        Return C{data} compressed with gzip, compressing it the first time
+        this is called.
+        """
+        if self._compressed is None:
+            buf = StringIO.StringIO()
+            gzip = GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+            gzip.write(self.data)
+            gzip.close()
+            self._compressed = buf.getvalue()
+        return self._compressed
+
+
+
+def _readModuleContent(path):
+    """
+    Read the module file at C{path} into a L{_ModuleContent}.
+    """
+    type = static.getTypeAndEncoding(
+        path, static.File.contentTypes, static.File.contentEncodings,
+        'text/plain')[0]
+    f = file(path, 'rb')
+    try:
+        return _ModuleContent(f.read(), type)
+    finally:
+        f.close()
+
+
+
+# Module file paths mapped to CachedFiles of their _ModuleContent.
+_moduleFiles = {}
+
+def _loadModuleContent(path):
+    """
+    Return the L{_ModuleContent} of the module file at C{path}, reading the
+    file only if it has changed since it was last read.
+    """
+    cached = _moduleFiles.get(path)
+    if cached is None:
+        cached = _moduleFiles[path] = CachedFile(path, _readModuleContent)
+    return cached.load()
+
+
+
+class _ImmutableModuleResource(object):
+    """
+    L{inevow.IResource} which serves a L{_ModuleContent} from a URL which
+    includes its digest, and so may be cached by clients forever.  The
+    content is compressed with gzip for clients which accept it.
+
+    @ivar content: The L{_ModuleContent} to serve.
+    """
+    implements(inevow.IResource)
+
+    def __init__(self, content):
+        self.content = content
+
+
+    def time(self):
+        """
+        Return the current time as a float.  Overridden by tests.
+        """
+        return time.time()
+
+
+    def locateChild(self, ctx, segments):
+        return rend.NotFound
+
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', self.content.type)
+        request.setHeader(
+            'cache-control',
+            'public, max-age=%d, immutable' % (_IMMUTABLE_EXPIRES,))
+        request.setHeader(
+            'expires', http.datetimeToString(self.time() + _IMMUTABLE_EXPIRES))
+        request.setHeader('vary', 'accept-encoding')
+        data = self.content.data
+        encodings = parseAcceptEncoding(
+            request.getHeader('accept-encoding') or '')
+        if encodings.get('gzip', 0.0) > 0.0:
+            data = self.content.compressed()
+            request.setHeader('content-encoding', 'gzip')
+        request.setHeader('content-length', str(len(data)))
+        if request.method == 'HEAD':
+            return ''
+        return data
+
+
+
+def _moduleURL(root, mapping, moduleName):
+    """
+    Return the URL below C{root} of the current version of the module named
+    C{moduleName}, or the URL of the module without a version if it is not in
+    C{mapping}.
+    """
+    url = root.child(moduleName)
+    path = mapping.get(moduleName)
+    if path is not None:
+        url = url.child(_loadModuleContent(path).digest)
+    return url
+
+
+
 class MappingResource(object):
     """
     L{inevow.IResource} which looks up segments in a mapping between symbolic
     names and the files they correspond to. 
 
+    A name may be followed by the digest of the current version of its file,
+    in which case the file is served from memory with headers allowing
+    clients to cache it forever.  If the digest is out of date, the current
+    version is served as if there were none.
+
     @type mapping: C{dict}
     @ivar mapping: A map between symbolic, requestable names (eg,
     'Nevow.Athena') and C{str} instances which name files containing data
@@ -120,10 +268,174 @@ class MappingResource(object):
         except KeyError:
             return rend.NotFound
         else:
+            if len(segments) == 2:
+                content = _loadModuleContent(impl)
+                if segments[1] == content.digest:
+                    return _ImmutableModuleResource(content), []
             return self.resourceFactory(impl), []
 
 
 
+# The segment below a JavaScript module root at which bundles are found.
+# Module names are dotted identifiers, so it cannot name a module.
+_BUNDLE_SEGMENT = '__bundle__'
+
+# The separator between the module names in the URL of a bundle, which cannot
+# appear in a module name either.
+_BUNDLE_SEPARATOR = u','
+
+class _JSBundler(object):
+    """
+    Concatenate JavaScript modules into bundles, which are kept in memory and
+    identified by a digest of their contents.
+
+    The URL of a bundle names its modules as well as giving its digest, so a
+    process which did not build a bundle (another server process, or this
+    one after a restart) can build it again when it is requested.
+
+    @ivar _versions: A mapping from tuples of module names and paths to
+        two-tuples of the digests of those files and the digest of the bundle
+        built from them.
+
+    @ivar _bundles: A mapping from digests to L{_ModuleContent}s of bundles.
+    """
+    def __init__(self):
+        self._versions = {}
+        self._bundles = {}
+
+
+    def _build(self, mapping, moduleNames):
+        """
+        Return the paths and module digests of the named modules, and the
+        digest of their bundle, using the bundle already built from them if
+        none of the modules has changed.
+
+        @return: A three-tuple of the key of L{_versions}, the digests of the
+            modules and the L{_ModuleContent} of the bundle.
+        """
+        paths = tuple([(name, mapping[name]) for name in moduleNames])
+        modules = [(name, _loadModuleContent(path)) for (name, path) in paths]
+        moduleDigests = tuple([content.digest for (name, content) in modules])
+        previous = self._versions.get(paths)
+        if previous is not None:
+            previousDigests, digest = previous
+            if previousDigests == moduleDigests:
+                return paths, moduleDigests, self._bundles[digest]
+
+        parts = []
+        for (name, content) in modules:
+            parts.append(jsModuleDeclaration(name).encode('ascii'))
+            parts.append('\n')
+            parts.append(content.data)
+            parts.append('\n')
+        return (paths, moduleDigests,
+                _ModuleContent(''.join(parts), 'text/javascript'))
+
+
+    def _keep(self, paths, moduleDigests, bundle):
+        """
+        Remember C{bundle} as the current bundle of the modules at C{paths},
+        discarding the one it replaces.
+        """
+        previous = self._versions.get(paths)
+        if previous is not None and previous[1] != bundle.digest:
+            self._bundles.pop(previous[1], None)
+        self._versions[paths] = (moduleDigests, bundle.digest)
+        self._bundles[bundle.digest] = bundle
+
+
+    def getDigest(self, mapping, moduleNames):
+        """
+        Return the digest of the bundle of the named modules, building it if
+        it does not exist or any of the modules has changed.
+
+        @param mapping: A mapping from module names to the paths of the files
+            which implement them.
+
+        @param moduleNames: The names of the modules, ordered so that each
+            comes after all of its dependencies.
+
+        @rtype: C{str}
+        """
+        paths, moduleDigests, bundle = self._build(mapping, moduleNames)
+        self._keep(paths, moduleDigests, bundle)
+        return bundle.digest
+
+
+    def getBundle(self, mapping, moduleNames, digest):
+        """
+        Return the L{_ModuleContent} of the bundle of the named modules if
+        its digest is C{digest}, building it if it is not in memory.
+
+        @param mapping: A mapping from module names to the paths of the files
+            which implement them.
+
+        @param moduleNames: The names of the modules, as given in the URL of
+            the bundle.
+
+        @param digest: The digest given in the URL of the bundle.
+
+        @return: The L{_ModuleContent}, or C{None} if a module is not in
+            C{mapping} or the bundle of the current versions of the modules
+            has a different digest.
+        """
+        bundle = self._bundles.get(digest)
+        if bundle is not None and self._versions.get(
+            tuple([(name, mapping.get(name)) for name in moduleNames]),
+            (None, None))[1] == digest:
+            return bundle
+        try:
+            paths, moduleDigests, bundle = self._build(mapping, moduleNames)
+        except KeyError:
+            return None
+        if bundle.digest != digest:
+            return None
+        # Only a bundle some page could have asked for is kept, so requests
+        # for other lists of modules cannot fill memory.
+        self._keep(paths, moduleDigests, bundle)
+        return bundle
+
+
+    def getSegments(self, mapping, moduleNames):
+        """
+        Return the path segments, below the L{_BUNDLE_SEGMENT} segment, of
+        the URL of the bundle of the named modules.
+
+        @see: L{getDigest}
+
+        @rtype: C{list} of C{unicode}
+        """
+        return [self.getDigest(mapping, moduleNames).decode('ascii'),
+                _BUNDLE_SEPARATOR.join(moduleNames)]
+
+
+_theJSBundler = _JSBundler()
+
+
+
+class JSModuleResource(MappingResource):
+    """
+    L{MappingResource} for JavaScript modules, which also serves bundles of
+    modules built by L{LivePage.getJSBundleURL}.
+    """
+    def locateChild(self, ctx, segments):
+        if segments[0] == _BUNDLE_SEGMENT:
+            if len(segments) != 3:
+                return rend.NotFound
+            try:
+                moduleNames = segments[2].decode('ascii').split(
+                    _BUNDLE_SEPARATOR)
+            except UnicodeDecodeError:
+                return rend.NotFound
+            bundle = _theJSBundler.getBundle(
+                self.mapping, moduleNames, segments[1])
+            if bundle is None:
+                return rend.NotFound
+            return _ImmutableModuleResource(bundle), []
+        return MappingResource.locateChild(self, ctx, segments)
+
+
+
 def _dependencyOrdered(coll, memo):
     """
     @type coll: iterable of modules
@@ -550,6 +862,96 @@ def getJSFailure(exc, modules):
 
 
 
+# The request header with which a client asks for the response to a basket
+# to be streamed.
+STREAMING_HEADER = 'x-athena-streaming'
+
+class _StreamingOutput(object):
+    """
+    An output of a L{ReliableMessageDelivery} which writes each basket it is
+    used for to an HTTP response, as a line of JSON, and keeps the response
+    open for more.
+
+    It stays an output until it is used for a basket with no new messages
+    (because it has been idle, or has been superseded by a newer output), the
+    message delivery is closed, or it has been open for the message
+    delivery's C{idleTimeout}.  Then the response is finished and the client
+    polls again.
+
+    @ivar sentSeq: The sequence number of the last message written, so that
+        messages are written only once.
+
+    @ivar finished: A L{Deferred} which fires with C{''} when the response
+        is finished.
+    """
+    def __init__(self, request, messageDeliverer):
+        self.request = request
+        self.messageDeliverer = messageDeliverer
+        self.sentSeq = -1
+        self.finished = defer.Deferred()
+        self._pending = None
+        self._expired = False
+        self._expiry = messageDeliverer.scheduler(
+            messageDeliverer.idleTimeout, self._expire)
+
+
+    def start(self, response):
+        """
+        Use this output first for the basket which C{response}, the
+        L{Deferred} returned by
+        L{ReliableMessageDelivery.basketCaseReceived}, fires with.
+        """
+        self._pending = response
+        response.addCallback(self)
+
+
+    def __call__(self, (ack, messages)):
+        self._pending = None
+        new = [(seq, msg) for (seq, msg) in messages if seq > self.sentSeq]
+        self.request.write(
+            self.messageDeliverer.serializeBasket([ack, new]) + '\n')
+        if new:
+            self.sentSeq = new[-1][0]
+        if new and not self._expired and not self.messageDeliverer._stopped:
+            self._pending = self
+            self.messageDeliverer.addOutput(self)
+        else:
+            self._finish()
+
+
+    def _expire(self):
+        """
+        Finish the response now if this is an output, or after its next use
+        otherwise.
+        """
+        self._expiry = None
+        self._expired = True
+        if self._pending is self:
+            self.messageDeliverer._unregisterDeferredAsOutputChannel(self)
+            self([self.messageDeliverer.outgoingAck, []])
+
+
+    def _finish(self):
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        self.finished.callback('')
+
+
+    def connectionLost(self):
+        """
+        Withdraw this output, as the response can no longer be written.
+        """
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        if self._pending is not None:
+            self.messageDeliverer._unregisterDeferredAsOutputChannel(
+                self._pending)
+            self._pending = None
+
+
+
 class LivePageTransport(object):
     implements(inevow.IResource)
 
@@ -568,25 +970,257 @@ class LivePageTransport(object):
         if self.useActiveChannels:
             activeChannel(req)
 
+        # The type NevowRequest defaults to, set here so that streamed and
+        # unstreamed responses have it whatever request they are written to.
+        req.setHeader('content-type', 'text/html; charset=UTF-8')
+
         requestContent = req.content.read()
         messageData = json.parse(requestContent)
 
         response = self.messageDeliverer.basketCaseReceived(ctx, messageData)
-        response.addCallback(json.serialize)
+        if req.getHeader(STREAMING_HEADER):
+            stream = _StreamingOutput(req, self.messageDeliverer)
+            stream.start(response)
+            req.notifyFinish().addErrback(lambda err: stream.connectionLost())
+            return stream.finished
+        response.addCallback(self.messageDeliverer.serializeBasket)
         req.notifyFinish().addErrback(lambda err: self.messageDeliverer._unregisterDeferredAsOutputChannel(response))
         return response
 
 
 
+class _LivePageWebSocketProtocol(WebSocketProtocol):
+    """
+    WebSocket protocol over which a client exchanges baskets of messages
+    with a L{ReliableMessageDelivery}.
+
+    Each message from the client is a basket, as would be posted to
+    L{LivePageTransport}, and opens an output, which the client is sent as a
+    message when it is used, just as it would be sent as the response to the
+    POST.
+
+    @ivar messageDeliverer: The L{ReliableMessageDelivery} of the page.
+
+    @ivar ctx: The context of the request which opened the connection, with
+        which messages are delivered to the page.
+
+    @ivar _outputs: The L{Deferred}s of the outputs opened over this
+        connection which have not yet been used.
+    """
+    def __init__(self, messageDeliverer, ctx):
+        WebSocketProtocol.__init__(self)
+        self.messageDeliverer = messageDeliverer
+        self.ctx = ctx
+        self._outputs = []
+
+
+    def messageReceived(self, message):
+        try:
+            basket = json.parse(message)
+        except (ValueError, IndexError):
+            # The parser raises IndexError for truncated input.
+            log.msg("Closing WebSocket after malformed basket: %r" % (
+                message[:100],))
+            self.close(INVALID_PAYLOAD)
+            return
+        output = self.messageDeliverer.basketCaseReceived(self.ctx, basket)
+        self._outputs.append(output)
+        output.addCallback(self._outputUsed, output)
+
+
+    def _outputUsed(self, basket, output):
+        """
+        Send the basket an output was used for to the client.
+        """
+        self._outputs.remove(output)
+        self.sendMessage(self.messageDeliverer.serializeBasket(basket))
+
+
+    def connectionLost(self, reason):
+        """
+        Withdraw the outputs which can no longer be used.
+        """
+        outputs, self._outputs = self._outputs, []
+        for output in outputs:
+            self.messageDeliverer._unregisterDeferredAsOutputChannel(output)
+
+
+
+class LivePageWebSocketTransport(object):
+    """
+    Alternative to L{LivePageTransport} which exchanges baskets of messages
+    with the client over a WebSocket connection instead of a series of
+    requests.
+    """
+    implements(inevow.IResource)
+
+    def __init__(self, messageDeliverer):
+        self.messageDeliverer = messageDeliverer
+
+
+    def locateChild(self, ctx, segments):
+        return rend.NotFound
+
+
+    def renderHTTP(self, ctx):
+        req = inevow.IRequest(ctx)
+        if not isWebSocketRequest(req):
+            req.setResponseCode(http.BAD_REQUEST)
+            return ''
+        if not isSameOrigin(req):
+            req.setResponseCode(http.FORBIDDEN)
+            return ''
+        acceptWebSocket(
+            req, _LivePageWebSocketProtocol(self.messageDeliverer, ctx))
+        # The connection now belongs to the protocol; the request is never
+        # finished.
+        return defer.Deferred()
+
+
+
+# The request header which marks a request forwarded from another process,
+# so that it is not forwarded again.
+FORWARDED_HEADER = 'x-athena-forwarded'
+
+# What client IDs look like, so that nothing else is looked up in a registry.
+_clientIDPattern = re.compile(r'^[0-9a-f]{32}$')
+
+
+class LocalClientRegistry(object):
+    """
+    An L{inevow.IAthenaClientRegistry} kept in memory.  Factories sharing one
+    stand in for processes sharing a registry, in tests.
+    """
+    implements(inevow.IAthenaClientRegistry)
+
+    def __init__(self):
+        self.owners = {}
+
+
+    def register(self, clientID, owner):
+        self.owners[clientID] = owner
+
+
+    def unregister(self, clientID):
+        self.owners.pop(clientID, None)
+
+
+    def lookup(self, clientID):
+        return self.owners.get(clientID)
+
+
+
+class DirectoryClientRegistry(object):
+    """
+    An L{inevow.IAthenaClientRegistry} kept as one file per client in a
+    directory, which the processes on one host can share.
+
+    @ivar path: The L{FilePath} of the directory.
+    """
+    implements(inevow.IAthenaClientRegistry)
+
+    def __init__(self, path):
+        """
+        @param path: The name of the directory, which must exist.
+        """
+        self.path = FilePath(path)
+
+
+    def register(self, clientID, owner):
+        self.path.child(clientID).setContent(owner)
+
+
+    def unregister(self, clientID):
+        try:
+            self.path.child(clientID).remove()
+        except OSError:
+            pass
+
+
+    def lookup(self, clientID):
+        try:
+            return self.path.child(clientID).getContent()
+        except IOError:
+            return None
+
+
+
+class _ForwardingResource(resource.Resource):
+    """
+    A resource which forwards the request for it to another process, and
+    relays the response.
+
+    @ivar owner: The client endpoint description of the other process.
+    """
+    isLeaf = True
+
+    def __init__(self, owner, reactor=reactor):
+        resource.Resource.__init__(self)
+        self.owner = owner
+        self.reactor = reactor
+
+
+    def render(self, request):
+        request.content.seek(0, 0)
+        headers = request.getAllHeaders().copy()
+        headers[FORWARDED_HEADER] = '1'
+        clientFactory = proxy.ProxyClientFactory(
+            request.method, request.uri, request.clientproto, headers,
+            request.content.read(), request)
+        connecting = endpoints.clientFromString(
+            self.reactor, self.owner).connect(clientFactory)
+        def ebConnect(reason):
+            log.err(reason, "Could not forward LivePage request to %s" % (
+                self.owner,))
+            request.setResponseCode(http.BAD_GATEWAY)
+            request.finish()
+        connecting.addErrback(ebConnect)
+        return server.NOT_DONE_YET
+
+
+
 class LivePageFactory:
+    """
+    Keeper of the connected L{LivePage}s, and of the topics their widgets
+    subscribe to with L{subscribe} so that L{publish} can call them all.
+
+    Several processes can serve the same pages if their factories share a
+    C{registry}.  Requests for a page which another process owns are then
+    forwarded to it, so a load balancer in front of the processes needs no
+    affinity.  WebSocket requests cannot be forwarded; clients which open
+    one to the wrong process fall back to the HTTP transport.
+
+    @ivar registry: C{None}, or an L{inevow.IAthenaClientRegistry} shared
+        with the factories of other processes.
+    @ivar owner: The client endpoint description of a port on which this
+        process serves the site, for the factories of other processes to
+        forward requests to.
+    @ivar metrics: The L{AthenaMetrics} of the factory's pages.  Publish it
+        with L{nevow.athenametrics.MetricsResource}.
+    """
     noisy = True
 
-    def __init__(self):
+    def __init__(self, registry=None, owner=None, metrics=None):
         self.clients = {}
+        self.registry = registry
+        self.owner = owner
+        if metrics is None:
+            metrics = AthenaMetrics()
+        self.metrics = metrics
+        # Topics mapped to dictionaries of subscribed widgets and the names
+        # of the methods to call on them.
+        self._subscribers = {}
+        # The client IDs of pages mapped to dictionaries of their subscribed
+        # widgets and the sets of topics they subscribe to, so that a page's
+        # subscriptions can be dropped when it disconnects.
+        self._subscriptions = {}
 
     def addClient(self, client):
         clientID = self._newClientID()
         self.clients[clientID] = client
+        self.metrics.livePages = len(self.clients)
+        if self.registry is not None:
+            self._updateRegistry(self.registry.register, clientID, self.owner)
         if self.noisy:
             log.msg("Rendered new LivePage %r: %r" % (client, clientID))
         return clientID
@@ -600,13 +1234,127 @@ class LivePageFactory:
         # client ID is already gone, then it should be gone, which means that
         # this method can't be called with that argument.
         del self.clients[clientID]
+        self.metrics.livePages = len(self.clients)
+        for widget in self._subscriptions.get(clientID, {}).keys():
+            self.unsubscribeAll(widget, clientID)
+        if self.registry is not None:
+            self._updateRegistry(self.registry.unregister, clientID)
         if self.noisy:
             log.msg("Disconnected old LivePage %r" % (clientID,))
 
+    def _updateRegistry(self, method, *args):
+        """
+        Call a method of the registry, logging rather than raising any error.
+        """
+        defer.maybeDeferred(method, *args).addErrback(
+            log.err, "Could not update the LivePage client registry")
+
+    def forwardClient(self, request, clientID):
+        """
+        Find out whether the page with the client ID C{clientID}, which is not
+        one of this factory's, belongs to another process.
+
+        @return: C{None}, or a resource which forwards C{request} to the
+            process, or a L{Deferred} which fires with one of these.
+        """
+        if (self.registry is None or
+                request.getHeader(FORWARDED_HEADER) is not None or
+                _clientIDPattern.match(clientID) is None):
+            return None
+        def cbLookedUp(owner):
+            if owner is None or owner == self.owner:
+                return None
+            return _ForwardingResource(owner)
+        owner = self.registry.lookup(clientID)
+        if isinstance(owner, defer.Deferred):
+            return owner.addCallback(cbLookedUp)
+        return cbLookedUp(owner)
+
     def _newClientID(self):
         return guard._sessionCookie()
 
 
+    def subscribe(self, topic, widget, methodName):
+        """
+        Have the client-side method named C{methodName} of C{widget} called
+        with the arguments given to L{publish} for C{topic}, until the widget
+        unsubscribes, is detached or its page disconnects.
+
+        @type widget: L{LiveElement} or L{LiveFragment}
+        @type methodName: C{str}
+        """
+        self._subscribers.setdefault(topic, {})[widget] = unicode(
+            methodName, 'ascii')
+        self._subscriptions.setdefault(
+            widget.page.clientID, {}).setdefault(widget, set()).add(topic)
+
+
+    def unsubscribe(self, topic, widget, clientID=None):
+        """
+        Stop calling C{widget} for C{topic}.
+
+        @param clientID: The client ID of the widget's page, if it is no
+            longer the widget's C{page}.
+        """
+        subscribers = self._subscribers.get(topic, {})
+        subscribers.pop(widget, None)
+        if not subscribers:
+            self._subscribers.pop(topic, None)
+        if clientID is None:
+            clientID = widget.page.clientID
+        widgets = self._subscriptions.get(clientID, {})
+        topics = widgets.get(widget, set())
+        topics.discard(topic)
+        if not topics:
+            widgets.pop(widget, None)
+        if not widgets:
+            self._subscriptions.pop(clientID, None)
+
+
+    def unsubscribeAll(self, widget, clientID=None):
+        """
+        Stop calling C{widget} for any topic.  This is done for every widget
+        which is detached or whose page disconnects.
+
+        @param clientID: The client ID of the widget's page, if it is no
+            longer the widget's C{page}.
+        """
+        if clientID is None:
+            clientID = widget.page.clientID
+        topics = self._subscriptions.get(clientID, {}).get(widget, ())
+        for topic in list(topics):
+            self.unsubscribe(topic, widget, clientID)
+
+
+    def publish(self, topic, *args):
+        """
+        Call the method of each widget subscribed to C{topic} with C{args}.
+
+        The arguments are serialized once, and the same serialized form is
+        sent to every subscriber.  Nothing is sent back; use
+        L{LivePage.callRemote} for calls which have results.  Subscribers
+        whose pages have too many messages waiting are skipped, or sent the
+        update in place of their last unsent one for C{topic}, as their
+        pages' C{TRANSPORT_OVERFLOW_POLICY} says.
+
+        @return: The number of subscribers the call was sent to.
+        """
+        subscribers = self._subscribers.get(topic)
+        if not subscribers:
+            return 0
+        payload = json.Serialized(json.serialize(args))
+        sent = 0
+        for widget, methodName in subscribers.items():
+            message = (u'notify', (u'Nevow.Athena.callByAthenaID',
+                                   (widget._athenaID, methodName, payload)))
+            try:
+                widget.page.addMessage(message, (topic, widget._athenaID))
+            except MessageQueueFull:
+                continue
+            sent += 1
+        return sent
+
+
 _thePrivateAthenaResource = static.File(util.resource_filename('nevow', 'athena_private'))
 
 
@@ -618,9 +1366,22 @@ class ConnectionLost(Exception):
     pass
 
 
+class MessageQueueFull(Exception):
+    """
+    A message could not be sent because too many messages are already waiting
+    to be sent to, or acknowledged by, the client.
+    """
+
+
 CLOSE = u'close'
 UNLOAD = u'unload'
 
+# What a ReliableMessageDelivery does with a message which would take it over
+# its limits.  See ReliableMessageDelivery.overflowPolicy.
+OVERFLOW_DROP = 'drop'
+OVERFLOW_COALESCE = 'coalesce'
+OVERFLOW_DISCONNECT = 'disconnect'
+
 class ReliableMessageDelivery(object):
     """
     A reliable message delivery abstraction over a possibly unreliable transport.
@@ -651,6 +1412,49 @@ class ReliableMessageDelivery(object):
     @type connectionMade: callable or C{None}
     @ivar connectionMade: A callback invoked with no arguments when it first
         becomes possible to to send a message to the client.
+
+    @type coalesceDelay: C{float} or C{None}
+    @ivar coalesceDelay: If not C{None}, the amount of time (in seconds) to
+        wait after a message is added before using an output for it, so that
+        the messages added in the meantime are sent along with it.  C{0}
+        batches the messages added during one reactor iteration.
+
+    @type maxMessages: C{int} or C{None}
+    @ivar maxMessages: The largest number of unacknowledged messages to keep,
+        or C{None} for no limit.
+
+    @type maxBytes: C{int} or C{None}
+    @ivar maxBytes: The largest total size of the serialized unacknowledged
+        messages to keep, or C{None} for no limit.  A single message larger
+        than this is kept if no others are.  If it is set, each message is
+        serialized when it is added, and that serialized form is sent in its
+        place, so that it is not serialized again.
+
+    @ivar overflowPolicy: What to do with a message which would exceed
+        C{maxMessages} or C{maxBytes}.  L{OVERFLOW_DROP} refuses it;
+        L{OVERFLOW_COALESCE} puts it in place of the unsent message added with
+        the same key, if there is one, and refuses it otherwise;
+        L{OVERFLOW_DISCONNECT} discards every unacknowledged message, closes
+        the delivery and reports the connection lost with
+        L{MessageQueueFull}.  A refused message raises L{MessageQueueFull}
+        from L{addMessage}.  Responses to the client's calls, added with
+        L{addResponse}, are never refused.
+
+    @type metrics: L{AthenaMetrics}
+    @ivar metrics: The metrics to count this delivery's messages and timeouts
+        in.
+
+    @ivar messages: The unacknowledged messages, as two-tuples of sequence
+        numbers and messages, oldest first.
+
+    @ivar pendingBytes: The total size of the serialized unacknowledged
+        messages, if C{maxBytes} is set, or C{0}.
+
+    @ivar outputs: Two-tuples of outputs and their idle timeout calls.  An
+        output is a callable which is used once, with a two-tuple of the
+        acknowledged sequence number and a list of messages.  An output with a
+        C{sentSeq} attribute has already been sent the messages up to that
+        sequence number, and is only used for messages after it.
     """
     _paused = 0
     _stopped = False
@@ -662,15 +1466,35 @@ class ReliableMessageDelivery(object):
     outgoingSeq = -1            # sequence number of the next message to be
                                 # added to the outgoing queue.
 
+    _coalesceCall = None
+
     def __init__(self,
                  livePage,
                  connectTimeout=60, transportlessTimeout=30, idleTimeout=300,
                  connectionLost=None,
                  scheduler=None,
-                 connectionMade=None):
+                 connectionMade=None,
+                 coalesceDelay=None,
+                 maxMessages=None, maxBytes=None,
+                 overflowPolicy=OVERFLOW_DISCONNECT,
+                 metrics=None):
         self.livePage = livePage
-        self.messages = []
-        self.outputs = []
+        if metrics is None:
+            metrics = AthenaMetrics()
+        self.metrics = metrics
+        self.messages = deque()
+        self.outputs = deque()
+        self.maxMessages = maxMessages
+        self.maxBytes = maxBytes
+        self.overflowPolicy = overflowPolicy
+        self.pendingBytes = 0
+        # The serialized forms of the messages in self.messages, in the same
+        # order, if maxBytes is set, or None.
+        self._serializedMessages = deque()
+        # Keys given to addMessage, mapped to the sequence numbers of the
+        # messages added with them since messages were last sent.
+        self._unsentKeys = {}
+        self._spaceNotifications = []
         self.connectTimeout = connectTimeout
         self.transportlessTimeout = transportlessTimeout
         self.idleTimeout = idleTimeout
@@ -680,20 +1504,35 @@ class ReliableMessageDelivery(object):
         self._transportlessTimeoutCall = self.scheduler(self.connectTimeout, self._connectTimedOut)
         self.connectionMade = connectionMade
         self.connectionLost = connectionLost
+        self.coalesceDelay = coalesceDelay
 
 
     def _connectTimedOut(self):
         self._transportlessTimeoutCall = None
-        self.connectionLost(failure.Failure(ConnectFailed("Timeout")))
+        self.metrics.timedOut('connect')
+        self._lost(failure.Failure(ConnectFailed("Timeout")))
 
 
     def _transportlessTimedOut(self):
         self._transportlessTimeoutCall = None
-        self.connectionLost(failure.Failure(ConnectionLost("Timeout")))
+        self.metrics.timedOut('transportless')
+        self._lost(failure.Failure(ConnectionLost("Timeout")))
+
+
+    def _lost(self, reason):
+        """
+        Errback the Deferreds returned by L{notifyOnSpace} and invoke
+        C{connectionLost} with C{reason}.
+        """
+        notifications, self._spaceNotifications = self._spaceNotifications, []
+        for d in notifications:
+            d.errback(reason)
+        self.connectionLost(reason)
 
 
     def _idleTimedOut(self):
-        output, timeout = self.outputs.pop(0)
+        self.metrics.timedOut('idle')
+        output, timeout = self.outputs.popleft()
         if not self.outputs:
             self._transportlessTimeoutCall = self.scheduler(self.transportlessTimeout, self._transportlessTimedOut)
         output([self.outgoingAck, []])
@@ -701,20 +1540,47 @@ class ReliableMessageDelivery(object):
 
     def _sendMessagesToOutput(self, output):
         log.msg(athena_send_messages=True, count=len(self.messages))
-        output([self.outgoingAck, self.messages])
+        self._unsentKeys.clear()
+        output([self.outgoingAck,
+                [(seq, serialized or msg) for ((seq, msg), serialized)
+                 in itertools.izip(self.messages, self._serializedMessages)]])
+
+
+    def serializeBasket(self, basket):
+        """
+        Serialize a basket an output was used for, to be sent to the client.
+
+        This builds the whole string with L{json.serialize}, rather than
+        streaming it with L{json.serializeTo}, so that the C accelerator is
+        used.
+
+        @rtype: C{str}
+        """
+        data = json.serialize(basket)
+        self.metrics.bytesSerialized += len(data)
+        return data
 
 
     def pause(self):
         self._paused += 1
 
 
+    def _hasMessagesFor(self, output):
+        """
+        Return whether there are messages which have not been sent to
+        C{output}.
+        """
+        return bool(self.messages) and (
+            self.messages[-1][0] > getattr(output, 'sentSeq', -1))
+
+
     def _trySendMessages(self):
         """
         If we have pending messages and there is an available transport, then
         consume it to send the messages.
         """
-        if self.messages and self.outputs:
-            output, timeout = self.outputs.pop(0)
+        if self.outputs and self._hasMessagesFor(self.outputs[0][0]):
+            output, timeout = self.outputs.popleft()
             timeout.cancel()
             if not self.outputs:
                 self._transportlessTimeoutCall = self.scheduler(self.transportlessTimeout, self._transportlessTimedOut)
@@ -732,25 +1598,145 @@ class ReliableMessageDelivery(object):
             self._flushOutputs()
 
 
-    def addMessage(self, msg):
+    def hasSpace(self, size=0):
+        """
+        Return whether a message whose serialized size is C{size} can be added
+        without exceeding C{maxMessages} or C{maxBytes}.
+        """
+        if self.maxMessages is not None and (
+                len(self.messages) >= self.maxMessages):
+            return False
+        if self.maxBytes is not None and self.messages and (
+                self.pendingBytes + size > self.maxBytes):
+            return False
+        return True
+
+
+    def notifyOnSpace(self):
+        """
+        Return a L{Deferred} which fires with C{None} once another message can
+        be added, at once if one can be now, or errbacks if the connection is
+        lost first.
+        """
+        if self.hasSpace():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._spaceNotifications.append(d)
+        return d
+
+
+    def addMessage(self, msg, key=None):
+        """
+        Queue C{msg} to be sent to the client.
+
+        @param key: If not C{None}, a hashable value identifying messages which
+            supersede each other, for L{OVERFLOW_COALESCE}.
+
+        @raise MessageQueueFull: If the message is refused by
+            C{overflowPolicy}.
+
+        @return: The message which C{msg} was put in place of, or C{None}.
+        """
         if self._stopped:
-            return
+            return None
+        serialized = self._serialize(msg)
+        if not self.hasSpace(len(serialized or '')):
+            return self._overflow(msg, key, serialized)
+        self._enqueue(msg, serialized)
+        if key is not None:
+            self._unsentKeys[key] = self.outgoingSeq
+        return None
+
+
+    def addResponse(self, msg):
+        """
+        Queue C{msg}, the response to a call the client made, to be sent to
+        the client however many messages are waiting.
+
+        The client is waiting for it, and gets at most one for each call it
+        makes, so it is not subject to C{maxMessages}, C{maxBytes} or
+        C{overflowPolicy}.
+        """
+        if not self._stopped:
+            self._enqueue(msg, self._serialize(msg))
+
+
+    def _serialize(self, msg):
+        """
+        Return the serialized form of C{msg} if C{maxBytes} is set, so that
+        its size can be counted, or C{None}.
+
+        @rtype: L{json.Serialized} or C{NoneType}
+        """
+        if self.maxBytes is None:
+            return None
+        return json.Serialized(json.serialize(msg))
+
+
+    def _overflow(self, msg, key, serialized):
+        """
+        Apply C{overflowPolicy} to a message which does not fit.
+        """
+        size = len(serialized or '')
+        description = "%d messages (%d bytes) waiting" % (
+            len(self.messages), self.pendingBytes)
+        if self.overflowPolicy == OVERFLOW_COALESCE:
+            seq = self._unsentKeys.get(key)
+            if seq is not None:
+                index = seq - self.messages[0][0]
+                change = size - len(self._serializedMessages[index] or '')
+                if (self.maxBytes is None or
+                        self.pendingBytes + change <= self.maxBytes):
+                    replaced = self.messages[index][1]
+                    self.messages[index] = (seq, msg)
+                    self._serializedMessages[index] = serialized
+                    self.pendingBytes += change
+                    return replaced
+        elif self.overflowPolicy == OVERFLOW_DISCONNECT:
+            # The close message follows the discarded ones in sequence, so
+            # no sequence number the client may have seen is used again.  The
+            # client acts on a close message even after a gap.
+            self.messages.clear()
+            self._serializedMessages.clear()
+            self.pendingBytes = 0
+            self._lost(failure.Failure(MessageQueueFull(description)))
+            self.close()
+        raise MessageQueueFull(description)
+
 
+    def _enqueue(self, msg, serialized):
+        """
+        Add C{msg}, with its serialized form or C{None}, to the queue and send
+        it, or arrange for it to be sent.
+        """
         self.outgoingSeq += 1
         self.messages.append((self.outgoingSeq, msg))
-        if not self._paused and self.outputs:
-            output, timeout = self.outputs.pop(0)
-            timeout.cancel()
-            if not self.outputs:
-                self._transportlessTimeoutCall = self.scheduler(self.transportlessTimeout, self._transportlessTimedOut)
-            self._sendMessagesToOutput(output)
+        self._serializedMessages.append(serialized)
+        self.pendingBytes += len(serialized or '')
+        self.metrics.pendingMessages.observe(len(self.messages))
+        if self.coalesceDelay is None:
+            if not self._paused:
+                self._trySendMessages()
+        elif self._coalesceCall is None:
+            self._coalesceCall = self.scheduler(
+                self.coalesceDelay, self._coalesceDelayElapsed)
+
+
+    def _coalesceDelayElapsed(self):
+        """
+        Send the messages added since C{coalesceDelay} started, if there is an
+        output for them.
+        """
+        self._coalesceCall = None
+        if not self._paused:
+            self._trySendMessages()
 
 
     def addOutput(self, output):
         if self._transportlessTimeoutCall is not None:
             self._transportlessTimeoutCall.cancel()
             self._transportlessTimeoutCall = None
-        if not self._paused and self.messages:
+        if not self._paused and self._hasMessagesFor(output):
             self._transportlessTimeoutCall = self.scheduler(self.transportlessTimeout, self._transportlessTimedOut)
             self._sendMessagesToOutput(output)
         else:
@@ -762,10 +1748,16 @@ class ReliableMessageDelivery(object):
 
     def close(self):
         assert not self._stopped, "Cannot multiply stop ReliableMessageDelivery"
-        self.addMessage((CLOSE, []))
+        self._enqueue((CLOSE, []), None)
         self._stopped = True
+        notifications, self._spaceNotifications = self._spaceNotifications, []
+        for d in notifications:
+            d.errback(ConnectionLost("Closed"))
+        if self._coalesceCall is not None:
+            self._coalesceCall.cancel()
+            self._coalesceCall = None
         while self.outputs:
-            output, timeout = self.outputs.pop(0)
+            output, timeout = self.outputs.popleft()
             timeout.cancel()
             self._sendMessagesToOutput(output)
         self.outputs = None
@@ -775,9 +1767,10 @@ class ReliableMessageDelivery(object):
 
 
     def _unregisterDeferredAsOutputChannel(self, deferred):
-        for i in xrange(len(self.outputs)):
-            if self.outputs[i][0].im_self is deferred:
-                output, timeout = self.outputs.pop(i)
+        for entry in self.outputs:
+            output, timeout = entry
+            if getattr(output, 'im_self', output) is deferred:
+                self.outputs.remove(entry)
                 timeout.cancel()
                 break
         else:
@@ -813,7 +1806,7 @@ class ReliableMessageDelivery(object):
         if self.outputs is None:
             return
         while len(self.outputs) > 1:
-            output, timeout = self.outputs.pop(0)
+            output, timeout = self.outputs.popleft()
             timeout.cancel()
             output([self.outgoingAck, []])
 
@@ -840,7 +1833,13 @@ class ReliableMessageDelivery(object):
 
         # dequeue messages that our client certainly knows about.
         while outgoingMessages and outgoingMessages[0][0] <= ack:
-            outgoingMessages.pop(0)
+            outgoingMessages.popleft()
+            self.pendingBytes -= len(self._serializedMessages.popleft() or '')
+        if self._spaceNotifications and self.hasSpace():
+            notifications = self._spaceNotifications
+            self._spaceNotifications = []
+            for d in notifications:
+                d.callback(None)
 
         if incomingMessages:
             log.msg(athena_received_messages=True, count=len(incomingMessages))
@@ -873,6 +1872,7 @@ class ReliableMessageDelivery(object):
                     self.unpause()
             else:
                 d = defer.succeed([self.outgoingAck, []])
+                self.metrics.sequenceGaps += 1
                 log.msg(
                     "Sequence gap! %r went from %s to %s" %
                     (self.livePage.clientID,
@@ -991,6 +1991,27 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
     @ivar _jsDepsMemo: A cache for JS module dependencies; by default, this
                        will only be shared within a single page instance.
 
+    @type bundleJSModules: C{bool}
+    @ivar bundleJSModules: If set, the JavaScript modules imported together
+        by the page glue or a widget are fetched as a single bundle from
+        L{getJSBundleURL}, rather than one by one.
+
+    @type useStreamingTransport: C{bool}
+    @ivar useStreamingTransport: If set, clients ask for the responses from
+        the page's C{transport} child to be streamed, so that several batches
+        of messages can be delivered before the client has to poll again.
+
+    @type useWebSocketTransport: C{bool}
+    @ivar useWebSocketTransport: If set, clients which support WebSockets
+        exchange messages with the page over a WebSocket connection to the
+        page's C{websocket} child, falling back to the C{transport} child if
+        the connection cannot be made or is lost.
+
+    @type transportTimerWheel: L{nevow.timerwheel.TimerWheel} or C{None}
+    @ivar transportTimerWheel: If not C{None}, the timer wheel which keeps
+        the page's transport timeouts, instead of the reactor.  Share one
+        between all pages to make the timeouts of many pages cheap.
+
     @type _didConnect: C{bool}
     @ivar _didConnect: Initially C{False}, set to C{True} if connectionMade has
         been invoked.
@@ -1016,6 +2037,10 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
     _didDisconnect = False
 
     useActiveChannels = True
+    bundleJSModules = True
+    useStreamingTransport = False
+    useWebSocketTransport = False
+    transportTimerWheel = None
 
     # This is the amount of time that each 'transport' request will remain open
     # to the server.  Although the underlying transport, i.e. the conceptual
@@ -1042,6 +2067,25 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
     # two chances to retry.
     TRANSPORTLESS_DISCONNECT_TIMEOUT = TRANSPORT_CLIENT_IDLE_TIMEOUT * 2 + 10
 
+    # This is the number of seconds for which messages are collected before
+    # they are sent, so that many calls made in quick succession (by a loop
+    # of callRemotes, for example) are answered with one response rather than
+    # several.  0 collects the messages sent during one reactor iteration;
+    # None sends each message as soon as there is a transport for it.
+    TRANSPORT_COALESCE_DELAY = 0
+
+    # These limit the number of messages, and the total size in bytes of the
+    # serialized messages, which may be waiting to be sent to or acknowledged
+    # by the browser, so that a browser which has stopped reading cannot make
+    # them pile up until the transportless timeout.  None means no limit.
+    # TRANSPORT_OVERFLOW_POLICY says what happens to a message which would
+    # exceed them: OVERFLOW_DROP, OVERFLOW_COALESCE or OVERFLOW_DISCONNECT (see
+    # ReliableMessageDelivery.overflowPolicy).  Use notifyOnQueueSpace to
+    # wait for room before sending more.
+    TRANSPORT_MAX_PENDING_MESSAGES = None
+    TRANSPORT_MAX_PENDING_BYTES = None
+    TRANSPORT_OVERFLOW_POLICY = OVERFLOW_DISCONNECT
+
     page = property(lambda self: self)
 
     # Modules needed to bootstrap
@@ -1117,7 +2161,15 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
         try:
             client = self.factory.getClient(segments[0])
         except KeyError:
-            return super(LivePage, self).locateChild(ctx, segments)
+            def cbForwarded(forwarder):
+                if forwarder is None:
+                    return super(LivePage, self).locateChild(ctx, segments)
+                return forwarder, ()
+            forwarder = self.factory.forwardClient(
+                inevow.IRequest(ctx, None), segments[0])
+            if isinstance(forwarder, defer.Deferred):
+                return forwarder.addCallback(cbForwarded)
+            return cbForwarded(forwarder)
         else:
             return client, segments[1:]
 
@@ -1151,13 +2203,22 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
 
         self._requestIDCounter = itertools.count().next
 
+        scheduler = None
+        if self.transportTimerWheel is not None:
+            scheduler = self.transportTimerWheel.callLater
         self._messageDeliverer = ReliableMessageDelivery(
             self,
             self.TRANSPORTLESS_DISCONNECT_TIMEOUT * 2,
             self.TRANSPORTLESS_DISCONNECT_TIMEOUT,
             self.TRANSPORT_IDLE_TIMEOUT,
             self._disconnected,
-            connectionMade=self._connectionMade)
+            scheduler=scheduler,
+            connectionMade=self._connectionMade,
+            coalesceDelay=self.TRANSPORT_COALESCE_DELAY,
+            maxMessages=self.TRANSPORT_MAX_PENDING_MESSAGES,
+            maxBytes=self.TRANSPORT_MAX_PENDING_BYTES,
+            overflowPolicy=self.TRANSPORT_OVERFLOW_POLICY,
+            metrics=self.factory.metrics)
         self._remoteCalls = {}
         self._localObjects = {}
         self._localObjectIDCounter = itertools.count().next
@@ -1253,6 +2314,7 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
 
         neverEverCache(request)
         if request.args.get(ATHENA_RECONNECT):
+            self.factory.metrics.reconnects += 1
             return json.serialize(self.clientID.decode("ascii"))
         return rend.Page.renderHTTP(self, ctx)
 
@@ -1324,17 +2386,83 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
         del self._localObjects[objID]
 
 
-    def callRemote(self, methodName, *args):
+    def callRemote(self, methodName, *args, **kw):
+        """
+        Call the function named C{methodName} in the browser with C{args}.
+
+        @param coalesceKey: Optional keyword argument.  If not C{None}, a
+            hashable value identifying calls which supersede each other: if
+            the page's outgoing messages are full and its
+            C{TRANSPORT_OVERFLOW_POLICY} is L{OVERFLOW_COALESCE}, this call
+            is made in place of an unsent call with the same key, and the
+            L{Deferred} returned for that call fires with the result of this
+            one.
+
+        @return: A L{Deferred} which fires with the result of the call, or
+            fails with L{MessageQueueFull} if the call could not be sent.
+        """
+        coalesceKey = kw.pop('coalesceKey', None)
+        if kw:
+            raise TypeError(
+                "callRemote() got unexpected keyword arguments %r" % (
+                    kw.keys(),))
+        return self._callRemote(methodName, args, coalesceKey, methodName)
+
+
+    def _callRemote(self, methodName, args, coalesceKey, latencyName):
+        """
+        Implement L{callRemote}, counting the latency of the call under
+        C{latencyName} in C{callRemoteLatency}.
+        """
         requestID = u's2c%i' % (self._requestIDCounter(),)
         message = (u'call', (unicode(methodName, 'ascii'), requestID, args))
-        resultD = defer.Deferred()
-        self._remoteCalls[requestID] = resultD
-        self.addMessage(message)
+        try:
+            replaced = self.addMessage(message, coalesceKey)
+        except MessageQueueFull:
+            return defer.fail()
+        # Register the call only once it has been queued, so that a
+        # disconnection caused by refusing it does not fail it a second time.
+        resultD = self._remoteCalls[requestID] = defer.Deferred()
+        metrics = self._messageDeliverer.metrics
+        started = metrics.clock.seconds()
+        def _cbMeasure(result):
+            if not (isinstance(result, failure.Failure) and
+                    result.check(ConnectionLost, ConnectFailed)):
+                metrics.observeLatency(
+                    metrics.callRemoteLatency, latencyName, started)
+            return result
+        resultD.addBoth(_cbMeasure)
+        if replaced is not None and replaced[0] == u'call':
+            supersededD = self._remoteCalls.pop(replaced[1][1])
+            def _cbRelay(result):
+                if isinstance(result, failure.Failure):
+                    supersededD.errback(result)
+                else:
+                    supersededD.callback(result)
+                return result
+            resultD.addBoth(_cbRelay)
         return resultD
 
 
-    def addMessage(self, message):
-        self._messageDeliverer.addMessage(message)
+    def addMessage(self, message, key=None):
+        """
+        Queue C{message} to be sent to the browser.  See
+        L{ReliableMessageDelivery.addMessage}.
+        """
+        return self._messageDeliverer.addMessage(message, key)
+
+
+    def notifyOnQueueSpace(self):
+        """
+        Return a L{Deferred} which fires once there is room for another
+        message to the browser under C{TRANSPORT_MAX_PENDING_MESSAGES} and
+        C{TRANSPORT_MAX_PENDING_BYTES}, so that code producing many messages
+        can wait for the browser to catch up.  It fails if the page
+        disconnects first.
+
+        @rtype: L{defer.Deferred}
+        """
+        return self._messageDeliverer.notifyOnSpace()
 
 
     def notifyOnDisconnect(self):
@@ -1353,19 +2481,51 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
 
 
     def getJSModuleURL(self, moduleName):
-        return self.jsModuleRoot.child(moduleName)
+        """
+        Return a URL rooted at L{jsModuleRoot} from which the JavaScript module
+        named C{moduleName} can be fetched.  The URL includes a digest of the
+        module, so it changes whenever the module does.
+
+        @type moduleName: C{unicode}
+
+        @rtype: L{URL}
+        """
+        return _moduleURL(
+            self.jsModuleRoot, self.jsModules.mapping, moduleName)
 
 
     def getCSSModuleURL(self, moduleName):
         """
         Return a URL rooted a L{cssModuleRoot} from which the CSS module named
-        C{moduleName} can be fetched.
+        C{moduleName} can be fetched.  The URL includes a digest of the
+        module, so it changes whenever the module does.
 
         @type moduleName: C{unicode}
 
         @rtype: C{str}
         """
-        return self.cssModuleRoot.child(moduleName)
+        return _moduleURL(
+            self.cssModuleRoot, self.cssModules.mapping, moduleName)
+
+
+    def getJSBundleURL(self, moduleNames):
+        """
+        Return a URL rooted at L{jsModuleRoot} from which a single script
+        defining all of the named modules can be fetched.  The URL includes a
+        digest of the script, so it changes whenever any of the modules does,
+        and the names of the modules, so any server process can build the
+        script again.
+
+        @param moduleNames: The names of the modules, ordered so that each
+            comes after all of its dependencies.
+
+        @rtype: L{URL}
+        """
+        url = self.jsModuleRoot.child(_BUNDLE_SEGMENT)
+        for segment in _theJSBundler.getSegments(
+            self.jsModules.mapping, moduleNames):
+            url = url.child(segment)
+        return url
 
 
     def getImportStan(self, moduleName):
@@ -1374,6 +2534,20 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
                 tags.script(type='text/javascript', src=self.getJSModuleURL(moduleName))]
 
 
+    def getImportsStan(self, moduleNames):
+        """
+        Get some stan which will import the named modules, in order.
+
+        If L{bundleJSModules} is set, more than one module is imported with a
+        single script from L{getJSBundleURL}.  Otherwise, each module is
+        imported using L{getImportStan}.
+        """
+        if self.bundleJSModules and len(moduleNames) > 1:
+            return tags.script(
+                type='text/javascript', src=self.getJSBundleURL(moduleNames))
+        return [self.getImportStan(name) for name in moduleNames]
+
+
     def render_liveglue(self, ctx, data):
         bootstrapString = '\n'.join(
             [self._bootstrapCall(method, args) for
@@ -1383,9 +2557,10 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
 
             # Hit jsDeps.getModuleForName to force it to load some plugins :/
             # This really needs to be redesigned.
-            [self.getImportStan(jsDeps.getModuleForName(name).name)
-             for (name, url)
-             in self._getRequiredModules(self._jsDepsMemo)],
+            self.getImportsStan(
+                [jsDeps.getModuleForName(name).name
+                 for (name, url)
+                 in self._getRequiredModules(self._jsDepsMemo)]),
             tags.script(type='text/javascript',
                         id=BOOTSTRAP_NODE_ID,
                         payload=bootstrapString)[
@@ -1401,12 +2576,18 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
 
         @param: a L{WovenContext} that can render an URL.
         """
-        return [
+        bootstraps = [
             ("Divmod.bootstrap",
              [flat.flatten(self.transportRoot, ctx).decode("ascii"),
-              self.TRANSPORT_CLIENT_IDLE_TIMEOUT]),
+              self.TRANSPORT_CLIENT_IDLE_TIMEOUT])]
+        if self.useStreamingTransport:
+            bootstraps.append(("Nevow.Athena.enableStreamingTransport", []))
+        if self.useWebSocketTransport:
+            bootstraps.append(("Nevow.Athena.enableWebSocketTransport", []))
+        bootstraps.append(
             ("Nevow.Athena.bootstrap",
-             [self.jsClass, self.clientID.decode('ascii')])]
+             [self.jsClass, self.clientID.decode('ascii')]))
+        return bootstraps
 
 
     def _bootstrapCall(self, methodName, args):
@@ -1424,7 +2605,7 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
 
 
     def child_jsmodule(self, ctx):
-        return MappingResource(self.jsModules.mapping)
+        return JSModuleResource(self.jsModules.mapping)
 
 
     def child_cssmodule(self, ctx):
@@ -1443,6 +2624,14 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
         return self._transportResource
 
 
+    _webSocketTransportResource = None
+    def child_websocket(self, ctx):
+        if self._webSocketTransportResource is None:
+            self._webSocketTransportResource = LivePageWebSocketTransport(
+                self._messageDeliverer)
+        return self._webSocketTransportResource
+
+
     def locateMethod(self, ctx, methodName):
         if methodName in self.iface:
             return getattr(self.rootObject, methodName)
@@ -1464,12 +2653,20 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
         Handle a remote call initiated by the client.
         """
         localObj = self._localObjects[objectID]
+        metrics = self._messageDeliverer.metrics
         try:
             func = localObj.locateMethod(ctx, method)
         except AttributeError:
             result = defer.fail(NoSuchMethod(objectID, method))
         else:
+            started = metrics.clock.seconds()
             result = defer.maybeDeferred(func, *args, **kwargs)
+            def _cbMeasure(result):
+                metrics.observeLatency(
+                    metrics.actionCallLatency,
+                    '%s.%s' % (qual(localObj.__class__), method), started)
+                return result
+            result.addBoth(_cbMeasure)
         def _cbCall(result):
             success = True
             if isinstance(result, failure.Failure):
@@ -1487,7 +2684,7 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
                                 result.type.__name__.decode('ascii'),
                                 result.getErrorMessage().decode('ascii'))])
             message = (u'respond', (unicode(requestId), success, result))
-            self.addMessage(message)
+            self._messageDeliverer.addResponse(message)
         result.addBoth(_cbCall)
 
 
@@ -1512,7 +2709,8 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
         """
         The client is going away.  Clean up after them.
         """
-        self._messageDeliverer.close()
+        if not self._messageDeliverer._stopped:
+            self._messageDeliverer.close()
         self._disconnected(error.ConnectionDone("Connection closed"))
 
 
@@ -1647,6 +2845,9 @@ class _LiveMixin(_HasJSClass, _HasCSSModule):
 
         if self.page is None:
             raise OrphanedFragment(self)
+        # The widget is added to its page each time it is rendered, so markup
+        # containing it must never be replayed from a cache.
+        preventCaching()
         self._athenaID = self.page.addLocalObject(self)
         if self.page._didConnect:
             self.connectionMade()
@@ -1762,7 +2963,7 @@ class _LiveMixin(_HasJSClass, _HasCSSModule):
             self.getStylesheetStan(requiredCSSModules),
 
             # Import stuff
-            [self.getImportStan(name) for (name, url) in requiredModules],
+            self.page.getImportsStan([name for (name, url) in requiredModules]),
 
             # Dump some data for our client-side __init__ into a text area
             # where it can easily be found.
@@ -1798,12 +2999,39 @@ class _LiveMixin(_HasJSClass, _HasCSSModule):
         return remoteMethod
 
 
-    def callRemote(self, methodName, *varargs):
-        return self.page.callRemote(
+    def callRemote(self, methodName, *varargs, **kw):
+        """
+        Call the client-side method named C{methodName} of this widget, as
+        L{LivePage.callRemote} calls a function.  The latency of the call is
+        counted for the qualified name of this widget's class followed by
+        C{methodName}.
+        """
+        coalesceKey = kw.pop('coalesceKey', None)
+        if kw:
+            raise TypeError(
+                "callRemote() got unexpected keyword arguments %r" % (
+                    kw.keys(),))
+        return self.page._callRemote(
             "Nevow.Athena.callByAthenaID",
-            self._athenaID,
-            unicode(methodName, 'ascii'),
-            varargs)
+            (self._athenaID, unicode(methodName, 'ascii'), varargs),
+            coalesceKey,
+            '%s.%s' % (qual(self.__class__), methodName))
+
+
+    def subscribe(self, topic, methodName):
+        """
+        Have the client-side method named C{methodName} called with the
+        arguments of each L{LivePageFactory.publish} to C{topic} by this
+        widget's page's factory.
+        """
+        self.page.factory.subscribe(topic, self, methodName)
+
+
+    def unsubscribe(self, topic):
+        """
+        Undo L{subscribe}.
+        """
+        self.page.factory.unsubscribe(topic, self)
 
 
     def _athenaDetachServer(self):
@@ -1819,6 +3047,7 @@ class _LiveMixin(_HasJSClass, _HasCSSModule):
         self.fragmentParent.liveFragmentChildren.remove(self)
         self.fragmentParent = None
         page = self.page
+        page.factory.unsubscribeAll(self)
         self.page = None
         page.removeLocalObject(self._athenaID)
         if page._didConnect:
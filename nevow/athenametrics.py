@@ -0,0 +1,237 @@
+# -*- test-case-name: nevow.test.test_athenametrics -*-
+"""
+Counters and histograms describing the Athena pages served by a process, for
+operators.  Each L{nevow.athena.LivePageFactory} keeps an L{AthenaMetrics} as
+its C{metrics}; L{MetricsResource} publishes one as plain text.
+"""
+from bisect import bisect_left
+
+from zope.interface import implements
+
+from nevow import inevow, rend
+
+
+# The upper bounds of the buckets of the histogram of outgoing queue depths.
+DEPTH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# The upper bounds, in seconds, of the buckets of the latency histograms.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30)
+
+
+
+class Histogram(object):
+    """
+    Counts of observed values in buckets, as well as their number and sum.
+
+    @ivar bounds: The upper bounds of the buckets, in increasing order.  A
+        value goes in the first bucket whose bound it does not exceed; larger
+        values are only counted in C{count}.
+    @ivar counts: The number of values in each bucket.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0
+
+
+    def observe(self, value):
+        """
+        Count C{value}.
+        """
+        i = bisect_left(self.bounds, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def snapshot(self):
+        """
+        Return a C{dict} of C{count}, C{sum} and C{buckets}: a C{list} of
+        two-tuples of bucket bounds and the number of values which do not
+        exceed them.
+        """
+        buckets = []
+        total = 0
+        for (bound, count) in zip(self.bounds, self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+
+class AthenaMetrics(object):
+    """
+    Instrumentation of the L{nevow.athena.LivePage}s of one factory, and of
+    their L{nevow.athena.ReliableMessageDelivery}s and transports.
+
+    @ivar clock: The L{IReactorTime} provider which latencies are measured
+        with.
+    @ivar livePages: The number of connected pages.
+    @ivar bytesSerialized: The total size of the baskets of messages
+        serialized for clients.
+    @ivar reconnects: The number of pages rendered for clients reconnecting
+        after losing their pages.
+    @ivar sequenceGaps: The number of baskets refused because messages before
+        them had not been received.
+    @ivar timeouts: A C{dict} mapping kinds of transport timeout
+        (C{'connect'}, C{'transportless'} and C{'idle'}) to the number of
+        times they have happened.
+    @ivar pendingMessages: A L{Histogram} of the number of unacknowledged
+        messages to a client each time one is added.
+    @ivar callRemoteLatency: A C{dict} mapping the names of client methods
+        called with C{callRemote} to L{Histogram}s of the seconds until their
+        results arrived.  Methods of widgets are named by the fully qualified
+        names of the widgets' server-side classes and the method names.
+    @ivar actionCallLatency: A C{dict} mapping the fully qualified names of
+        server methods called by clients to L{Histogram}s of the seconds
+        until their results were ready.
+    """
+    def __init__(self, clock=None):
+        """
+        @param clock: The L{IReactorTime} provider to measure latencies with.
+            If C{None}, the reactor is used.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.livePages = 0
+        self.bytesSerialized = 0
+        self.reconnects = 0
+        self.sequenceGaps = 0
+        self.timeouts = {}
+        self.pendingMessages = Histogram(DEPTH_BUCKETS)
+        self.callRemoteLatency = {}
+        self.actionCallLatency = {}
+
+
+    def timedOut(self, kind):
+        """
+        Count a transport timeout of the kind C{kind}.
+        """
+        self.timeouts[kind] = self.timeouts.get(kind, 0) + 1
+
+
+    def observeLatency(self, latencies, name, started):
+        """
+        Count the time since C{started} in the histogram for C{name} in
+        C{latencies}, either C{callRemoteLatency} or C{actionCallLatency}.
+
+        @param started: A time given by C{clock}.
+        """
+        histogram = latencies.get(name)
+        if histogram is None:
+            histogram = latencies[name] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(self.clock.seconds() - started)
+
+
+    def snapshot(self):
+        """
+        Return the current values of the metrics, as a C{dict} of simple
+        types.  Histograms are given as by L{Histogram.snapshot}.
+        """
+        def latencies(histograms):
+            return dict([(name, histogram.snapshot())
+                         for (name, histogram) in histograms.iteritems()])
+        return {
+            'livePages': self.livePages,
+            'bytesSerialized': self.bytesSerialized,
+            'reconnects': self.reconnects,
+            'sequenceGaps': self.sequenceGaps,
+            'timeouts': dict(self.timeouts),
+            'pendingMessages': self.pendingMessages.snapshot(),
+            'callRemoteLatency': latencies(self.callRemoteLatency),
+            'actionCallLatency': latencies(self.actionCallLatency)}
+
+
+
+def _labels(labels):
+    """
+    Format a C{list} of two-tuples of names and values as the labels of a
+    sample in the Prometheus text format.
+    """
+    if not labels:
+        return ''
+    return '{%s}' % (','.join([
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n').encode('utf-8'))
+        for (name, value) in labels]),)
+
+
+
+def _histogramLines(name, snapshot, labels=()):
+    """
+    Return the lines of the samples of a histogram in the Prometheus text
+    format.
+    """
+    labels = list(labels)
+    lines = []
+    for (bound, count) in snapshot['buckets']:
+        lines.append('%s_bucket%s %d' % (
+            name, _labels(labels + [('le', repr(float(bound)))]), count))
+    lines.append('%s_bucket%s %d' % (
+        name, _labels(labels + [('le', '+Inf')]), snapshot['count']))
+    lines.append('%s_sum%s %r' % (name, _labels(labels), snapshot['sum']))
+    lines.append('%s_count%s %d' % (name, _labels(labels), snapshot['count']))
+    return lines
+
+
+
+def formatMetrics(snapshot):
+    """
+    Format a snapshot from L{AthenaMetrics.snapshot} in the Prometheus text
+    exposition format.
+
+    @rtype: C{str}
+    """
+    lines = [
+        '# TYPE athena_live_pages gauge',
+        'athena_live_pages %d' % (snapshot['livePages'],),
+        '# TYPE athena_serialized_bytes_total counter',
+        'athena_serialized_bytes_total %d' % (snapshot['bytesSerialized'],),
+        '# TYPE athena_reconnects_total counter',
+        'athena_reconnects_total %d' % (snapshot['reconnects'],),
+        '# TYPE athena_sequence_gaps_total counter',
+        'athena_sequence_gaps_total %d' % (snapshot['sequenceGaps'],),
+        '# TYPE athena_timeouts_total counter']
+    for kind in sorted(snapshot['timeouts']):
+        lines.append('athena_timeouts_total%s %d' % (
+            _labels([('type', kind)]), snapshot['timeouts'][kind]))
+    lines.append('# TYPE athena_pending_messages histogram')
+    lines.extend(_histogramLines(
+        'athena_pending_messages', snapshot['pendingMessages']))
+    for (name, key) in [('athena_call_remote_seconds', 'callRemoteLatency'),
+                        ('athena_action_call_seconds', 'actionCallLatency')]:
+        lines.append('# TYPE %s histogram' % (name,))
+        for method in sorted(snapshot[key]):
+            lines.extend(_histogramLines(
+                name, snapshot[key][method], [('method', method)]))
+    return '\n'.join(lines) + '\n'
+
+
+
+class MetricsResource(object):
+    """
+    A resource which renders the current values of an L{AthenaMetrics} as
+    plain text, in the format understood by Prometheus and similar scrapers.
+
+    Nothing puts this in a site; do so behind whatever access control the
+    site's operators need.
+    """
+    implements(inevow.IResource)
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+
+    def locateChild(self, ctx, segments):
+        return rend.NotFound
+
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return formatMetrics(self.metrics.snapshot())
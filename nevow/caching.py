@@ -0,0 +1,473 @@
+# -*- test-case-name: nevow.test.test_caching -*-
+"""
+Caching of complete responses rendered by HTTP resources.
+"""
+import copy
+
+from zope.interface import Interface, implements
+
+from twisted.python import log
+from twisted.internet.defer import maybeDeferred, Deferred
+from twisted.web.http import FOUND, datetimeToString
+from twisted.web.http_headers import Headers
+
+from nevow.inevow import IRequest, IResource
+from nevow.context import PageContext
+from nevow.appserver import errorMarker
+from nevow.rend import NotFound
+from nevow.page import RenderCache
+from nevow.compression import _makeBase
+
+
+
+# Response headers which describe one particular response, and so are never
+# replayed from the cache.
+_UNCACHED_HEADERS = frozenset(['date', 'set-cookie', 'content-length'])
+
+
+class CachedResponse(object):
+    """
+    A response kept by L{CachingResourceWrapper}, which renders itself by
+    replaying the response code, headers and body it was created with.
+
+    @ivar code: The response code.
+    @type code: C{int}
+    @ivar headers: A list of two-tuples of header names and lists of values.
+    @ivar body: The response body.
+    @type body: C{str}
+    @ivar created: The time at which the response was rendered, in seconds.
+    @ivar resource: The resource which rendered the response, and renders it
+        again when it is out of date, or C{None} to render the resource which
+        finds it out of date.
+    @type resource: L{IResource}
+    """
+    implements(IResource)
+
+    def __init__(self, code, headers, body, created, resource=None):
+        self.code = code
+        self.headers = headers
+        self.body = body
+        self.created = created
+        self.resource = resource
+
+
+    def __len__(self):
+        """
+        Return the size of the body, which is what L{RenderCache} limits.
+        """
+        return len(self.body)
+
+
+    # IResource
+    def renderHTTP(self, ctx):
+        """
+        Replay the response onto the request in C{ctx}.
+        """
+        req = IRequest(ctx)
+        req.setResponseCode(self.code)
+        for name, values in self.headers:
+            req.responseHeaders.setRawHeaders(name, values)
+        return self.body
+
+
+    def locateChild(self, ctx, segments):
+        return NotFound
+
+
+
+class _CapturingRequestWrapper(_makeBase()):
+    """
+    A request wrapper which keeps a copy of the response body written to it,
+    and notices anything which makes the response unsuitable for caching.
+
+    @ivar underlying: the request being wrapped.
+    @type underlying: L{IRequest}
+    @ivar written: The strings written to the response body.
+    @ivar cacheable: Whether nothing seen so far prevents caching.
+    """
+    implements(IRequest)
+
+    def __init__(self, underlying):
+        self.underlying = underlying
+        self.written = []
+        self.cacheable = True
+
+
+    def write(self, data):
+        """
+        Keep a copy of C{data} and pass it on.
+        """
+        self.written.append(data)
+        self.underlying.write(data)
+
+
+    def addCookie(self, *a, **kw):
+        """
+        Pass a cookie on.  A response setting a cookie is never cached.
+        """
+        self.cacheable = False
+        return self.underlying.addCookie(*a, **kw)
+
+
+
+class _DetachedRequestWrapper(_makeBase()):
+    """
+    A request wrapper for rendering a response again in the background, which
+    keeps the response to itself instead of sending it: everything about the
+    request is read from the underlying request, which may already have been
+    answered, but the response code, headers and body are kept here.
+
+    @ivar underlying: the request being wrapped.
+    @type underlying: L{IRequest}
+    @ivar code: The response code.
+    @ivar responseHeaders: The response headers.
+    @ivar written: The strings written to the response body.
+    @ivar cacheable: Whether nothing seen so far prevents caching.
+    @ivar deferred: A L{Deferred} which fires with C{''} when the response is
+        finished.
+    """
+    implements(IRequest)
+
+    def __init__(self, underlying):
+        self.underlying = underlying
+        self.code = 200
+        self.responseHeaders = Headers()
+        self.written = []
+        self.cacheable = True
+        self.deferred = Deferred()
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def finish(self):
+        self.deferred.callback('')
+
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+
+    def setLastModified(self, when):
+        self.setHeader('last-modified', datetimeToString(when))
+
+
+    def setETag(self, etag):
+        self.setHeader('etag', '"%s"' % (etag,))
+
+
+    def redirect(self, url):
+        self.setResponseCode(FOUND)
+        self.setHeader('location', url)
+
+
+    def addCookie(self, *a, **kw):
+        """
+        Drop a cookie, which there is nobody to send to.  A response setting a
+        cookie is never cached.
+        """
+        self.cacheable = False
+
+
+    def registerProducer(self, producer, streaming):
+        """
+        Refuse a producer.  Only responses rendered as strings are cached.
+        """
+        self.cacheable = False
+        producer.stopProducing()
+
+
+    def unregisterProducer(self):
+        pass
+
+
+
+class _ICacheKey(Interface):
+    """
+    The parameters of a L{CachingResourceWrapper} and the key it found for a
+    request, remembered in a context so that wrappers below it with the same
+    parameters need not find it again.
+    """
+
+
+
+def _outgoingCookies(request):
+    """
+    Return the number of cookies a L{twisted.web.http.Request} will send, or
+    C{0} for a request which does not keep them in a list.
+    """
+    cookies = getattr(request, 'cookies', None)
+    if isinstance(cookies, list):
+        return len(cookies)
+    return 0
+
+
+
+class CachingResourceWrapper(object):
+    """
+    A resource wrapper which keeps complete successful responses to I{GET}
+    requests and replays them instead of rendering the resource again.
+
+    Responses are keyed on the request path, the values of C{queryArgs} and
+    C{varyHeaders}, and the result of C{keyFunction}.  Children located
+    through the wrapper are wrapped as well and share its cache, and once a
+    response is kept, locating it returns the kept response without
+    consulting the wrapped resources at all.
+
+    Only one render is in progress for a key at a time.  Other requests for
+    the key wait for it and are served its response.  A response which is
+    out of date by no more than C{staleWhileRevalidate} seconds is still
+    served, while it is rendered again in the background for the first
+    request to find it out of date.
+
+    Responses which set a cookie, have a code other than 200, or are
+    marked I{private} or I{no-store} by their Cache-Control header are not
+    kept.
+
+    @ivar underlying: the resource being wrapped.
+    @type underlying: L{IResource}
+    @ivar cache: The L{RenderCache} in which L{CachedResponse}s are kept.
+    @ivar maxAge: The number of seconds for which a response is served.
+    @ivar staleWhileRevalidate: The number of seconds after C{maxAge} for
+        which a response is still served while it is rendered again.
+    @ivar queryArgs: The names of the query arguments which select different
+        responses.  All others are ignored.
+    @ivar varyHeaders: The names of the request headers which select
+        different responses.
+    @ivar keyFunction: C{None}, or a callable taking the request and returning
+        a hashable value which selects different responses, or C{None} to
+        render the request without caching.
+    """
+    implements(IResource)
+
+    def __init__(self, underlying, cache=None, maxAge=60,
+                 staleWhileRevalidate=0, queryArgs=(), varyHeaders=(),
+                 keyFunction=None, clock=None):
+        """
+        @param clock: An L{IReactorTime} provider used to age responses.  If
+            C{None}, the reactor is used.
+        """
+        if cache is None:
+            cache = RenderCache(clock=clock)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.underlying = underlying
+        self.cache = cache
+        self.maxAge = maxAge
+        self.staleWhileRevalidate = staleWhileRevalidate
+        self.queryArgs = tuple(queryArgs)
+        self.varyHeaders = tuple(varyHeaders)
+        self.keyFunction = keyFunction
+        self._clock = clock
+        # Keys with a render in progress, mapped to the Deferreds of requests
+        # waiting for it.
+        self._rendering = {}
+
+
+    def cacheKey(self, req):
+        """
+        Return the key for the response to C{req}, or C{None} if it may not
+        be cached.
+        """
+        if req.method != 'GET':
+            return None
+        key = (req.path,
+               tuple([tuple(req.args.get(name, ()))
+                      for name in self.queryArgs]),
+               tuple([req.getHeader(name) for name in self.varyHeaders]))
+        if self.keyFunction is not None:
+            extra = self.keyFunction(req)
+            if extra is None:
+                return None
+            key += (extra,)
+        return key
+
+
+    def _key(self, ctx):
+        """
+        Return L{cacheKey} for the request in C{ctx}, remembering it there so
+        that it is found only once for each request by this wrapper and the
+        wrappers of its children.
+        """
+        parameters = (type(self), self.queryArgs, self.varyHeaders,
+                      self.keyFunction)
+        try:
+            remembered, key = ctx.locate(_ICacheKey)
+        except KeyError:
+            pass
+        else:
+            if remembered == parameters:
+                return key
+        key = self.cacheKey(IRequest(ctx))
+        ctx.remember((parameters, key), _ICacheKey)
+        return key
+
+
+    def _lookup(self, ctx, key):
+        """
+        Return the kept response for C{key} if it may be served now, or
+        C{None}.  If it is out of date, start rendering it again for the
+        request in C{ctx}, unless that is already being done.
+        """
+        response = self.cache.get(key)
+        if response is not None:
+            if (self._clock.seconds() >= response.created + self.maxAge and
+                    key not in self._rendering):
+                resource = response.resource
+                if resource is None:
+                    resource = self.underlying
+                self._revalidate(ctx, key, resource)
+            return response
+        return None
+
+
+    def _keep(self, key, resource, req, capture, cookies, html):
+        """
+        Keep the response to C{req} for C{key}, if it may be cached.
+
+        @param resource: The resource which rendered the response.
+        @param capture: The request wrapper to which the body was written.
+        @param cookies: The number of cookies C{req} was to send before it was
+            rendered.
+        @param html: The result of rendering.
+
+        @return: The L{CachedResponse} kept, or C{None}.
+        """
+        if not (isinstance(html, str) and capture.cacheable and
+                _outgoingCookies(req) == cookies and
+                getattr(req, 'code', 200) == 200):
+            return None
+        cacheControl = ','.join(
+            req.responseHeaders.getRawHeaders('cache-control', []))
+        if 'private' in cacheControl or 'no-store' in cacheControl:
+            return None
+        headers = [
+            (name, values) for (name, values)
+            in req.responseHeaders.getAllRawHeaders()
+            if name.lower() not in _UNCACHED_HEADERS]
+        response = CachedResponse(
+            200, headers, ''.join(capture.written) + html,
+            self._clock.seconds(), resource)
+        self.cache.set(key, response, self.maxAge + self.staleWhileRevalidate)
+        return response
+
+
+    def _capture(self, ctx, req, key):
+        """
+        Render the underlying resource, keeping its response for C{key} if it
+        may be cached, and serve it to any requests waiting for it.
+        """
+        self._rendering[key] = []
+        capture = _CapturingRequestWrapper(req)
+        ctx.remember(capture, IRequest)
+        cookies = _outgoingCookies(req)
+
+        def cbRendered(html):
+            self._release(key, self._keep(
+                    key, self.underlying, req, capture, cookies, html))
+            return html
+
+        def ebRendered(reason):
+            self._release(key, None)
+            return reason
+
+        return maybeDeferred(self.underlying.renderHTTP, ctx).addCallbacks(
+            cbRendered, ebRendered)
+
+
+    def _revalidate(self, ctx, key, resource):
+        """
+        Render C{resource} again in the background for the request in C{ctx},
+        which is served the out of date response, and keep the new response
+        for C{key}.
+
+        @param resource: The resource which rendered the out of date response.
+            This is not necessarily the underlying resource of this wrapper,
+            which may have found the response while locating a child.
+        """
+        self._rendering[key] = []
+        detached = _DetachedRequestWrapper(IRequest(ctx))
+        detachedContext = PageContext(tag=resource, parent=ctx)
+        detachedContext.remember(detached, IRequest)
+
+        def cbRendered(html):
+            self._release(
+                key, self._keep(key, resource, detached, detached, 0, html))
+
+        def ebRendered(reason):
+            self._release(key, None)
+            log.err(reason, "Rendering %r again failed" % (key,))
+
+        maybeDeferred(resource.renderHTTP, detachedContext).addCallbacks(
+            cbRendered, ebRendered)
+
+
+    def _release(self, key, response):
+        """
+        Serve C{response} to the requests waiting for C{key}, or have them
+        render the resource themselves if it is C{None}.
+        """
+        for waiting in self._rendering.pop(key):
+            waiting.callback(response)
+
+
+    def _wait(self, ctx, key):
+        """
+        Wait for the render in progress for C{key} and serve its response.
+        """
+        def cbRendered(response):
+            if response is None:
+                return self.underlying.renderHTTP(ctx)
+            return response.renderHTTP(ctx)
+        waiting = Deferred()
+        self._rendering[key].append(waiting)
+        return waiting.addCallback(cbRendered)
+
+
+    # IResource
+    def renderHTTP(self, ctx):
+        """
+        Serve a kept response, or render the underlying resource.
+        """
+        key = self._key(ctx)
+        if key is None:
+            return self.underlying.renderHTTP(ctx)
+        response = self._lookup(ctx, key)
+        if response is not None:
+            return response.renderHTTP(ctx)
+        if key in self._rendering:
+            return self._wait(ctx, key)
+        return self._capture(ctx, IRequest(ctx), key)
+
+
+    def locateChild(self, ctx, segments):
+        """
+        Return a kept response for the request, or retrieve wrapped child
+        resources via the underlying resource.
+        """
+        key = self._key(ctx)
+        if key is not None:
+            response = self._lookup(ctx, key)
+            if response is not None:
+                return response, ()
+
+        def _cbWrapChild(result):
+            if result in [NotFound, errorMarker]:
+                return result
+
+            if isinstance(result, tuple):
+                res, segments = result
+                if isinstance(res, Deferred):
+                    return res.addCallback(lambda res: _cbWrapChild((res, segments)))
+                child = copy.copy(self)
+                child.underlying = IResource(res)
+                return child, segments
+
+            raise ValueError('Broken resource; locateChild returned %r' % (result,))
+
+        return maybeDeferred(self.underlying.locateChild, ctx, segments).addCallback(_cbWrapChild)
@@ -9,11 +9,11 @@ from nevow.flat.ten import flatten, precompile, iterflatten, getSerializer, seri
 
 try:
     import twisted
-    def flattenFactory(stan, ctx, writer, finisher):
+    def flattenFactory(stan, ctx, writer, finisher, bufferSize=None):
         from nevow.flat.twist import deferflatten
-        return deferflatten(stan, ctx, writer).addCallback(finisher)
+        return deferflatten(stan, ctx, writer, bufferSize).addCallback(finisher)
 except ImportError:
-    def flattenFactory(stan, ctx, writer, finisher):
+    def flattenFactory(stan, ctx, writer, finisher, bufferSize=None):
         list(iterflatten(stan, ctx, writer))
         return finisher('')
 
@@ -5,6 +5,7 @@
 from twisted.internet import defer
 
 from nevow import flat
+from nevow._flat import _BufferedWriter
 
 
 def _isDeferred(d):
@@ -57,9 +58,41 @@ def _drive(iterable, finished):
         deferred.addCallback(cb).addErrback(eb)
 
 
-def deferflatten(stan, ctx, writer):
+def _flushing(iterable, writer):
+    """
+    Pass on what an iterable returned by L{nevow.flat.iterflatten} produces,
+    flushing a L{_BufferedWriter} before it waits for a Deferred which has not
+    fired, and when it ends.
+    """
+    while True:
+        try:
+            deferred, returner = iterable.next()
+        except:
+            writer.flush()
+            raise
+        if not deferred.called or deferred.paused:
+            writer.flush()
+        yield deferred, returner
+
+
+def deferflatten(stan, ctx, writer, bufferSize=None):
+    """
+    Flatten C{stan} into C{writer}.
+
+    @param bufferSize: If not C{None}, the output is collected and passed to
+        C{writer} in strings of about this many bytes, as by
+        L{nevow._flat.deferflatten}.
+
+    @return: A Deferred which fires when flattening is done.
+    """
     finished = defer.Deferred()
-    iterable = flat.iterflatten(stan, ctx, writer, _isDeferred)
+    if bufferSize is None:
+        iterable = flat.iterflatten(stan, ctx, writer, _isDeferred)
+    else:
+        buffered = _BufferedWriter(writer, bufferSize)
+        iterable = _flushing(
+            flat.iterflatten(stan, ctx, buffered.write, _isDeferred),
+            buffered)
     _drive(iterable, finished)
     return finished
 
@@ -688,3 +688,41 @@ class IAthenaTransportable(Interface):
         @return: A tuple of simple types which will be passed as positional
             arguments to L{jsClass}.
         """
+
+
+
+class IAthenaClientRegistry(Interface):
+    """
+    A record, which several processes may share, of which process owns each
+    connected L{nevow.athena.LivePage}.
+
+    Owners are Twisted client endpoint descriptions (for example,
+    C{"unix:/var/run/app/worker-1.sock"}) of a port on which the owning
+    process serves the same site.  Any method may return a L{Deferred}
+    instead of its result.
+    """
+
+    def register(clientID, owner):
+        """
+        Record that the page with the client ID C{clientID} belongs to
+        C{owner}.
+
+        @type clientID: C{str}
+        @type owner: C{str}
+        """
+
+
+    def unregister(clientID):
+        """
+        Forget the owner of the page with the client ID C{clientID}, if it is
+        known.
+        """
+
+
+    def lookup(clientID):
+        """
+        Return the owner of the page with the client ID C{clientID}, or
+        C{None} if it is not known.
+
+        @rtype: C{str} or C{None}
+        """
@@ -551,6 +551,13 @@ Divmod.Runtime.Platform.namedMethods({
      * @param content: optional; the payload of the HTTP request.  defaults to
      * ''.
      *
+     * @param synchronous: optional; whether to block until the request has
+     * completed.  defaults to false.
+     *
+     * @param progress: optional; a function which is called with the text of
+     * the response received so far each time more of it arrives, before the
+     * request completes.
+     *
      * @return: an array with 2 elements.  The first is an XMLHttpRequest
      * object, whose API is browser-dependent but bears at least a passing
      * resemblance to http://www.w3.org/TR/XMLHttpRequest/.  The second is a
@@ -562,7 +569,7 @@ Divmod.Runtime.Platform.namedMethods({
      * will be a string, the text of the response.
      */
     'getPage': function (self, url, /* optional */ args, action, headers,
-                         content, synchronous) {
+                         content, synchronous, progress) {
         // Fill out defaults.
         if (args === undefined) {
             args = [];
@@ -606,6 +613,19 @@ Divmod.Runtime.Platform.namedMethods({
         // Set up a callback to fire a deferred.
         var d = new Divmod.Defer.Deferred();
         req.onreadystatechange = function() {
+            if (req.readyState == Divmod.Runtime.Platform.XHR_LOADING &&
+                progress !== undefined) {
+                var text = null;
+                try {
+                    text = req.responseText;
+                } catch (err) {
+                    // Some browsers do not make the response available
+                    // until it is complete.
+                }
+                if (text) {
+                    progress(text);
+                }
+            }
             if (req.readyState == Divmod.Runtime.Platform.XHR_DONE) {
                 var result = null;
                 try {
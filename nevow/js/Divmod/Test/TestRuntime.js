@@ -143,6 +143,28 @@ Divmod.Test.TestRuntime.NetworkTests.methods(
         self.assertIdentical(realResult.response, "this is some text");
     },
 
+    /**
+     * getPage should call its 'progress' function with the response received
+     * so far each time more of it arrives.
+     */
+    function test_getPageProgress(self) {
+        var progress = [];
+        var gp = self.platform.getPage('/hello/world', [], 'POST', [], '',
+                                       false, function (text) {
+                                           progress.push(text);
+                                       });
+        self.httpRequest.readyState = Divmod.Runtime.Platform.XHR_LOADING;
+        self.httpRequest.responseText = "some";
+        self.httpRequest.onreadystatechange();
+        self.httpRequest.responseText = "some text";
+        self.httpRequest.onreadystatechange();
+        self.assertArraysEqual(progress, ["some", "some text"]);
+        self.httpRequest._status = 200;
+        self.httpRequest.readyState = Divmod.Runtime.Platform.XHR_DONE;
+        self.httpRequest.onreadystatechange();
+        self.assertIdentical(progress.length, 2);
+    },
+
     /**
      * getPage should translate its 'headers' array into calls to
      * 'setRequestHeader' on the XMLHttpRequest.
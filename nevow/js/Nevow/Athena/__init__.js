@@ -174,6 +174,24 @@ Nevow.Athena.PageWidget.methods(
         }
     },
 
+    /**
+     * Page-level 'notify' action, like 'call' but without a response: invoke
+     * a method on a global object with some given arguments, and log any
+     * error it raises.
+     *
+     * @param functionName: the global identifier of a method to call
+     */
+    function action_notify(self, functionName, funcArgs) {
+        var path = [null];
+        var method = Divmod.namedAny(functionName, path);
+        var target = path.pop();
+        try {
+            method.apply(target, funcArgs);
+        } catch (error) {
+            Divmod.err(error, 'Notification ' + functionName + ' failed.');
+        }
+    },
+
     /**
      * The server has closed the connection.
      */
@@ -238,6 +256,15 @@ Nevow.Athena.PageWidget.methods(
         return self.baseURL() + 'transport';
     },
 
+    /**
+     * Generate a string, the URL of the WebSocket transport endpoint for this
+     * livepage.  This is the same as L{transportURL}, but for the
+     * C{websocket} child and with a I{ws} or I{wss} scheme.
+     */
+    function webSocketURL(self) {
+        return (self.baseURL() + 'websocket').replace(/^http/, 'ws');
+    },
+
     /**
      * Generate a string, the unambiguous URL of the server peer of this page
      * object.
@@ -546,6 +573,15 @@ Nevow.Athena.ReliableMessageDelivery.methods(
                 Divmod.debug("transport",
                              "Sequence gap!  " + self.page.livepageID +
                              " went from " + self.ack + " to " + message[0][0]);
+                var last = message[message.length - 1];
+                if (last[1][0] == 'close') {
+                    /* The server discards the messages before a close
+                     * when it gives up on the page, and sends nothing
+                     * after it.
+                     */
+                    self.ack = last[0];
+                    self.page.action_close.apply(self.page, last[1][1]);
+                }
             }
         }
         self.unpause();
@@ -587,13 +623,16 @@ Nevow.Athena.ReliableMessageDelivery.methods(
         }
 
         var theRequest = self.outputFactory().send(self.ack, outgoingMessages);
-
-        self.requests.push(theRequest);
-        theRequest.deferred.addCallback(function(result) {
+        var basketReceived = function (result) {
             self.failureCount = 0;
             self.acknowledgeMessage(result[0]);
             self.messageReceived(result[1]);
-        });
+        };
+
+        self.requests.push(theRequest);
+        // Streaming requests receive baskets before they complete.
+        theRequest.basketReceived = basketReceived;
+        theRequest.deferred.addCallback(basketReceived);
         theRequest.deferred.addErrback(function(err) {
             self.failureCount += 1;
         });
@@ -686,6 +725,256 @@ Nevow.Athena.HTTPRequestOutput.methods(
         return requestWrapper;
     });
 
+Nevow.Athena.StreamingHTTPRequest = Nevow.Athena.AbortableHTTPRequest.subclass("Nevow.Athena.StreamingHTTPRequest");
+/**
+ * An L{AbortableHTTPRequest} whose response is a series of baskets, one per
+ * line, which are handed to C{basketReceived} as they arrive.  Its deferred
+ * fires with the last basket once the response is complete.
+ *
+ * @ivar basketReceived: A function called with each basket but the last.
+ *
+ * @ivar consumed: The length of the part of the response which has been
+ * parsed.
+ *
+ * @ivar lastAck: The acknowledgement in the last basket handed to
+ * C{basketReceived}.
+ */
+Nevow.Athena.StreamingHTTPRequest.methods(
+    function __init__(self, request, deferred) {
+        Nevow.Athena.StreamingHTTPRequest.upcall(
+            self, '__init__', request, deferred);
+        self.consumed = 0;
+        self.lastAck = -1;
+        self.basketReceived = function (basket) {};
+    },
+
+    /**
+     * Parse the complete lines of C{text} after those already parsed.
+     */
+    function _parseBaskets(self, text) {
+        var end = text.lastIndexOf('\n');
+        if (end < self.consumed) {
+            return [];
+        }
+        var lines = text.substring(self.consumed, end).split('\n');
+        self.consumed = end + 1;
+        var baskets = [];
+        for (var i = 0; i < lines.length; ++i) {
+            if (lines[i].length) {
+                baskets.push(eval('(' + lines[i] + ')'));
+            }
+        }
+        return baskets;
+    },
+
+    function _deliver(self, basket) {
+        self.lastAck = basket[0];
+        self.basketReceived(basket);
+    },
+
+    /**
+     * Hand the baskets which have arrived since this was last called to
+     * C{basketReceived}.
+     *
+     * @param text: The response received so far.
+     */
+    function progress(self, text) {
+        var baskets = self._parseBaskets(text);
+        for (var i = 0; i < baskets.length; ++i) {
+            self._deliver(baskets[i]);
+        }
+    },
+
+    /**
+     * Hand all but the last of the baskets which have arrived since
+     * L{progress} was last called to C{basketReceived}, and return the last,
+     * or an empty basket if there are none.
+     *
+     * @param text: The complete response.
+     */
+    function finish(self, text) {
+        var baskets = self._parseBaskets(text);
+        if (baskets.length == 0) {
+            return [self.lastAck, []];
+        }
+        for (var i = 0; i < baskets.length - 1; ++i) {
+            self._deliver(baskets[i]);
+        }
+        return baskets[baskets.length - 1];
+    });
+
+Nevow.Athena.StreamingHTTPRequestOutput = Nevow.Athena.HTTPRequestOutput.subclass('Nevow.Athena.StreamingHTTPRequestOutput');
+/**
+ * An L{HTTPRequestOutput} which asks for the response to be streamed, and
+ * returns L{StreamingHTTPRequest}s.
+ */
+Nevow.Athena.StreamingHTTPRequestOutput.methods(
+    function send(self, ack, message) {
+        var serialized = Divmod.Base.serializeJSON([ack, message]);
+        var headers = [['X-Athena-Streaming', '1']];
+        if (self.headers !== undefined) {
+            headers = self.headers.concat(headers);
+        }
+        var requestWrapper = null;
+        var response = Divmod.Runtime.theRuntime.getPage(
+            self.baseURL,
+            self.queryArgs,
+            'POST',
+            headers,
+            serialized,
+            self.synchronous,
+            function (text) {
+                requestWrapper.progress(text);
+            });
+        requestWrapper = new Nevow.Athena.StreamingHTTPRequest(
+            response[0], response[1]);
+        requestWrapper.deferred.addCallback(function(result) {
+            if (result.status == 200) {
+                return requestWrapper.finish(result.response);
+            }
+            throw new Error("Request failed: " + result.status);
+        });
+        return requestWrapper;
+    });
+
+Nevow.Athena.WebSocketRequest = Divmod.Class.subclass("Nevow.Athena.WebSocketRequest");
+/**
+ * A basket sent over a L{WebSocketChannel}, waiting for the server to answer.
+ *
+ * Unlike an HTTP request, it cannot be cancelled: the server always answers
+ * it, promptly once it has been superseded by a newer one.  Aborting it only
+ * marks it as aborted.
+ *
+ * @ivar deferred: A Deferred which fires with the basket which answers this
+ * one, or fails if the connection is lost first.
+ */
+Nevow.Athena.WebSocketRequest.methods(
+    function __init__(self) {
+        self.deferred = Divmod.Defer.Deferred();
+        self.aborted = false;
+    },
+
+    function abort(self) {
+        self.aborted = true;
+    });
+
+Nevow.Athena.WebSocketChannel = Divmod.Class.subclass("Nevow.Athena.WebSocketChannel");
+/**
+ * A WebSocket connection to the server-side peer of a page, which can be
+ * used in place of L{HTTPRequestOutput}s by a L{ReliableMessageDelivery}.
+ *
+ * Each basket sent over the connection is answered by exactly one basket
+ * from the server, as if it had been posted to the C{transport} child.
+ * Answers are not necessarily in the order the baskets were sent, but as an
+ * answer is handled the same way whichever basket it answers, each is given
+ * to the oldest unanswered L{WebSocketRequest}.
+ *
+ * @ivar socket: The WebSocket.
+ *
+ * @ivar pending: The L{WebSocketRequest}s which have not been answered,
+ * oldest first.
+ *
+ * @ivar buffered: Serialized baskets sent before the connection was open.
+ *
+ * @ivar closed: Whether the connection has been lost (or could not be
+ * made), in which case this channel may not be used any more.
+ */
+Nevow.Athena.WebSocketChannel.methods(
+    function __init__(self, url, /* optional */ socketFactory) {
+        if (socketFactory === undefined) {
+            socketFactory = function (url) {
+                return new window.WebSocket(url);
+            };
+        }
+        self.pending = [];
+        self.buffered = [];
+        self.opened = false;
+        self.closed = false;
+        self.socket = socketFactory(url);
+        self.socket.onopen = function () {
+            self._connectionMade();
+        };
+        self.socket.onmessage = function (event) {
+            self._messageReceived(event.data);
+        };
+        self.socket.onclose = function () {
+            self._connectionLost();
+        };
+    },
+
+    function _connectionMade(self) {
+        self.opened = true;
+        for (var i = 0; i < self.buffered.length; ++i) {
+            self.socket.send(self.buffered[i]);
+        }
+        self.buffered = [];
+    },
+
+    function _messageReceived(self, data) {
+        var request = self.pending.shift();
+        if (request === undefined) {
+            Divmod.debug("transport", "Unexpected basket over WebSocket");
+            return;
+        }
+        request.deferred.callback(eval('(' + data + ')'));
+    },
+
+    function _connectionLost(self) {
+        self.opened = false;
+        self.closed = true;
+        self.buffered = [];
+        var pending = self.pending;
+        self.pending = [];
+        for (var i = 0; i < pending.length; ++i) {
+            pending[i].deferred.errback(new Error("WebSocket closed"));
+        }
+    },
+
+    /**
+     * Send a basket to the server.
+     *
+     * @return: A L{WebSocketRequest} for the basket.
+     */
+    function send(self, ack, message) {
+        var serialized = Divmod.Base.serializeJSON([ack, message]);
+        var request = Nevow.Athena.WebSocketRequest();
+        self.pending.push(request);
+        if (self.opened) {
+            self.socket.send(serialized);
+        } else {
+            self.buffered.push(serialized);
+        }
+        return request;
+    });
+
+/**
+ * Whether pages should use L{StreamingHTTPRequestOutput}s.
+ */
+Nevow.Athena._useStreamingTransport = false;
+
+/**
+ * Have pages ask for the responses to their HTTP requests to be streamed.
+ * The server calls this during bootstrap if the LivePage's
+ * C{useStreamingTransport} is set.
+ */
+Nevow.Athena.enableStreamingTransport = function () {
+    Nevow.Athena._useStreamingTransport = true;
+};
+
+/**
+ * Whether pages should use a L{WebSocketChannel} where possible.
+ */
+Nevow.Athena._useWebSocketTransport = false;
+
+/**
+ * Have pages exchange messages with the server over a WebSocket where the
+ * browser supports it, rather than with HTTP requests.  The server calls
+ * this during bootstrap if the LivePage's C{useWebSocketTransport} is set.
+ */
+Nevow.Athena.enableWebSocketTransport = function () {
+    Nevow.Athena._useWebSocketTransport = true;
+};
+
 Nevow.Athena.CONNECTED = 'connected';
 Nevow.Athena.DISCONNECTED = 'disconnected';
 
@@ -829,12 +1118,30 @@ Nevow.Athena.KEYCODE_ESCAPE = 27;
  * to manage the connection associated with the page.
  */
 Nevow.Athena._createMessageDelivery = function (page) {
+    var webSocket = null;
     return Nevow.Athena.ReliableMessageDelivery(
         function (synchronous /* = false */) {
             if (synchronous === undefined) {
                 synchronous = false;
             }
-            return Nevow.Athena.HTTPRequestOutput(
+            // Use a WebSocket if enabled and supported, unless the request
+            // must be synchronous.  Once it is lost, fall back to HTTP
+            // requests for good.
+            if (!synchronous && Nevow.Athena._useWebSocketTransport &&
+                window.WebSocket !== undefined) {
+                if (webSocket === null) {
+                    webSocket = Nevow.Athena.WebSocketChannel(
+                        page.webSocketURL());
+                }
+                if (!webSocket.closed) {
+                    return webSocket;
+                }
+            }
+            var outputClass = Nevow.Athena.HTTPRequestOutput;
+            if (!synchronous && Nevow.Athena._useStreamingTransport) {
+                outputClass = Nevow.Athena.StreamingHTTPRequestOutput;
+            }
+            return outputClass(
                 page.transportURL(),
                 [],
                 [['Livepage-Id', page.livepageID],
@@ -148,6 +148,28 @@ Nevow.Test.TestMessageDelivery.ReliableMessageDeliveryTests.methods(
         self.assertIdentical(dupcount, 2);
     },
 
+    /**
+     * A close message is acted on even if it follows a gap in the sequence,
+     * since the server discards the messages before it when it gives up on
+     * a page.
+     */
+    function test_closeAfterGap(self) {
+        var closed = 0;
+        var skipped = 0;
+        self.fakePage.action_close = function () {
+            closed++;
+        };
+        self.fakePage.action_skipped = function () {
+            skipped++;
+        };
+        self.channel.messageReceived([[3, ["skipped", []]]]);
+        self.assertIdentical(skipped, 0);
+        self.assertIdentical(closed, 0);
+        self.channel.messageReceived([[5, ["close", []]]]);
+        self.assertIdentical(closed, 1);
+        self.assertIdentical(self.channel.ack, 5);
+    },
+
     /**
      * When the reliable message delivery channel is closed, it must be done
      * in a few steps:
@@ -228,6 +250,40 @@ Nevow.Test.TestMessageDelivery.GlobalSetupTests.methods(
         self.assertIdentical(testRDM.page, fakePage);
     },
 
+    /**
+     * Once the WebSocket transport is enabled, the output factory of the
+     * message delivery created by _createMessageDelivery returns a single
+     * WebSocketChannel for asynchronous requests, until its connection is
+     * lost.
+     */
+    function test_webSocketMessageDelivery(self) {
+        var sockets = [];
+        var FakeWebSocket = function (url) {
+            this.url = url;
+            sockets.push(this);
+        };
+        self.faker.fake("window", {location: "http://unittest.example.com/",
+                                   WebSocket: FakeWebSocket});
+        self.faker.fake("_useWebSocketTransport", false, Nevow.Athena);
+        Nevow.Athena.enableWebSocketTransport();
+        var fakePage = Nevow.Athena.PageWidget("fake-widget-id",
+                                               Nevow.Athena._createMessageDelivery);
+        var testRDM = fakePage.deliveryChannel;
+        var output = testRDM.outputFactory();
+        self.assert(output instanceof Nevow.Athena.WebSocketChannel);
+        self.assertIdentical(testRDM.outputFactory(), output);
+        self.assertIdentical(sockets.length, 1);
+        self.assertIdentical(sockets[0].url,
+                             "ws://unittest.example.com/fake-widget-id/websocket");
+        self.assert(testRDM.outputFactory(true) instanceof
+                    Nevow.Athena.HTTPRequestOutput);
+
+        sockets[0].onclose();
+        self.assert(testRDM.outputFactory() instanceof
+                    Nevow.Athena.HTTPRequestOutput);
+        self.assertIdentical(sockets.length, 1);
+    },
+
     /**
      * Verify that the HTTPRequestOutput sends the appropriate request via the
      * runtime.
@@ -250,4 +306,183 @@ Nevow.Test.TestMessageDelivery.GlobalSetupTests.methods(
         self.assertIdentical(reqs.length, 1);
         self.assertArraysEqual(reqs[0].opened, ["POST", "http://unittest.example.com/?test=arg", false]);
         self.assertArraysEqual(reqs[0].sent, ['[5, ["hello"]]']);
+    },
+
+    /**
+     * Once the streaming transport is enabled, the output factory of the
+     * message delivery created by _createMessageDelivery returns
+     * StreamingHTTPRequestOutputs for asynchronous requests.
+     */
+    function test_streamingMessageDelivery(self) {
+        self.faker.fake("window", {location: "http://unittest.example.com/"});
+        self.faker.fake("_useStreamingTransport", false, Nevow.Athena);
+        Nevow.Athena.enableStreamingTransport();
+        var fakePage = Nevow.Athena.PageWidget("fake-widget-id",
+                                               Nevow.Athena._createMessageDelivery);
+        var testRDM = fakePage.deliveryChannel;
+        self.assert(testRDM.outputFactory() instanceof
+                    Nevow.Athena.StreamingHTTPRequestOutput);
+        self.assert(!(testRDM.outputFactory(true) instanceof
+                      Nevow.Athena.StreamingHTTPRequestOutput));
+    },
+
+    /**
+     * A StreamingHTTPRequestOutput asks for the response to be streamed, and
+     * hands each complete basket but the last to the request's
+     * basketReceived as it arrives.  The request's deferred fires with the
+     * last basket.
+     */
+    function test_streamingOutputSend(self) {
+        var reqs = [];
+        self.faker.fake("makeHTTPRequest",
+                         function () {
+                             var fr = Divmod.Test.TestRuntime.FakeRequest();
+                             reqs.push(fr);
+                             return fr;
+                         },
+                         Divmod.Runtime.theRuntime);
+        var reqOut = Nevow.Athena.StreamingHTTPRequestOutput(
+            "http://unittest.example.com/", [], [['header', 'value']], false);
+        var request = reqOut.send(5, ["hello"]);
+        self.assertIdentical(reqs.length, 1);
+        self.assertArraysEqual(reqs[0].headers[1],
+                               ['X-Athena-Streaming', '1']);
+
+        var received = [];
+        request.basketReceived = function (basket) {
+            received.push(basket);
+        };
+        var result = null;
+        request.deferred.addCallback(function (basket) {
+            result = basket;
+        });
+
+        var http = reqs[0];
+        http.readyState = Divmod.Runtime.Platform.XHR_LOADING;
+        http.responseText = '[1, [[0, "a"]]]\n[1, [[1, ';
+        http.onreadystatechange();
+        self.assertIdentical(received.length, 1);
+        self.assertIdentical(received[0][0], 1);
+        self.assertIdentical(received[0][1][0][1], "a");
+
+        http.responseText = '[1, [[0, "a"]]]\n[1, [[1, "b"]]]\n[2, []]\n';
+        http._status = 200;
+        http.readyState = Divmod.Runtime.Platform.XHR_DONE;
+        http.onreadystatechange();
+        self.assertIdentical(received.length, 2);
+        self.assertIdentical(received[1][1][0][1], "b");
+        self.assertIdentical(result[0], 2);
+        self.assertIdentical(result[1].length, 0);
+    },
+
+    /**
+     * If a streamed response ends without any basket after those already
+     * received, the request's deferred fires with an empty basket carrying
+     * the last acknowledgement.
+     */
+    function test_streamingOutputEmpty(self) {
+        var http = Divmod.Test.TestRuntime.FakeRequest();
+        self.faker.fake("makeHTTPRequest", function () { return http; },
+                        Divmod.Runtime.theRuntime);
+        var request = Nevow.Athena.StreamingHTTPRequestOutput(
+            "http://unittest.example.com/", [], [], false).send(5, []);
+        var result = null;
+        request.deferred.addCallback(function (basket) {
+            result = basket;
+        });
+        http.readyState = Divmod.Runtime.Platform.XHR_LOADING;
+        http.responseText = '[3, []]\n';
+        http.onreadystatechange();
+        http._status = 200;
+        http.readyState = Divmod.Runtime.Platform.XHR_DONE;
+        http.onreadystatechange();
+        self.assertIdentical(result[0], 3);
+        self.assertIdentical(result[1].length, 0);
+    });
+
+
+
+/**
+ * Tests for L{Nevow.Athena.WebSocketChannel}.
+ */
+Nevow.Test.TestMessageDelivery.WebSocketChannelTests = Divmod.UnitTest.TestCase.subclass(
+    "Nevow.Test.TestMessageDelivery.WebSocketChannelTests");
+
+Nevow.Test.TestMessageDelivery.WebSocketChannelTests.methods(
+    /**
+     * Create a WebSocketChannel with a fake socket which records what is
+     * sent over it.
+     */
+    function setUp(self) {
+        self.sent = [];
+        self.channel = Nevow.Athena.WebSocketChannel(
+            "ws://unittest.example.com/websocket",
+            function (url) {
+                self.url = url;
+                self.socket = {
+                  send: function (data) {
+                        self.sent.push(data);
+                    }
+                };
+                return self.socket;
+            });
+    },
+
+    /**
+     * Baskets sent before the connection is open are sent once it is, and
+     * baskets sent after are sent immediately.
+     */
+    function test_send(self) {
+        self.assertIdentical(self.url, "ws://unittest.example.com/websocket");
+        self.channel.send(-1, []);
+        self.assertArraysEqual(self.sent, []);
+        self.socket.onopen();
+        self.assertArraysEqual(self.sent, ['[-1, []]']);
+        self.channel.send(3, [[0, "hello"]]);
+        self.assertArraysEqual(self.sent,
+                               ['[-1, []]', '[3, [[0, "hello"]]]']);
+    },
+
+    /**
+     * Each basket received from the server answers the oldest request which
+     * has not been answered, including aborted ones.
+     */
+    function test_answers(self) {
+        self.socket.onopen();
+        var first = self.channel.send(-1, []);
+        var second = self.channel.send(-1, [[0, "hello"]]);
+        first.abort();
+        self.assertIdentical(first.aborted, true);
+        var results = [];
+        first.deferred.addCallback(function (result) {
+            results.push(["first", result]);
+        });
+        second.deferred.addCallback(function (result) {
+            results.push(["second", result]);
+        });
+        self.socket.onmessage({data: '[0, []]'});
+        self.assertIdentical(results.length, 1);
+        self.assertIdentical(results[0][0], "first");
+        self.assertIdentical(results[0][1][0], 0);
+        self.assertIdentical(results[0][1][1].length, 0);
+        self.socket.onmessage({data: '[0, [[0, ["noop", []]]]]'});
+        self.assertIdentical(results.length, 2);
+        self.assertIdentical(results[1][0], "second");
+        self.assertIdentical(self.channel.pending.length, 0);
+    },
+
+    /**
+     * When the connection is lost, unanswered requests fail and the channel
+     * is marked as closed.
+     */
+    function test_connectionLost(self) {
+        var request = self.channel.send(-1, []);
+        var failed = false;
+        request.deferred.addErrback(function (err) {
+            failed = true;
+        });
+        self.socket.onclose();
+        self.assertIdentical(failed, true);
+        self.assertIdentical(self.channel.closed, true);
+        self.assertIdentical(self.channel.pending.length, 0);
     });
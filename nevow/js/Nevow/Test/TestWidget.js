@@ -319,6 +319,37 @@ Nevow.Test.TestWidget.PageWidgetTests.methods(
         }, false);
     },
 
+    /**
+     * The 'notify' action should invoke a given global function without
+     * responding, and log any error it raises.
+     */
+    function test_notifyAction(self) {
+        var calls = [];
+        self.tempMethod = function (arg) {
+            calls.push([this, arg]);
+            throw new Error("notification failed");
+        };
+        var errors = [];
+        var removeObserver = Divmod.logger.addObserver(function (event) {
+            if (event.isError) {
+                errors.push(event);
+            }
+        });
+        try {
+            self.page.action_notify(
+                'Nevow.Test.TestWidget.TEMPORARY_GLOBAL.tempMethod',
+                ["test argument"]);
+        } finally {
+            removeObserver();
+        }
+        self.assertIdentical(calls.length, 1);
+        self.assertIdentical(calls[0][0], self);
+        self.assertIdentical(calls[0][1], "test argument");
+        self.assertIdentical(errors.length, 1);
+        self.assertIdentical(errors[0].error.message, "notification failed");
+        self.assertIdentical(self.messages.length, 0);
+    },
+
     /**
      * The 'close' action should stop the reliable message delivery channel.
      */
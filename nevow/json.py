@@ -7,9 +7,20 @@ JavaScript Object Notation.
 
 This is not (nor does it intend to be) a faithful JSON implementation, but it
 is kind of close.
+
+Encoding and decoding are delegated to L{codec}.  When the C accelerator of the
+standard library C{json} module is available, a L{StdlibCodec} is used, which
+falls back to the pure-Python implementation for the values it cannot handle
+itself.  Otherwise a L{PythonCodec} is used.
 """
 
+from __future__ import absolute_import
+
 import re, types
+from collections import deque
+
+from json import decoder as _stdlibDecoder, encoder as _stdlibEncoder
+from json import scanner as _stdlibScanner
 
 from nevow.inevow import IAthenaTransportable
 from nevow import rend, page, _flat, tags
@@ -18,7 +29,7 @@ class ParseError(ValueError):
     pass
 
 whitespace = re.compile(
-            r'('
+            r'(?:'
             r'[\r\n\t\ ]+'
             r'|/\*.*?\*/'
             r'|//[^\n]*[\n]'
@@ -28,39 +39,10 @@ openBrace = re.compile(r'{')
 closeBrace = re.compile(r'}')
 openSquare = re.compile(r'\[')
 closeSquare = re.compile(r'\]')
-
-class StringTokenizer(object):
-    """
-    because r'(?<!\\)"([^"]+|\\")*(?<!\\)"'
-    """
-
-    def match(self, s):
-        if not s.startswith('"'):
-            return None
-
-        bits = []
-
-        SLASH = "\\"
-
-        IT = iter(s)
-        bits = [IT.next()]
-        for char in IT:
-            bits.append(char)
-            if char == SLASH:
-                try:
-                    bits.append(IT.next())
-                except StopIteration:
-                    return None
-            if char == '"':
-                self.matched = ''.join(bits)
-                return self
-
-        return None
-
-    def group(self, num):
-        return self.matched
-
-string = StringTokenizer()
+# A double quote, then any number of characters which are neither a quote nor
+# a backslash, each run optionally followed by a backslash escaping any single
+# character, then a closing double quote.
+string = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
 identifier = re.compile(r'[A-Za-z_][A-Za-z_0-9]*')
 colon = re.compile(r':')
 comma = re.compile(r',')
@@ -68,8 +50,8 @@ true = re.compile(r'true')
 false = re.compile(r'false')
 null = re.compile(r'null')
 undefined = re.compile(r'undefined')
-floatNumber = re.compile(r'-?([1-9][0-9]*|0)(\.[0-9]+)([eE][-+]?[0-9]+)?')
-longNumber = re.compile(r'-?([1-9][0-9]*|0)([eE][-+]?[0-9]+)?')
+floatNumber = re.compile(r'-?(?:[1-9][0-9]*|0)(?:\.[0-9]+)(?:[eE][-+]?[0-9]+)?')
+longNumber = re.compile(r'-?(?:[1-9][0-9]*|0)(?:[eE][-+]?[0-9]+)?')
 
 class StringToken(str):
     pass
@@ -88,43 +70,54 @@ def jsonlong(s):
     return m * 10 ** e
 
 # list of tuples, the first element is a compiled regular expression the second
-# element returns a token and the original string.
+# element returns a token given the matched string.  Earlier entries take
+# precedence over later ones.  None of the expressions may define capturing
+# groups of their own.
 actions = [
-    (whitespace, lambda s: (WhitespaceToken, s)),
-    (openBrace, lambda s: ('{',s)),
-    (closeBrace, lambda s: ('}',s)),
-    (openSquare, lambda s: ('[',s)),
-    (closeSquare, lambda s: (']',s)),
-    (string, lambda s: (StringToken(s), s)),
-    (colon, lambda s: (':', s)),
-    (comma, lambda s: (',', s)),
-    (true, lambda s: (True, s)),
-    (false, lambda s: (False, s)),
-    (null, lambda s: (None, s)),
-    (undefined, lambda s: (None, s)),
-    (identifier, lambda s: (IdentifierToken(s), s)),
-    (floatNumber, lambda s: (float(s), s)),
-    (longNumber, lambda s: (jsonlong(s), s)),
+    (whitespace, lambda s: WhitespaceToken),
+    (openBrace, lambda s: '{'),
+    (closeBrace, lambda s: '}'),
+    (openSquare, lambda s: '['),
+    (closeSquare, lambda s: ']'),
+    (string, lambda s: StringToken(s)),
+    (colon, lambda s: ':'),
+    (comma, lambda s: ','),
+    (true, lambda s: True),
+    (false, lambda s: False),
+    (null, lambda s: None),
+    (undefined, lambda s: None),
+    (identifier, lambda s: IdentifierToken(s)),
+    (floatNumber, lambda s: float(s)),
+    (longNumber, lambda s: jsonlong(s)),
 ]
+
+# All of the expressions in actions joined into a single alternation, each in
+# its own group, so that the input is scanned once, left to right.  The index
+# of the matching group selects the action.
+_tokenExpr = re.compile(
+    '|'.join(['(%s)' % (regexp.pattern,) for (regexp, action) in actions]),
+    re.DOTALL)
+_tokenActions = [None] + [action for (regexp, action) in actions]
+
 def tokenise(s):
     tokens = []
-    while s:
-        for regexp, action in actions:
-            m = regexp.match(s)
-            if m:
-                tok, tokstr = action(m.group(0))
-                break
-        else:
-            raise ValueError, "Invalid Input, %r" % (s[:10],)
-
+    append = tokens.append
+    match = _tokenExpr.match
+    pos = 0
+    end = len(s)
+    while pos < end:
+        m = match(s, pos)
+        if m is None:
+            raise ValueError, "Invalid Input, %r" % (s[pos:pos + 10],)
+        tok = _tokenActions[m.lastindex](m.group())
         if tok is not WhitespaceToken:
-            tokens.append(tok)
-        s = s[len(tokstr):]
+            append(tok)
+        pos = m.end()
 
     return tokens
 
 def accept(want, tokens):
-    t = tokens.pop(0)
+    t = tokens.popleft()
     if want != t:
         raise ParseError, "Unexpected %r, %s expected" % (t , want)
 
@@ -136,13 +129,13 @@ def parseValue(tokens):
         return parseList(tokens)
 
     if tokens[0] in (True, False, None):
-        return tokens.pop(0), tokens
+        return tokens.popleft(), tokens
 
     if type(tokens[0]) == StringToken:
         return parseString(tokens)
 
     if type(tokens[0]) in (int, float, long):
-        return tokens.pop(0), tokens
+        return tokens.popleft(), tokens
 
     raise ParseError, "Unexpected %r" % tokens[0]
 
@@ -178,19 +171,19 @@ def _stringSub(m):
 def parseString(tokens):
     if type(tokens[0]) is not StringToken:
         raise ParseError, "Unexpected %r" % tokens[0]
-    s = _stringExpr.sub(_stringSub, tokens.pop(0)[1:-1].decode('utf-8'))
+    s = _stringExpr.sub(_stringSub, tokens.popleft()[1:-1].decode('utf-8'))
     return s, tokens
 
 
 def parseIdentifier(tokens):
     if type(tokens[0]) is not IdentifierToken:
         raise ParseError("Unexpected %r" % (tokens[0],))
-    return tokens.pop(0), tokens
+    return tokens.popleft(), tokens
 
 
 def parseList(tokens):
     l = []
-    tokens.pop(0)
+    tokens.popleft()
     first = True
     while tokens[0] != ']':
         if not first:
@@ -206,7 +199,7 @@ def parseList(tokens):
 
 def parseObject(tokens):
     o = {}
-    tokens.pop(0)
+    tokens.popleft()
     first = True
     while tokens[0] != '}':
         if not first:
@@ -222,16 +215,6 @@ def parseObject(tokens):
     return o, tokens
 
 
-def parse(s):
-    """
-    Return the object represented by the JSON-encoded string C{s}.
-    """
-    tokens = tokenise(s)
-    value, tokens = parseValue(tokens)
-    if tokens:
-        raise ParseError, "Unexpected %r" % tokens[0]
-    return value
-
 class CycleError(Exception):
     pass
 
@@ -256,62 +239,342 @@ def stringEncode(s):
     return s.translate(_translation).encode('utf-8')
 
 
-def _serialize(obj, w, seen):
+class Serialized(str):
+    """
+    The JSON-encoded form of a value, as returned by L{serialize}, which
+    L{serialize} copies into its output as it is.
+
+    Wrap a value which is part of many messages in this to serialize it only
+    once::
+
+        payload = Serialized(serialize(value))
+    """
+
+
+
+class _Container(object):
+    """
+    A list, tuple, dictionary or transportable which L{_serialize} is part way
+    through.
+
+    @ivar items: An iterator over the elements, or key/value pairs, not yet
+        serialized.
+    @ivar pairs: Whether C{items} produces key/value pairs.
+    @ivar count: The number of elements serialized so far.
+    @ivar closing: The output which ends the container.
+    @ivar ident: The C{id} of the container.
+    """
+    __slots__ = ['items', 'pairs', 'count', 'closing', 'ident']
+
+    def __init__(self, items, pairs, closing, ident):
+        self.items = items
+        self.pairs = pairs
+        self.count = 0
+        self.closing = closing
+        self.ident = ident
+
+
+
+def _serialize(obj, w, seen, serialized=None):
+    """
+    Write the JSON-encoded form of C{obj} to C{w}, a piece at a time.
+
+    Containers are tracked on an explicit stack rather than by recursion, so
+    deeply nested structures do not exhaust the Python stack.
+
+    @param seen: A C{set} of the C{id}s of the containers currently being
+        serialized.  A container which is found inside itself causes
+        L{CycleError} to be raised.
+
+    @param serialized: C{None}, or a C{dict} mapping the C{id}s of values
+        which are not plain data to two-tuples of the value and its
+        JSON-encoded form, which is written instead of serializing it again.
+    """
     from nevow import athena
 
-    if isinstance(obj, types.BooleanType):
-        if obj:
-            w('true')
+    stack = []
+    while True:
+        if type(obj) is Serialized:
+            w(obj)
+        elif isinstance(obj, types.BooleanType):
+            if obj:
+                w('true')
+            else:
+                w('false')
+        elif isinstance(obj, (int, long, float)):
+            w(str(obj))
+        elif isinstance(obj, unicode):
+            w('"')
+            w(stringEncode(obj))
+            w('"')
+        elif isinstance(obj, types.NoneType):
+            w('null')
+        elif id(obj) in seen:
+            raise CycleError(type(obj))
+        elif isinstance(obj, (tuple, list)):
+            w('[')
+            seen.add(id(obj))
+            stack.append(_Container(iter(obj), False, ']', id(obj)))
+        elif isinstance(obj, dict):
+            w('{')
+            seen.add(id(obj))
+            stack.append(_Container(obj.iteritems(), True, '}', id(obj)))
+        elif serialized and id(obj) in serialized:
+            w(serialized[id(obj)][1])
+        elif isinstance(obj, (athena.LiveFragment, athena.LiveElement)):
+            obj = obj._structured()
+            continue
+        elif isinstance(obj, (rend.Fragment, page.Element)):
+            def _w(s):
+                w(stringEncode(s.decode('utf-8')))
+            wrapper = tags.div(xmlns="http://www.w3.org/1999/xhtml")
+            w('"')
+            for _ in _flat.flatten(None, _w, wrapper[obj], False, False):
+                pass
+            w('"')
         else:
-            w('false')
-    elif isinstance(obj, (int, long, float)):
-        w(str(obj))
-    elif isinstance(obj, unicode):
-        w('"')
-        w(stringEncode(obj))
-        w('"')
-    elif isinstance(obj, types.NoneType):
-        w('null')
-    elif id(obj) in seen:
-        raise CycleError(type(obj))
-    elif isinstance(obj, (tuple, list)):
-        w('[')
-        for n, e in enumerate(obj):
-            _serialize(e, w, seen)
-            if n != len(obj) - 1:
-                w(',')
-        w(']')
-    elif isinstance(obj, dict):
-        w('{')
-        for n, (k, v) in enumerate(obj.iteritems()):
-            _serialize(k, w, seen)
-            w(':')
-            _serialize(v, w, seen)
-            if n != len(obj) - 1:
-                w(',')
-        w('}')
-    elif isinstance(obj, (athena.LiveFragment, athena.LiveElement)):
-        _serialize(obj._structured(), w, seen)
-    elif isinstance(obj, (rend.Fragment, page.Element)):
-        def _w(s):
-            w(stringEncode(s.decode('utf-8')))
-        wrapper = tags.div(xmlns="http://www.w3.org/1999/xhtml")
-        w('"')
-        for _ in _flat.flatten(None, _w, wrapper[obj], False, False):
-            pass
-        w('"')
-    else:
-        transportable = IAthenaTransportable(obj, None)
-        if transportable is not None:
-            w('(new ' + transportable.jsClass.encode('ascii') + '(')
-            arguments = transportable.getInitialArguments()
-            for n, e in enumerate(arguments):
-                _serialize(e, w, seen)
-                if n != len(arguments) - 1:
+            transportable = IAthenaTransportable(obj, None)
+            if transportable is not None:
+                w('(new ' + transportable.jsClass.encode('ascii') + '(')
+                seen.add(id(obj))
+                stack.append(_Container(
+                    iter(transportable.getInitialArguments()), False, '))',
+                    id(obj)))
+            else:
+                raise TypeError("Unsupported type %r: %r" % (type(obj), obj))
+
+        # Find the next value to serialize, closing any containers which
+        # have been exhausted.
+        while stack:
+            container = stack[-1]
+            for obj in container.items:
+                if container.count:
                     w(',')
-            w('))')
+                container.count += 1
+                if container.pairs:
+                    key, value = obj
+                    _serialize(key, w, seen)
+                    w(':')
+                    obj = value
+                break
+            else:
+                w(container.closing)
+                seen.discard(container.ident)
+                stack.pop()
+                continue
+            break
         else:
-            raise TypeError("Unsupported type %r: %r" % (type(obj), obj))
+            return
+
+
+
+# The size, in bytes, of the pieces of output passed to the write function
+# given to serializeTo.
+CHUNK_SIZE = 2 ** 16
+
+
+
+class PythonCodec(object):
+    """
+    Pure-Python JSON codec.
+
+    This supports every Nevow-specific value: L{IAthenaTransportable}
+    providers, live fragments and elements, ordinary fragments and elements,
+    and C{undefined} and comments in parsed input.
+    """
+
+    def parse(self, s):
+        """
+        Return the object represented by the JSON-encoded string C{s}.
+        """
+        tokens = deque(tokenise(s))
+        value, tokens = parseValue(tokens)
+        if tokens:
+            raise ParseError, "Unexpected %r" % tokens[0]
+        return value
+
+
+    def serialize(self, obj):
+        """
+        Return the JSON-encoded form of C{obj} as a UTF-8 encoded C{str}.
+        """
+        L = []
+        _serialize(obj, L.append, set())
+        return ''.join(L)
+
+
+    def serializeTo(self, obj, write, chunkSize=CHUNK_SIZE):
+        """
+        Write the JSON-encoded form of C{obj} to C{write} as it is produced,
+        in UTF-8 encoded C{str} chunks of about C{chunkSize} bytes.
+
+        @param write: A one-argument callable, such as the C{write} method of
+            a file or of a request.
+        """
+        writer = _flat._BufferedWriter(write, chunkSize)
+        _serialize(obj, writer.write, set())
+        writer.flush()
+
+
+
+class _Verbatim(unicode):
+    """
+    Already-encoded output which L{StdlibCodec} passes through unchanged.
+    """
+
+
+
+def _encodeString(s):
+    """
+    Encode a string for the standard library encoder the same way
+    L{_serialize} does.
+    """
+    if type(s) is _Verbatim:
+        return s
+    if type(s) is Serialized:
+        return s.decode('utf-8')
+    if not isinstance(s, unicode):
+        raise TypeError("Unsupported type %r: %r" % (type(s), s))
+    return u'"' + s.translate(_translation) + u'"'
+
+
+
+def _hasIncompatibleValues(obj):
+    """
+    Determine whether C{obj} contains a value which the standard library
+    encoder would encode differently than L{_serialize}.
+
+    Floats are formatted with C{repr} rather than C{str} by the standard
+    library and dictionary keys which are not unicode are coerced to strings,
+    so these are incompatible.  Values which are not plain data are not
+    descended into; they are handed back to L{PythonCodec} individually.
+    """
+    seen = set()
+    stack = [obj]
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+        obj = pop()
+        if isinstance(obj, float):
+            return True
+        elif isinstance(obj, (list, tuple)):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                extend(obj)
+        elif isinstance(obj, dict):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                for k in obj:
+                    if not isinstance(k, unicode):
+                        return True
+                extend(obj.itervalues())
+    return False
+
+
+
+def _parseNumber(s):
+    """
+    Convert a number with a fraction or an exponent the same way
+    L{tokenise} does.
+    """
+    if '.' in s:
+        return float(s)
+    return jsonlong(s)
+
+
+
+def _rejectConstant(s):
+    """
+    Refuse C{NaN}, C{Infinity} and C{-Infinity}, which L{parseValue} does not
+    accept either.
+    """
+    raise ValueError("Unsupported constant %r" % (s,))
+
+
+
+# Escape sequences which the standard library decoder accepts but decodes
+# differently than L{parseString}: an escaped solidus, which is left alone,
+# and escaped surrogates, which are not combined into a single code point.
+_stdlibIncompatibleEscapes = re.compile(r'\\(?:/|u[dD][89abAB])')
+
+
+
+class StdlibCodec(PythonCodec):
+    """
+    JSON codec which uses the C accelerator of the standard library C{json}
+    module for plain data.
+
+    Output is byte-for-byte identical to that of L{PythonCodec}.  Nevow-specific
+    values are serialized by L{PythonCodec} and spliced into the output.
+    Structures containing floats, or dictionaries with keys which are not
+    unicode, and input which uses Nevow extensions such as C{undefined},
+    comments or C{\\x} escapes are handled entirely by L{PythonCodec}.
+
+    L{serializeTo} is inherited from L{PythonCodec}, since the C encoder
+    cannot produce its output incrementally.
+    """
+
+    def __init__(self):
+        self._decoder = _stdlibDecoder.JSONDecoder(
+            parse_float=_parseNumber,
+            parse_int=long,
+            parse_constant=_rejectConstant,
+            strict=False)
+
+
+    def parse(self, s):
+        """
+        Return the object represented by the JSON-encoded string C{s}.
+        """
+        if _stdlibIncompatibleEscapes.search(s) is None:
+            try:
+                return self._decoder.decode(s)
+            except ValueError:
+                pass
+        return PythonCodec.parse(self, s)
+
+
+    def serialize(self, obj):
+        """
+        Return the JSON-encoded form of C{obj} as a UTF-8 encoded C{str}.
+        """
+        if _hasIncompatibleValues(obj):
+            return PythonCodec.serialize(self, obj)
+        serialized = {}
+        def default(value):
+            result = PythonCodec.serialize(self, value)
+            serialized[id(value)] = (value, result)
+            return _Verbatim(result.decode('utf-8'))
+        encode = _stdlibEncoder.c_make_encoder(
+            {}, default, _encodeString, None, ':', ',',
+            False, False, True)
+        try:
+            chunks = encode(obj, 0)
+        except (ValueError, RuntimeError):
+            # A circular reference, which the pure-Python serializer reports
+            # as a CycleError, or nesting too deep for the C encoder, which
+            # the pure-Python serializer does not mind.  Fragments and
+            # transportables serialized already are not rendered again.
+            L = []
+            _serialize(obj, L.append, set(), serialized)
+            return ''.join(L)
+        return u''.join(chunks).encode('utf-8')
+
+
+
+if (_stdlibEncoder.c_make_encoder is not None and
+    _stdlibScanner.c_make_scanner is not None):
+    codec = StdlibCodec()
+else:
+    codec = PythonCodec()
+
+
+
+def parse(s):
+    """
+    Return the object represented by the JSON-encoded string C{s}.
+    """
+    return codec.parse(s)
 
 
 
@@ -326,8 +589,26 @@ def serialize(obj=_undefined, **kw):
     """
     if obj is _undefined:
         obj = kw
-    L = []
-    _serialize(obj, L.append, {})
-    return ''.join(L)
+    return codec.serialize(obj)
+
+
+
+def serializeTo(obj, write, chunkSize=CHUNK_SIZE):
+    """
+    JSON-encode an object, passing the output to C{write} in chunks as it is
+    produced rather than returning it.
+
+    @param obj: Anything which L{serialize} accepts.
+
+    @param write: A one-argument callable, such as the C{write} method of a
+        file or of a request, which will be called with UTF-8 encoded C{str}
+        chunks of about C{chunkSize} bytes.
+
+    This is for applications writing large values where peak memory matters
+    more than speed: it always uses the pure-Python serializer.  Athena does
+    not use it for its baskets of messages, which L{serialize} encodes faster
+    with the C accelerator, and which a WebSocket message needs whole anyway.
+    """
+    codec.serializeTo(obj, write, chunkSize)
 
-__all__ = ['parse', 'serialize']
+__all__ = ['parse', 'serialize', 'serializeTo']
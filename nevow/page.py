@@ -6,17 +6,22 @@ Basic rendering classes for Nevow applications.
 API Stability: Completely unstable.
 """
 
+from collections import OrderedDict
+
 from zope.interface import implements
 
+from twisted.python import context
+
 from nevow.inevow import IRequest, IRenderable, IRendererFactory
 from nevow.errors import MissingRenderMethod, MissingDocumentFactory
 
 from nevow.util import Expose
-from nevow.rend import _getPreprocessors
+from nevow.stan import xml
+from nevow.rend import _getPreprocessors, _unboundFunction
 
 from nevow.flat.ten import registerFlattener
 from nevow._flat import FlattenerError, _OldRendererFactory, _ctxForRequest
-from nevow._flat import deferflatten
+from nevow._flat import deferflatten, _compiledDocument, _schedule
 
 
 renderer = Expose(
@@ -42,6 +47,21 @@ renderer = Expose(
 
 
 
+def _exposedFunction(cls, name):
+    """
+    Find the function which C{nevow.page.renderer} exposes as C{name} on
+    instances of C{cls}.
+
+    @return: The function, or C{None} if the class attribute C{name} is not
+        an exposed method.
+    """
+    function = _unboundFunction(cls, name)
+    if renderer in getattr(function, 'exposedThrough', ()):
+        return function
+    return None
+
+
+
 class Element(object):
     """
     Base for classes which can render part of a page.
@@ -77,6 +97,10 @@ class Element(object):
     docFactory = None
     preprocessors = ()
 
+    # The class which owns the table of exposed render functions, and the
+    # table itself.  Subclasses replace it with their own on first use.
+    _rendererDispatch = (None, None)
+
     def __init__(self, docFactory=None):
         if docFactory is not None:
             self.docFactory = docFactory
@@ -85,11 +109,27 @@ class Element(object):
     def renderer(self, name):
         """
         Get the named render method using C{nevow.page.renderer}.
+
+        The function found for C{name} is remembered in a table kept on the
+        class of this element (and not inherited by its subclasses), so
+        repeated lookups of the same name cost a dictionary hit and an
+        attribute lookup, which finds out whether the class has changed
+        since.
         """
-        method = renderer.get(self, name, None)
-        if method is None:
-            raise MissingRenderMethod(self, name)
-        return method
+        cls = type(self)
+        owner, table = self._rendererDispatch
+        if owner is not cls:
+            owner, table = cls._rendererDispatch = (cls, {})
+        function = table.get(name)
+        if function is None or getattr(
+            getattr(cls, name, None), 'im_func', None) is not function:
+            function = table[name] = _exposedFunction(cls, name)
+        if function is None or name in self.__dict__:
+            method = renderer.get(self, name, None)
+            if method is None:
+                raise MissingRenderMethod(self, name)
+            return method
+        return function.__get__(self, cls)
 
 
     def render(self, request):
@@ -104,7 +144,8 @@ class Element(object):
         docFactory = self.docFactory
         if docFactory is None:
             raise MissingDocumentFactory(self)
-        return docFactory.load(None, _getPreprocessors(self))
+        return _compiledDocument(
+            docFactory, docFactory.load(None, _getPreprocessors(self)))
 
 
     def rend(self, context, data):
@@ -121,6 +162,206 @@ class Element(object):
 
 
 
+# The context key under which the captures of all RenderCacheMixin renders in
+# progress are found.
+_CAPTURES = object()
+
+class _Capture(object):
+    """
+    The output of a L{RenderCacheMixin} being rendered, and whether it may be
+    cached.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.cacheable = True
+
+
+
+def preventCaching():
+    """
+    Prevent the output of every L{RenderCacheMixin} currently being rendered
+    from being cached.
+
+    Call this while rendering something which has side-effects each time it
+    is rendered, so that output containing it cannot be replayed from a
+    cache.  Athena widgets do this, because each of them must be added to its
+    page when it is rendered.
+    """
+    for capture in context.get(_CAPTURES, ()):
+        capture.cacheable = False
+
+
+
+class RenderCache(object):
+    """
+    A bounded, least-recently-used cache of flattened output, for use by
+    L{RenderCacheMixin}.
+
+    @ivar maxSize: The most bytes of output which will be kept.  Output larger
+        than this is never kept.
+
+    @ivar size: The number of bytes of output currently kept.
+    """
+    def __init__(self, maxSize=2 ** 22, clock=None):
+        """
+        @param clock: An L{IReactorTime} provider used to expire entries.  If
+            C{None}, the reactor is used.
+        """
+        self.maxSize = maxSize
+        self.size = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+
+
+    def _seconds(self):
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock.seconds()
+
+
+    def get(self, key):
+        """
+        Return the output kept for C{key}, or C{None} if there is none or it
+        has expired.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        data, expires = entry
+        if expires is not None and expires <= self._seconds():
+            self.size -= len(data)
+            return None
+        self._entries[key] = entry
+        return data
+
+
+    def set(self, key, data, ttl=None):
+        """
+        Keep C{data} as the output for C{key}, discarding the least recently
+        used output to stay within C{maxSize}.
+
+        @type data: C{str}
+
+        @param ttl: The number of seconds after which C{data} expires, or
+            C{None} if it does not.
+        """
+        self.invalidate(key)
+        if len(data) > self.maxSize:
+            return
+        expires = None
+        if ttl is not None:
+            expires = self._seconds() + ttl
+        self._entries[key] = (data, expires)
+        self.size += len(data)
+        while self.size > self.maxSize:
+            key, (data, expires) = self._entries.popitem(last=False)
+            self.size -= len(data)
+
+
+    def invalidate(self, key):
+        """
+        Discard the output kept for C{key}, if there is any.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+    def clear(self):
+        """
+        Discard all kept output.
+        """
+        self._entries.clear()
+        self.size = 0
+
+
+
+class _Uncached(object):
+    """
+    The L{IRenderable} a L{RenderCacheMixin} is flattened as, to produce the
+    output it will cache.
+    """
+    implements(IRenderable)
+
+    def __init__(self, renderable):
+        self.renderable = renderable
+
+
+    def render(self, request):
+        return super(RenderCacheMixin, self.renderable).render(request)
+
+
+    def renderer(self, name):
+        return self.renderable.renderer(name)
+
+
+
+class RenderCacheMixin(object):
+    """
+    Mix in before L{Element} to keep the flattened output of an element in a
+    L{RenderCache} and reuse it in place of rendering the element again::
+
+        class Footer(RenderCacheMixin, Element):
+            cacheTTL = 60
+            def cacheKey(self, request):
+                return ('footer', self.siteName)
+
+    Output is only cached if nothing rendered as part of it calls
+    L{preventCaching}, so a subtree containing Athena widgets is rendered
+    every time.  Output is always flattened as XML text, so elements using
+    this mixin must not be placed in attribute values.  As for any
+    L{Element}, slots inside the element are only filled by tags inside it,
+    never by an enclosing tag, so cached output does not depend on where the
+    element is placed.
+
+    @ivar renderCache: The L{RenderCache} in which output is kept.  Every
+        class using this mixin shares one unless this is overridden.
+
+    @ivar cacheTTL: The number of seconds for which output is kept, or
+        C{None} to keep it until it is evicted or invalidated.
+    """
+    renderCache = RenderCache()
+    cacheTTL = None
+
+    def cacheKey(self, request):
+        """
+        Return a hashable key identifying the output this element will render
+        for C{request} among everything kept in C{renderCache}, or C{None} to
+        render it without caching.  The default never caches.
+        """
+        return None
+
+
+    def render(self, request):
+        """
+        Return the cached output for C{self.cacheKey(request)} if there is
+        any, otherwise flatten and cache this element's document.
+        """
+        key = self.cacheKey(request)
+        if key is None:
+            return super(RenderCacheMixin, self).render(request)
+        cache = self.renderCache
+        data = cache.get(key)
+        if data is not None:
+            return xml(data)
+
+        capture = _Capture()
+        ctx = {_CAPTURES: context.get(_CAPTURES, ()) + (capture,)}
+        def schedule(f, *a):
+            _schedule(context.call, ctx, f, *a)
+        finished = context.call(
+            ctx, deferflatten, request, _Uncached(self), False, True,
+            capture.chunks.append, schedule=schedule)
+        def cbFlattened(ignored):
+            data = ''.join(capture.chunks)
+            if capture.cacheable:
+                cache.set(key, data, self.cacheTTL)
+            return xml(data)
+        return finished.addCallback(cbFlattened)
+
+
+
 def _flattenElement(element, ctx):
     """
     Use the new flattener implementation to flatten the given L{IRenderable} in
@@ -158,5 +399,7 @@ __all__ = [
 
     'Element',
 
+    'RenderCache', 'RenderCacheMixin', 'preventCaching',
+
     'renderer', 'deferflatten',
     ]
@@ -53,20 +53,70 @@ def _getPreprocessors(inst):
 
 
 
+def _parseRendererName(name):
+    """
+    Split a render directive into the name of its renderer and its arguments.
+
+    The named renderer can be parameterised, i.e. 'renderIt one,two,three'.
+
+    @return: A two-tuple of the renderer name and a list of arguments.
+    """
+    args = []
+    if name.find(' ') != -1:
+        name, args = name.split(None, 1)
+        args = [arg.strip() for arg in args.split(',')]
+    return name, args
+
+
+
+def _unboundFunction(cls, name):
+    """
+    Find the function which is bound to instances of C{cls} as the method
+    C{name}.
+
+    @return: The function, or C{None} if the class attribute C{name} is not a
+        plain method (for example if it is missing, or is a class method).
+    """
+    method = getattr(cls, name, None)
+    if getattr(method, 'im_self', True) is None:
+        return method.im_func
+    return None
+
+
+
 class RenderFactory(object):
     implements(inevow.IRendererFactory)
 
+    # The class which owns the table of parsed render directives, and the
+    # table itself.  Subclasses replace it with their own on first use.
+    _rendererDispatch = (None, None)
+
     def renderer(self, context, name):
         """Return a renderer with the given name.
-        """
-
-        # The named renderer can be parameterised, i.e. 'renderIt one,two,three'
-        args = []
-        if name.find(' ') != -1:
-            name, args = name.split(None, 1)
-            args = [arg.strip() for arg in args.split(',')]
 
-        callable = getattr(self, 'render_%s' % name, None)
+        Each parsed directive is remembered in a table kept on the class of
+        this object (and not inherited by its subclasses), so repeated
+        lookups of the same name cost a dictionary hit and an attribute
+        lookup, which finds the current render method even if it was
+        assigned to the class after the table was made.
+        """
+        cls = type(self)
+        owner, table = self._rendererDispatch
+        if owner is not cls:
+            owner, table = cls._rendererDispatch = (cls, {})
+        try:
+            name, attribute, args = table[name]
+        except KeyError:
+            directive = name
+            name, args = _parseRendererName(directive)
+            attribute = 'render_%s' % name
+            table[directive] = name, attribute, args
+        function = _unboundFunction(cls, attribute)
+
+        if function is None or attribute in self.__dict__:
+            callable = getattr(self, attribute, None)
+        else:
+            callable = function.__get__(self, cls)
         if callable is None:
             warnings.warn(
                 "Renderer %r missing on %s will result in an exception." % (
@@ -521,11 +571,19 @@ class Page(Fragment, ConfigurableFactory, ChildLookupMixin):
 
     buffered = False
 
+    # The size of the strings in which the page is written to the request, or
+    # None to write each piece as soon as it is flattened.  Whatever has been
+    # flattened is written before waiting for a Deferred, whatever the size.
+    # Setting it passes a bufferSize keyword argument to flattenFactory, so
+    # a page which overrides flattenFactory must accept one; nevow._flat's
+    # BUFFER_SIZE is a good value.
+    writeBufferSize = None
+
     beforeRender = None
     afterRender = None
     addSlash = None
 
-    flattenFactory = lambda self, *args: flat.flattenFactory(*args)
+    flattenFactory = lambda self, *args, **kw: flat.flattenFactory(*args, **kw)
 
     def renderHTTP(self, ctx):
         if self.beforeRender is not None:
@@ -566,7 +624,10 @@ class Page(Fragment, ConfigurableFactory, ChildLookupMixin):
         doc = self.docFactory.load(ctx, preprocessors)
         ctx =  WovenContext(ctx, tags.invisible[doc])
 
-        return self.flattenFactory(doc, ctx, writer, finisher)
+        if self.buffered or self.writeBufferSize is None:
+            return self.flattenFactory(doc, ctx, writer, finisher)
+        return self.flattenFactory(doc, ctx, writer, finisher,
+                                   bufferSize=self.writeBufferSize)
 
     def rememberStuff(self, ctx):
         Fragment.rememberStuff(self, ctx)
@@ -6,14 +6,23 @@
 """
 
 # System Imports
-import os, string, time
+import os, stat, string, time, errno
 import cStringIO
-import traceback
 import warnings
+from collections import OrderedDict, deque
 StringIO = cStringIO
 del cStringIO
 from zope.interface import implements
 
+try:
+    _sendfile = os.sendfile
+except AttributeError:
+    try:
+        # The pysendfile package.
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = None
+
 try:
     from twisted.web.resource import NoResource, ForbiddenResource
 except ImportError:
@@ -25,12 +34,15 @@ try:
 except ImportError:
     from twisted.protocols import http
 from twisted.python import threadable, log, components, filepath
-from twisted.internet import abstract
+from twisted.internet import abstract, defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.internet.interfaces import IPushProducer, IPullProducer
 from twisted.spread import pb
 from twisted.python.util import InsensitiveDict
 from twisted.python.runtime import platformType
 
 from nevow import appserver, dirlist, inevow, rend
+from nevow.compression import parseAcceptEncoding, CompressingRequestWrapper
 
 
 dangerousPathError = NoResource("Invalid request URL.")
@@ -85,15 +97,302 @@ def addSlash(request):
         request.getHeader("host"),
         (string.split(request.uri,'?')[0]))
 
+class _CachedFile(object):
+    """
+    The contents of a file kept by a L{FileCache}, and what is needed to serve
+    them.
+
+    @ivar signature: The modification time, size and inode number of the
+        file when it was read, to tell whether it has changed since.
+    @ivar checked: When the file was last found unchanged.
+    @ivar etag: The entity tag of the file when it was last found unchanged.
+    """
+    def __init__(self, data, type, encoding, st, checked):
+        self.data = data
+        self.type = type
+        self.encoding = encoding
+        self.signature = _signature(st)
+        self.lastModified = st.st_mtime
+        self.unchanged(checked)
+
+
+    def unchanged(self, now):
+        """
+        Record that the file was found unchanged at C{now}, computing its
+        entity tag again so that a weak one becomes strong once the file is
+        old enough, as it would if the file were not cached.
+        """
+        mtime, size, inode = self.signature
+        self.etag = _entityTag(inode, size, mtime, now)
+        self.checked = now
+
+
+
+def _entityTag(inode, size, mtime, now):
+    """
+    Return the entity tag of a file with the given inode number, size and
+    modification time, at the time C{now}.
+
+    Modification times are only compared to the second, so the tag of a file
+    modified within the last second is weak: the file could change again
+    without changing its tag.
+    """
+    tag = '"%x-%x-%x"' % (inode, size, int(mtime))
+    if now - mtime < 1:
+        return 'W/' + tag
+    return tag
+
+
+
+def _matchesEntityTag(header, etag, weak):
+    """
+    Return whether the value of an If-None-Match or If-Range header matches
+    the entity tag C{etag}.  If C{weak} is false, weak tags never match.
+    """
+    if not weak and etag.startswith('W/'):
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if weak:
+            if candidate.startswith('W/'):
+                candidate = candidate[2:]
+            if candidate == etag.replace('W/', '', 1):
+                return True
+        elif candidate == etag:
+            return True
+    return False
+
+
+
+def _notModified(request, etag, lastModified):
+    """
+    Set the entity tag and modification time of the response to C{request},
+    and evaluate its If-None-Match and If-Modified-Since conditions.
+
+    @return: Whether the response code has been set to Not Modified or
+        Precondition Failed, and no body should be sent.
+    """
+    request.setHeader('etag', etag)
+    tags = request.getHeader('if-none-match')
+    if tags is None:
+        return request.setLastModified(lastModified) is http.CACHED
+    # If-Modified-Since is ignored in favour of If-None-Match.
+    request.setHeader('last-modified', http.datetimeToString(lastModified))
+    if _matchesEntityTag(tags, etag, True):
+        if request.method in ('GET', 'HEAD'):
+            request.setResponseCode(http.NOT_MODIFIED)
+        else:
+            request.setResponseCode(http.PRECONDITION_FAILED)
+        return True
+    return False
+
+
+
+def _rangeApplies(request, etag, lastModified):
+    """
+    Return whether the Range header of C{request} should be honoured: whether
+    there is no If-Range header or it matches the file.
+    """
+    condition = request.getHeader('if-range')
+    if condition is None:
+        return True
+    condition = condition.strip()
+    if condition.startswith('"') or condition.startswith('W/'):
+        return _matchesEntityTag(condition, etag, False)
+    try:
+        return http.stringToDatetime(condition) == int(lastModified)
+    except ValueError:
+        return False
+
+
+
+def parseRange(header, size):
+    """
+    Parse the value of a Range header for an entity of C{size} bytes.
+
+    @return: C{None} if the header is not a valid byte range set, and should
+        be ignored, or otherwise a C{list} of the satisfiable ranges in it, as
+        two-tuples of their first and last byte positions, in order, with
+        overlapping and adjacent ranges merged.
+    """
+    unit, sep, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    ranges = []
+    valid = False
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        start, sep, end = spec.partition('-')
+        start, end = start.strip(), end.strip()
+        if not sep or not (start or end):
+            return None
+        if (start and not start.isdigit()) or (end and not end.isdigit()):
+            return None
+        valid = True
+        if start:
+            start = int(start)
+            if end:
+                end = int(end)
+                if end < start:
+                    return None
+            else:
+                end = size - 1
+        else:
+            # A suffix of the entity.
+            start = max(size - int(end), 0)
+            end = size - 1
+        if start < size and start <= end:
+            ranges.append((start, min(end, size - 1)))
+    if not valid:
+        return None
+    ranges.sort()
+    merged = []
+    for (start, end) in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+
+def _signature(st):
+    """
+    Return what is compared to tell whether a file has changed, from the
+    result of C{os.stat} for it.
+    """
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+
+class FileCache(object):
+    """
+    A cache of the contents of small files, so that L{File} can serve them
+    without opening and reading them for every request.  Files are kept until
+    they change, or until room is needed for more recently used ones.
+
+    Give one to the L{Registry} of some L{File}s to have them use it.
+
+    @ivar maxBytes: The largest total size of the files to keep.
+    @ivar maxFileSize: The size of the largest file to keep.
+    @ivar revalidateInterval: The number of seconds for which a file is served
+        from the cache without checking whether it has changed.
+    @ivar size: The total size of the files kept.
+    """
+    def __init__(self, maxBytes=2 ** 24, maxFileSize=2 ** 18,
+                 revalidateInterval=1.0):
+        self.maxBytes = maxBytes
+        self.maxFileSize = maxFileSize
+        self.revalidateInterval = revalidateInterval
+        self.size = 0
+        # Paths mapped to _CachedFiles, least recently used first.
+        self._entries = OrderedDict()
+
+
+    def time(self):
+        """
+        Return the current time as a float.
+
+        The default implementation simply uses L{time.time}.  This is mainly
+        provided as a hook for tests to override.
+        """
+        return time.time()
+
+
+    def get(self, path):
+        """
+        Return the cached contents of the file at C{path}, unless they are not
+        cached or the file has changed.
+
+        @rtype: L{_CachedFile} or C{None}
+        """
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return None
+        now = self.time()
+        if now - entry.checked >= self.revalidateInterval:
+            try:
+                signature = _signature(os.stat(path))
+            except OSError:
+                signature = None
+            if signature != entry.signature:
+                self.size -= len(entry.data)
+                return None
+            entry.unchanged(now)
+        self._entries[path] = entry
+        return entry
+
+
+    def load(self, resource):
+        """
+        Read the file of the L{File} C{resource} into the cache, if it is
+        small enough.
+
+        @rtype: L{_CachedFile} or C{None}
+        """
+        path = resource.fp.path
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.maxFileSize:
+            return None
+        try:
+            f = resource.openForReading()
+            try:
+                data = f.read(self.maxFileSize + 1)
+            finally:
+                f.close()
+            unchanged = _signature(os.stat(path)) == _signature(st)
+        except (IOError, OSError):
+            return None
+        if not unchanged or len(data) != st.st_size:
+            # The file changed while it was read, or the resource does not
+            # serve it as it is.
+            return None
+        type, encoding = resource._getTypeAndEncoding()
+        entry = _CachedFile(data, type, encoding, st, self.time())
+        old = self._entries.pop(path, None)
+        if old is not None:
+            self.size -= len(old.data)
+        self._entries[path] = entry
+        self.size += len(data)
+        while self.size > self.maxBytes:
+            path, old = self._entries.popitem(last=False)
+            self.size -= len(old.data)
+        return entry
+
+
+
 class Registry(components.Componentized):
     """
     I am a Componentized object that will be made available to internal Twisted
     file-based dynamic web content such as .rpy and .epy scripts.
+
+    @ivar fileCache: C{None}, or the L{FileCache} used by the L{File}s which
+        share this registry, unless it has a C{threadPool}.
+    @ivar threadPool: C{None}, or the L{twisted.python.threadpool.ThreadPool}
+        in which the L{File}s which share this registry look for, open and
+        read their files, for storage slow enough that doing so would hold up
+        the reactor.  Its maximum number of threads bounds the number of
+        filesystem operations in progress at once.  Whoever creates it must
+        start it, and stop it when the reactor stops.
+    @ivar reactor: The reactor to which the results of C{threadPool} are
+        delivered.
     """
 
-    def __init__(self):
+    def __init__(self, fileCache=None, threadPool=None, reactor=None):
         components.Componentized.__init__(self)
         self._pathCache = {}
+        self.fileCache = fileCache
+        self.threadPool = threadPool
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
 
     def cachePath(self, path, rsrc):
         self._pathCache[path] = rsrc
@@ -169,6 +468,17 @@ class File:
     File('/tmp'), then http://server/FILE/ will return an HTML-formatted
     listing of the /tmp/ directory, and http://server/FILE/foo/bar.html will
     return the contents of /tmp/foo/bar.html .
+
+    If there is a precompressed copy of a file next to it, named as in
+    C{precompressedEncodings}, it is served instead to clients which accept
+    its content-coding.  For example, /tmp/foo/bar.html.gz is served, with a
+    Content-Encoding of gzip, for /tmp/foo/bar.html.
+
+    If the L{Registry} has a C{threadPool}, files and their precompressed
+    copies are looked for, opened, listed and read in it, so that slow
+    storage does not hold up the reactor.  The C{fileCache} of the registry
+    is not used then, since looking files up in it and filling it stat and
+    read them in the reactor thread.
     """
 
     implements(inevow.IResource)
@@ -184,6 +494,15 @@ class File:
 
     indexNames = ["index", "index.html", "index.htm", "index.trp", "index.rpy"]
 
+    # Content-codings, and the extensions of the precompressed copies of
+    # files in them, in order of preference.
+    precompressedEncodings = [("gzip", ".gz")]
+
+    # The most ranges, after merging those which overlap, to send in a
+    # multipart/byteranges response; the whole file is sent for requests for
+    # more.
+    maxRanges = 64
+
     type = None
 
     def __init__(self, path, defaultType="text/html", ignoredExts=(), registry=None, allowExt=0):
@@ -226,33 +545,91 @@ class File:
             return r, segments[1:]
         
         path=segments[0]
-        
+
+        cache = self._getFileCache()
+        if path and cache is not None:
+            fpath = self.fp.child(path)
+            if (cache.get(fpath.path) is not None and
+                    self._getProcessor(fpath) is None):
+                return self.createSimilarFile(fpath.path), segments[1:]
+
+        if self.registry.threadPool is None:
+            return self._locatedChild(self._findChild(path), segments)
+        d = self._inThreadPool(self._findChild, path)
+        d.addCallback(self._locatedChild, segments)
+        return d
+
+    def _getFileCache(self):
+        """
+        Return the L{FileCache} to use, or C{None} if there is none or the
+        registry has a thread pool.
+        """
+        if self.registry.threadPool is not None:
+            return None
+        return self.registry.fileCache
+
+    def _inThreadPool(self, f, *args):
+        """
+        Call C{f}, which blocks on the filesystem, with C{args} in the thread
+        pool of the registry.
+
+        @return: A L{Deferred} which fires in the reactor thread with the
+            result of C{f}.
+        """
+        return deferToThreadPool(
+            self.registry.reactor, self.registry.threadPool, f, *args)
+
+    def _findChild(self, path):
+        """
+        Look in the filesystem for the file to serve as the child C{path}.
+        This blocks, so it is run in the registry's thread pool if there is
+        one.
+
+        @return: C{None} if there is nothing to serve, or a two-tuple of the
+            L{FilePath} of the file and whether it is an ordinary file.  The
+            L{FilePath} is C{None} if C{path} is empty and there is no index
+            file, so that the directory should be listed.
+        """
         self.fp.restat()
-        
+
         if not self.fp.isdir():
-            return rend.NotFound
+            return None
 
         if path:
             fpath = self.fp.child(path)
         else:
             fpath = self.fp.childSearchPreauth(*self.indexNames)
             if fpath is None:
-                return self.directoryListing(), segments[1:]
+                return None, False
 
         if not fpath.exists():
             fpath = fpath.siblingExtensionSearch(*self.ignoredExts)
             if fpath is None:
-                return rend.NotFound
+                return None
+
+        return fpath, fpath.isfile()
+
+    def _locatedChild(self, found, segments):
+        """
+        Return the child resource and remaining segments for the result of
+        L{_findChild}.
+        """
+        if found is None:
+            return rend.NotFound
+        fpath, isFile = found
+
+        if fpath is None:
+            if self.registry.threadPool is None:
+                return self.directoryListing(), segments[1:]
+            # Listing the directory blocks too.
+            d = self._inThreadPool(self.directoryListing)
+            d.addCallback(lambda listing: (listing, segments[1:]))
+            return d
 
         # Don't run processors on directories - if someone wants their own
         # customized directory rendering, subclass File instead.
-        if fpath.isfile():
-            if platformType == "win32":
-                # don't want .RPY to be different than .rpy, since that
-                # would allow source disclosure.
-                processor = InsensitiveDict(self.processors).get(fpath.splitext()[1])
-            else:
-                processor = self.processors.get(fpath.splitext()[1])
+        if isFile:
+            processor = self._getProcessor(fpath)
             if processor:
                 return (
                     inevow.IResource(processor(fpath.path, self.registry)),
@@ -260,6 +637,16 @@ class File:
 
         return self.createSimilarFile(fpath.path), segments[1:]
 
+    def _getProcessor(self, fpath):
+        """
+        Return the processor for the file at C{fpath}, or C{None}.
+        """
+        if platformType == "win32":
+            # don't want .RPY to be different than .rpy, since that
+            # would allow source disclosure.
+            return InsensitiveDict(self.processors).get(fpath.splitext()[1])
+        return self.processors.get(fpath.splitext()[1])
+
     # methods to allow subclasses to e.g. decrypt files on the fly:
     def openForReading(self):
         """Open a file and return it."""
@@ -270,21 +657,84 @@ class File:
         return self.fp.getsize()
 
 
-    def renderHTTP(self, ctx):
-        """You know what you doing."""
-        self.fp.restat()
-
+    def _getTypeAndEncoding(self):
+        """Return the content type and encoding of the file."""
         if self.type is None:
             self.type, self.encoding = getTypeAndEncoding(self.fp.basename(),
                                                           self.contentTypes,
                                                           self.contentEncodings,
                                                           self.defaultType)
+        return self.type, self.encoding
 
-        if not self.fp.exists():
-            return rend.FourOhFour()
 
+    def renderHTTP(self, ctx):
+        """You know what you doing."""
         request = inevow.IRequest(ctx)
 
+        if self.registry.threadPool is not None:
+            return self._renderThreaded(ctx, request)
+
+        precompressed = self._getPrecompressed(request)
+        if precompressed is not None:
+            return precompressed.renderHTTP(ctx)
+
+        cache = self.registry.fileCache
+        if cache is not None and request.getHeader('range') is None:
+            entry = cache.get(self.fp.path) or cache.load(self)
+            if entry is not None:
+                return self._renderCached(request, entry)
+
+        return self._renderFile(request, *self._openFile())
+
+    def _renderThreaded(self, ctx, request):
+        """
+        Respond to C{request}, looking for precompressed copies of the file
+        and opening it in the registry's thread pool.
+        """
+        if self._mayUsePrecompressed(request):
+            d = self._inThreadPool(self._findPrecompressed)
+            d.addCallback(
+                lambda copies: self._choosePrecompressed(request, copies))
+        else:
+            d = defer.succeed(None)
+        def cbPrecompressed(precompressed):
+            if precompressed is not None:
+                return precompressed.renderHTTP(ctx)
+            d = self._inThreadPool(self._openFile)
+            d.addCallback(lambda (f, forbidden):
+                              self._renderFile(request, f, forbidden))
+            return d
+        return d.addCallback(cbPrecompressed)
+
+    def _openFile(self):
+        """
+        Find out about the file and open it, if it exists and is not a
+        directory.  This blocks, so it is run in the registry's thread pool if
+        there is one.
+
+        @return: A two-tuple of the open file, or C{None}, and whether it
+            could not be opened for lack of permission.
+        """
+        self.fp.restat()
+        if not self.fp.exists() or self.fp.isdir():
+            return None, False
+        try:
+            return self.openForReading(), False
+        except IOError, e:
+            if e[0] == errno.EACCES:
+                return None, True
+            else:
+                raise
+
+    def _renderFile(self, request, f, forbidden):
+        """
+        Respond to C{request} with the file opened by L{_openFile}.
+        """
+        self._getTypeAndEncoding()
+
+        if not self.fp.exists():
+            return rend.FourOhFour()
+
         if self.fp.isdir():
             return self.redirect(request)
 
@@ -299,52 +749,167 @@ class File:
         if self.encoding:
             request.setHeader('content-encoding', self.encoding)
 
-        try:
-            f = self.openForReading()
-        except IOError, e:
-            import errno
-            if e[0] == errno.EACCES:
-                return ForbiddenResource().render(request)
-            else:
-                raise
+        if forbidden:
+            return ForbiddenResource().render(request)
 
-        if request.setLastModified(self.fp.getModificationTime()) is http.CACHED:
+        mtime = self.fp.getModificationTime()
+        try:
+            inode = self.fp.getInodeNumber()
+        except NotImplementedError:
+            inode = 0
+        etag = _entityTag(inode, fsize, mtime, time.time())
+        if _notModified(request, etag, mtime):
+            f.close()
             return ''
 
-        try:
-            range = request.getHeader('range')
-
-            if range is not None:
-                # This is a request for partial data...
-                bytesrange = string.split(range, '=')
-                assert bytesrange[0] == 'bytes',\
-                       "Syntactically invalid http range header!"
-                start, end = string.split(bytesrange[1],'-')
-                if start:
-                    f.seek(int(start))
-                if end:
-                    end = int(end)
-                else:
-                    end = fsize-1
-                request.setResponseCode(http.PARTIAL_CONTENT)
-                request.setHeader('content-range',"bytes %s-%s/%s" % (
-                    str(start), str(end), str(fsize)))
+        ranges = None
+        range = request.getHeader('range')
+        if range is not None and _rangeApplies(request, etag, mtime):
+            ranges = parseRange(range, fsize)
+            if ranges is not None and len(ranges) > self.maxRanges:
+                ranges = None
+
+        parts = None
+        if ranges is not None:
+            if not ranges:
+                f.close()
+                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+                request.setHeader('content-range', 'bytes */%d' % (fsize,))
+                request.setHeader('content-length', '0')
+                return ''
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            if len(ranges) == 1:
+                [(start, end)] = ranges
+                f.seek(start)
+                request.setHeader('content-range', 'bytes %d-%d/%d' % (
+                    start, end, fsize))
                 #content-length should be the actual size of the stuff we're
                 #sending, not the full size of the on-server entity.
-                size = 1 + end - int(start)
-
-            request.setHeader('content-length', str(size))
-        except:
-            traceback.print_exc(file=log.logfile)
+                size = 1 + end - start
+            else:
+                boundary = os.urandom(12).encode('hex')
+                request.setHeader(
+                    'content-type',
+                    'multipart/byteranges; boundary=%s' % (boundary,))
+                parts = []
+                size = 0
+                for (start, end) in ranges:
+                    header = '\r\n--%s\r\n' % (boundary,)
+                    if self.type:
+                        header += 'Content-Type: %s\r\n' % (self.type,)
+                    header += 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                        start, end, fsize)
+                    parts.append((header, start, 1 + end - start))
+                    size += len(header) + 1 + end - start
+                trailer = '\r\n--%s--\r\n' % (boundary,)
+                size += len(trailer)
+
+        request.setHeader('content-length', str(size))
 
         if request.method == 'HEAD':
+            f.close()
             return ''
 
         # return data
-        FileTransfer(f, size, request)
+        pool = self.registry.threadPool
+        if pool is not None:
+            if parts is None:
+                parts = [('', f.tell(), size)]
+                trailer = ''
+            ThreadedFileTransfer(
+                f, parts, trailer, request, pool, self.registry.reactor)
+        elif parts is not None:
+            MultipartFileTransfer(f, parts, trailer, request)
+        elif _canSendfile(request, f):
+            SendfileTransfer(f, f.tell(), size, request)
+        else:
+            FileTransfer(f, size, request)
         # and make sure the connection doesn't get closed
         return request.deferred
 
+    def _getPrecompressed(self, request):
+        """
+        Return a resource for the precompressed copy of the file to serve in
+        response to C{request}, if there is one which the client accepts.
+        Let caches know that the response depends on the client's
+        Accept-Encoding if there are any precompressed copies.
+        """
+        if not self._mayUsePrecompressed(request):
+            return None
+        return self._choosePrecompressed(request, self._findPrecompressed())
+
+    def _mayUsePrecompressed(self, request):
+        """
+        Return whether a precompressed copy of the file could be served in
+        response to C{request}.
+        """
+        if (not self.precompressedEncodings or
+                isinstance(request, CompressingRequestWrapper)):
+            return False
+        type, encoding = self._getTypeAndEncoding()
+        return encoding is None
+
+    def _findPrecompressed(self):
+        """
+        Look for the precompressed copies of the file.  This blocks, so it is
+        run in the registry's thread pool if there is one.
+
+        @return: A C{list} of two-tuples of the content-coding and path of
+            each copy which exists, in order of preference.
+        """
+        cache = self._getFileCache()
+        found = []
+        for (coding, ext) in self.precompressedEncodings:
+            path = self.fp.path + ext
+            if ((cache is not None and cache.get(path) is not None) or
+                    os.path.isfile(path)):
+                found.append((coding, path))
+        return found
+
+    def _choosePrecompressed(self, request, copies):
+        """
+        Return a resource for the copy, of those found by
+        L{_findPrecompressed}, which the client accepts best, or C{None}.
+        """
+        accepted = parseAcceptEncoding(
+            request.getHeader('accept-encoding') or '')
+        identityQuality = accepted.get('identity', accepted.get('*', 0))
+        best = None
+        bestQuality = 0
+        for (coding, path) in copies:
+            quality = accepted.get(coding, accepted.get('*', 0))
+            if quality > bestQuality and quality >= identityQuality:
+                best = (coding, path)
+                bestQuality = quality
+        if copies:
+            request.setHeader('vary', 'accept-encoding')
+        if best is None:
+            return None
+        type, encoding = self._getTypeAndEncoding()
+        coding, path = best
+        precompressed = self.createSimilarFile(path)
+        precompressed.type = type
+        precompressed.encoding = coding
+        precompressed.precompressedEncodings = []
+        return precompressed
+
+    def _renderCached(self, request, entry):
+        """
+        Respond to C{request} with the contents of the file from a
+        L{FileCache}, in a single write.
+        """
+        request.setHeader('accept-ranges','bytes')
+        if entry.type:
+            request.setHeader('content-type', entry.type)
+        if entry.encoding:
+            request.setHeader('content-encoding', entry.encoding)
+        if _notModified(request, entry.etag, entry.lastModified):
+            return ''
+        request.setHeader('content-length', str(len(entry.data)))
+        if request.method == 'HEAD':
+            return ''
+        return entry.data
+
     def redirect(self, request):
         return redirectTo(addSlash(request), request)
 
@@ -360,6 +925,7 @@ class File:
         # refactoring by steps, here - constructor should almost certainly take these
         f.processors = self.processors
         f.indexNames = self.indexNames[:]
+        f.precompressedEncodings = self.precompressedEncodings
         return f
 
 
@@ -409,6 +975,325 @@ class FileTransfer(pb.Viewable):
 
 threadable.synchronize(FileTransfer)
 
+
+
+class MultipartFileTransfer(object):
+    """
+    A transfer of several ranges of a file over the network, as the parts of
+    a multipart/byteranges response, reading the file as it goes.
+
+    @ivar parts: The parts left to send, as three-tuples of the part headers,
+        the position of the range in the file and its size.
+    @ivar trailer: The delimiter to send after the last part.
+    """
+    implements(IPullProducer)
+
+    request = None
+
+    def __init__(self, file, parts, trailer, request):
+        self.file = file
+        self.parts = deque(parts)
+        self.trailer = trailer
+        self.request = request
+        self._remaining = 0
+        request.registerProducer(self, 0)
+
+
+    def resumeProducing(self):
+        if not self.request:
+            return
+        if not self._remaining:
+            if not self.parts:
+                self.request.write(self.trailer)
+                self.file.close()
+                request, self.request = self.request, None
+                request.unregisterProducer()
+                request.finish()
+                return
+            header, start, self._remaining = self.parts.popleft()
+            self.file.seek(start)
+            self.request.write(header)
+        data = self.file.read(
+            min(abstract.FileDescriptor.bufferSize, self._remaining))
+        if not data:
+            # The file has become shorter than the response promised.  Drop
+            # the connection rather than finishing the response, so that the
+            # client knows it is incomplete.
+            transport = self.request.transport
+            self.stopProducing()
+            transport.loseConnection()
+            return
+        self.request.write(data)
+        self._remaining -= len(data)
+
+
+    def stopProducing(self):
+        self.file.close()
+        self.request = None
+
+
+
+class ThreadedFileTransfer(object):
+    """
+    A transfer of ranges of a file over the network which reads the file in a
+    thread pool, so that a slow read holds up only the response it is for
+    rather than the whole reactor.
+
+    Chunks are read one at a time by the pool, and written to the request in
+    the reactor thread.  Up to C{readAhead} chunks are read before they are
+    written, so that the next one is usually ready when the transport wants
+    it.  While the transport is paused, reading carries on only until that
+    many are waiting.
+
+    @ivar parts: The ranges left to send, as three-tuples of data to write
+        before each range, its position in the file and its size.
+    @ivar chunkSize: The largest number of bytes to read at once.
+    @ivar readAhead: The largest number of chunks to keep waiting to be
+        written.
+    """
+    implements(IPushProducer)
+
+    chunkSize = abstract.FileDescriptor.bufferSize
+    readAhead = 4
+    request = None
+
+    def __init__(self, file, parts, trailer, request, threadPool, reactor):
+        """
+        @param trailer: Data to write after the last range.
+        @param threadPool: The L{twisted.python.threadpool.ThreadPool} to read
+            the file in.
+        @param reactor: The reactor to which the reads are delivered.
+        """
+        self.file = file
+        self.parts = deque(parts)
+        if trailer:
+            self.parts.append((trailer, 0, 0))
+        self.request = request
+        self.threadPool = threadPool
+        self.reactor = reactor
+        self._chunks = deque()
+        self._offset = self._remaining = 0
+        self._reading = False
+        self._paused = False
+        request.registerProducer(self, True)
+        self._pump()
+
+
+    def _pump(self):
+        """
+        Write the chunks which are waiting, unless the transport is paused,
+        then start reading the next one if there is room for it, or finish if
+        everything has been written.
+        """
+        while self.request is not None:
+            while self._chunks and not self._paused and (
+                self.request is not None):
+                self.request.write(self._chunks.popleft())
+            if (self.request is None or self._reading or
+                    len(self._chunks) >= self.readAhead):
+                return
+            if not self._remaining:
+                if not self.parts:
+                    if not self._chunks:
+                        self.file.close()
+                        request, self.request = self.request, None
+                        request.unregisterProducer()
+                        request.finish()
+                    return
+                header, self._offset, self._remaining = self.parts.popleft()
+                if header:
+                    self._chunks.append(header)
+                continue
+            self._reading = True
+            d = deferToThreadPool(
+                self.reactor, self.threadPool, self._read, self._offset,
+                min(self.chunkSize, self._remaining))
+            d.addCallbacks(self._cbRead, self._ebRead)
+            return
+
+
+    def _read(self, offset, size):
+        """
+        Read C{size} bytes from C{offset} in the file.  This is run in the
+        thread pool.
+        """
+        self.file.seek(offset)
+        return self.file.read(size)
+
+
+    def _cbRead(self, data):
+        self._reading = False
+        if self.request is None:
+            # Stopped while the file was being read.
+            self.file.close()
+            return
+        if not data:
+            # The file has become shorter than the response promised.
+            self._abort()
+            return
+        self._offset += len(data)
+        self._remaining -= len(data)
+        self._chunks.append(data)
+        self._pump()
+
+
+    def _ebRead(self, reason):
+        self._reading = False
+        if self.request is None:
+            self.file.close()
+            return
+        log.err(reason, "Error reading %r" % (self.file,))
+        self._abort()
+
+
+    def _abort(self):
+        """
+        Give up on the response, which cannot be completed, and drop the
+        connection so that the client knows it is incomplete.
+        """
+        transport = self.request.transport
+        self.stopProducing()
+        transport.loseConnection()
+
+
+    def pauseProducing(self):
+        self._paused = True
+
+
+    def resumeProducing(self):
+        self._paused = False
+        self._pump()
+
+
+    def stopProducing(self):
+        self.request = None
+        self._chunks.clear()
+        if not self._reading:
+            self.file.close()
+
+
+
+# The attributes of Twisted's FileDescriptor transports which
+# SendfileTransfer relies on to share the socket with them.  They are not
+# public, so sendfile is only used if the transport has all of them.
+_TRANSPORT_INTERNALS = ('producerPaused', 'dataBuffer', 'offset',
+                        '_tempDataLen')
+
+def _canSendfile(request, f):
+    """
+    Return whether L{SendfileTransfer} can send the response to C{request}
+    from C{f}: whether C{sendfile} is available, C{f} is an ordinary file,
+    and the response is written unaltered, with a known length, straight to
+    a socket whose transport has the attributes in L{_TRANSPORT_INTERNALS}.
+    Otherwise the response must be sent with L{FileTransfer}.
+    """
+    if _sendfile is None or not isinstance(f, file):
+        return False
+    # Wrappers, such as those which compress responses, are not http.Request
+    # instances.
+    if not isinstance(request, http.Request) or request.isSecure():
+        return False
+    if not request.responseHeaders.hasHeader('content-length'):
+        return False
+    transport = request.transport
+    if not isinstance(transport, abstract.FileDescriptor):
+        return False
+    for name in _TRANSPORT_INTERNALS:
+        if not hasattr(transport, name):
+            return False
+    return getattr(transport, 'socket', None) is not None
+
+
+
+class SendfileTransfer(object):
+    """
+    A transfer of part of a file over the network with the C{sendfile}
+    system call, which copies it from the file to the socket without reading
+    it into memory.
+
+    The request's transport is used to find out when its socket can be
+    written to, and nothing is sent while the transport has data of its own
+    to write, such as the response headers.
+
+    @ivar offset: The position in the file of the next byte to send.
+    @ivar size: The number of bytes left to send.
+    @ivar chunkSize: The largest number of bytes to send at once.
+    """
+    implements(IPushProducer)
+
+    chunkSize = 2 ** 20
+    request = None
+
+    def __init__(self, file, offset, size, request):
+        self.file = file
+        self.offset = offset
+        self.size = size
+        self.request = request
+        self.transport = request.transport
+        self._paused = False
+        request.registerProducer(self, True)
+        # Write the headers.
+        request.write('')
+        self.resumeProducing()
+
+
+    def _waitForTransport(self):
+        """
+        Have the transport resume this producer once its socket can be written
+        to and it has written everything it had.
+        """
+        # The transport resumes its own producer, the request's channel, after
+        # emptying its buffer if the producer is paused, and the channel
+        # resumes this producer.
+        self.transport.producerPaused = True
+        self.transport.startWriting()
+
+
+    def resumeProducing(self):
+        self._paused = False
+        if not self.request:
+            return
+        transport = self.transport
+        if transport.offset < len(transport.dataBuffer) or (
+            transport._tempDataLen):
+            self._waitForTransport()
+            return
+        try:
+            sent = _sendfile(transport.fileno(), self.file.fileno(),
+                             self.offset, min(self.size, self.chunkSize))
+        except (IOError, OSError), e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Most likely the client has gone away.
+                self.stopProducing()
+                transport.loseConnection()
+                return
+            sent = 0
+        else:
+            if not sent:
+                # The file has become shorter than the response promised.
+                self.stopProducing()
+                transport.loseConnection()
+                return
+        self.offset += sent
+        self.size -= sent
+        self.request.sentLength += sent
+        if self.size <= 0:
+            self.file.close()
+            request, self.request = self.request, None
+            request.unregisterProducer()
+            request.finish()
+        elif not self._paused:
+            self._waitForTransport()
+
+
+    def pauseProducing(self):
+        self._paused = True
+
+
+    def stopProducing(self):
+        self.file.close()
+        self.request = None
+
 """I contain AsIsProcessor, which serves files 'As Is'
    Inspired by Apache's mod_asis
 """
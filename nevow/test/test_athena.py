@@ -1,27 +1,41 @@
 
-import os, sets
+import gc, os, sets, urllib
 from itertools import izip
+from gzip import GzipFile
+from StringIO import StringIO
 from xml.dom.minidom import parseString
 
+from zope.interface.verify import verifyObject
+
 from twisted.trial import unittest
 from twisted.python import util
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Clock
 from twisted.application.service import IServiceMaker
 from twisted.application.internet import TCPServer
 from twisted.python.reflect import qual
 from twisted.python.usage import UsageError
+from twisted.python.failure import Failure
 from twisted.plugin import IPlugin
+from twisted.web import http
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+from twisted.test.proto_helpers import StringTransport, MemoryReactor
 
-from nevow import athena, rend, tags, flat, loaders, url
+from nevow import athena, rend, tags, flat, loaders, url, json
 from nevow.loaders import stan
 from nevow.athena import LiveElement, ConnectionLost
 from nevow.appserver import NevowSite
-from nevow.inevow import IRequest
-from nevow.context import WovenContext
+from nevow.inevow import IRequest, IAthenaClientRegistry
+from nevow.context import WovenContext, RequestContext
 from nevow.testutil import FakeRequest, renderPage, renderLivePage, CSSModuleTestMixin
 from nevow._widget_plugin import WidgetPluginRoot
 from nevow._widget_plugin import ElementRenderingLivePage
 from nevow.json import serialize
+from nevow.page import Element, renderer, RenderCache, RenderCacheMixin
+from nevow.timerwheel import TimerWheel
+from nevow.athenametrics import AthenaMetrics
 
 from twisted.plugins.nevow_widget import widgetServiceMaker
 
@@ -59,6 +73,73 @@ class MappingResourceTests(unittest.TestCase):
         self.assertEquals(resource, sets.Set('value'))
 
 
+    def _makeModule(self, content='var x = 1;\n'):
+        """
+        Create a module file and return a L{athena.MappingResource} mapping
+        C{'name'} to it, and the digest of its content.
+        """
+        path = self.mktemp() + '.js'
+        file(path, 'wb').write(content)
+        m = athena.MappingResource({'name': path})
+        return m, athena._loadModuleContent(path).digest
+
+
+    def test_lookupVersion(self):
+        """
+        L{athena.MappingResource} serves the module from memory, with headers
+        allowing clients to cache it forever, when the key is followed by the
+        digest of the module.
+        """
+        m, digest = self._makeModule()
+        resource, segments = m.locateChild(None, ('name', digest))
+        self.assertEquals(segments, [])
+        resource.time = lambda: 0
+        req = FakeRequest()
+        result = resource.renderHTTP(RequestContext(tag=req))
+        self.assertEquals(result, 'var x = 1;\n')
+        self.assertEquals(
+            req.responseHeaders.getRawHeaders('cache-control'),
+            ['public, max-age=%d, immutable' % (athena._IMMUTABLE_EXPIRES,)])
+        self.assertEquals(
+            req.responseHeaders.getRawHeaders('expires'),
+            [http.datetimeToString(athena._IMMUTABLE_EXPIRES)])
+        self.assertEquals(
+            req.responseHeaders.getRawHeaders('content-length'), ['11'])
+        self.assertEquals(
+            req.responseHeaders.getRawHeaders('content-encoding'), None)
+
+
+    def test_lookupVersionCompressed(self):
+        """
+        A module served by L{athena.MappingResource} from memory is compressed
+        with gzip for clients which accept it, compressing it only once.
+        """
+        m, digest = self._makeModule()
+        resource, segments = m.locateChild(None, ('name', digest))
+        req = FakeRequest(headers={'accept-encoding': 'gzip'})
+        result = resource.renderHTTP(RequestContext(tag=req))
+        self.assertEquals(
+            req.responseHeaders.getRawHeaders('content-encoding'), ['gzip'])
+        self.assertEquals(
+            GzipFile(fileobj=StringIO(result)).read(), 'var x = 1;\n')
+        resource, segments = m.locateChild(None, ('name', digest))
+        self.assertIdentical(
+            resource.renderHTTP(RequestContext(tag=req)), result)
+
+
+    def test_lookupStaleVersion(self):
+        """
+        L{athena.MappingResource} serves the current version of the module
+        from C{resourceFactory} when the key is followed by anything but its
+        digest.
+        """
+        m, digest = self._makeModule()
+        m.resourceFactory = sets.Set
+        resource, segments = m.locateChild(None, ('name', 'abc'))
+        self.assertEquals(segments, [])
+        self.assertEquals(resource, sets.Set(m.mapping['name']))
+
+
 
 class ModuleRegistryTestMixin:
     """
@@ -623,6 +704,31 @@ class UtilitiesTests(unittest.TestCase):
         return renderDeferred
 
 
+    def test_elementNotCached(self):
+        """
+        The output of a L{RenderCacheMixin} containing a L{LiveElement} is not
+        cached, since the widget must be added to its page each time it is
+        rendered.
+        """
+        class Cached(RenderCacheMixin, Element):
+            renderCache = RenderCache()
+            docFactory = loaders.stan(tags.div(render=tags.directive('child')))
+            def cacheKey(self, request):
+                return 'widget'
+            def child(self, request, tag):
+                return tag[element]
+            renderer(child)
+
+        element = athena.LiveElement(docFactory=loaders.stan(
+                tags.span(render=tags.directive('liveElement'))))
+        page = athena.LivePage(docFactory=loaders.stan(Cached()))
+        element.setFragmentParent(page)
+        def rendered(result):
+            self.assertIn('id="athena:%d"' % (element._athenaID,), result)
+            self.assertIdentical(Cached.renderCache.get('widget'), None)
+        return renderLivePage(page).addCallback(rendered)
+
+
     def test_userAgentDetection(self):
         """
         C{LivePage._supportedBrowser} should return True for User-Agent strings
@@ -1259,6 +1365,482 @@ class Transport(unittest.TestCase):
         self.assertEqual(self.outgoingMessages, [(None, [athena.CLOSE, []])])
 
 
+    def test_coalesceMessages(self):
+        """
+        If the message deliverer has a C{coalesceDelay}, messages added
+        while there is an output are sent together once it has passed.
+        """
+        self.rdm.coalesceDelay = 0.5
+        self.rdm.addOutput(mappend(self.transport))
+        for i in range(3):
+            self.rdm.addMessage(i)
+        self.assertEqual(self.transport, [])
+        n, f, a, kw = self.scheduled.pop()
+        self.assertEqual(n, 0.5)
+        self.assertEqual(self.scheduled[-1][0], self.idleTimeout)
+        f(*a, **kw)
+        self.assertEqual(self.transport, [[(0, 0), (1, 1), (2, 2)]])
+        self.rdm.addMessage(3)
+        self.assertEqual(self.scheduled[-1][0], 0.5)
+
+
+    def test_coalescedMessagesWithoutOutput(self):
+        """
+        Messages waiting for C{coalesceDelay} to pass are sent to an output
+        added in the meantime at once.
+        """
+        self.rdm.coalesceDelay = 0.5
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.addOutput(mappend(self.transport))
+        self.assertEqual(self.transport, [[(0, self.theMessage)]])
+
+
+    def test_closeCancelsCoalesce(self):
+        """
+        Closing the message deliverer sends waiting messages at once and
+        cancels the C{coalesceDelay} call.
+        """
+        self.rdm.coalesceDelay = 0.5
+        self.rdm.addOutput(mappend(self.transport))
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.close()
+        self.assertEqual(
+            self.transport,
+            [[(0, self.theMessage), (1, (athena.CLOSE, []))]])
+        self.failIf(self.scheduled, "Expected no scheduled calls.")
+
+
+    def test_acknowledgeMany(self):
+        """
+        Acknowledging a long run of messages discards them all, oldest first.
+        """
+        for i in range(1000):
+            self.rdm.addMessage(i)
+        self.rdm.basketCaseReceived(None, [997, []])
+        self.assertEqual(list(self.rdm.messages), [(998, 998), (999, 999)])
+
+
+    def test_maxMessages(self):
+        """
+        With L{athena.OVERFLOW_DROP}, a message which would take the number of
+        unacknowledged messages over C{maxMessages} is refused with
+        L{athena.MessageQueueFull} until some are acknowledged.
+        """
+        self.rdm.maxMessages = 2
+        self.rdm.overflowPolicy = athena.OVERFLOW_DROP
+        self.rdm.addMessage(0)
+        self.rdm.addMessage(1)
+        self.assertRaises(athena.MessageQueueFull, self.rdm.addMessage, 2)
+        self.assertEqual(list(self.rdm.messages), [(0, 0), (1, 1)])
+        self.rdm.basketCaseReceived(None, [0, []])
+        self.rdm.addMessage(2)
+        self.assertEqual(list(self.rdm.messages), [(1, 1), (2, 2)])
+        self.failIf(self.events, "Unexpectedly received some events.")
+
+
+    def test_maxBytes(self):
+        """
+        A message which would take the total size of the serialized
+        unacknowledged messages over C{maxBytes} is refused, unless there are
+        no others.
+        """
+        message = u'hello'
+        size = len(serialize(message))
+        self.rdm.maxBytes = size * 2
+        self.rdm.overflowPolicy = athena.OVERFLOW_DROP
+        self.rdm.addMessage(message)
+        self.rdm.addMessage(message)
+        self.assertEqual(self.rdm.pendingBytes, size * 2)
+        self.assertRaises(
+            athena.MessageQueueFull, self.rdm.addMessage, u'x')
+        self.rdm.basketCaseReceived(None, [1, []])
+        self.assertEqual(self.rdm.pendingBytes, 0)
+        self.rdm.addMessage(message * 3)
+        self.assertEqual(self.rdm.pendingBytes, size * 3 - 4)
+
+
+    def test_maxBytesSerializedOnce(self):
+        """
+        If C{maxBytes} is set, the serialized form of each message, made to
+        count its size, is sent in place of the message.
+        """
+        self.rdm.maxBytes = 100
+        self.rdm.addMessage([u'hello', []])
+        self.assertEqual(list(self.rdm.messages), [(0, [u'hello', []])])
+        self.rdm.addOutput(mappend(self.transport))
+        [[(seq, serialized)]] = self.transport
+        self.assertIdentical(type(serialized), json.Serialized)
+        self.assertEqual(
+            self.rdm.serializeBasket([-1, [(seq, serialized)]]),
+            '[-1,[[0,["hello",[]]]]]')
+
+
+    def test_addResponse(self):
+        """
+        L{athena.ReliableMessageDelivery.addResponse} queues a message however
+        many are already waiting.
+        """
+        self.rdm.maxMessages = 1
+        self.rdm.maxBytes = 1
+        self.rdm.addMessage(0)
+        self.rdm.addResponse(1)
+        self.assertEqual(list(self.rdm.messages), [(0, 0), (1, 1)])
+        self.assertEqual(self.rdm.pendingBytes, 2)
+        self.failIf(self.events, "Unexpectedly received some events.")
+
+
+    def test_overflowCoalesce(self):
+        """
+        With L{athena.OVERFLOW_COALESCE}, a message which does not fit is put
+        in place of the unsent message added with the same key, which
+        L{athena.ReliableMessageDelivery.addMessage} returns.  Messages with
+        no such unsent message are refused.
+        """
+        self.rdm.maxMessages = 2
+        self.rdm.overflowPolicy = athena.OVERFLOW_COALESCE
+        self.assertIdentical(self.rdm.addMessage(u'a', key='k'), None)
+        self.rdm.addMessage(u'b')
+        self.assertEqual(self.rdm.addMessage(u'c', key='k'), u'a')
+        self.assertEqual(list(self.rdm.messages), [(0, u'c'), (1, u'b')])
+        self.assertRaises(
+            athena.MessageQueueFull, self.rdm.addMessage, u'd', key='j')
+        self.rdm.addOutput(mappend(self.transport))
+        self.assertEqual(self.transport, [[(0, u'c'), (1, u'b')]])
+        self.assertRaises(
+            athena.MessageQueueFull, self.rdm.addMessage, u'e', key='k')
+
+
+    def test_overflowDisconnect(self):
+        """
+        With L{athena.OVERFLOW_DISCONNECT}, a message which does not fit
+        discards the unacknowledged messages, closes the message deliverer and
+        reports the connection lost.
+        """
+        self.rdm.maxMessages = 2
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.addMessage(self.theMessage)
+        waiting = self.rdm.notifyOnSpace()
+        self.assertRaises(
+            athena.MessageQueueFull, self.rdm.addMessage, self.theMessage)
+        self.assertEqual(len(self.events), 1)
+        self.events[0].trap(athena.MessageQueueFull)
+        self.assertFailure(waiting, athena.MessageQueueFull)
+        self.failIf(self.scheduled, "Expected no scheduled calls.")
+        self.rdm.addOutput(mappend(self.transport))
+        self.assertEqual(self.transport, [[(2, (athena.CLOSE, []))]])
+        return waiting
+
+
+    def test_notifyOnSpace(self):
+        """
+        L{athena.ReliableMessageDelivery.notifyOnSpace} returns a L{Deferred}
+        which fires once another message can be added.
+        """
+        self.rdm.maxMessages = 1
+        self.assertTrue(self.rdm.notifyOnSpace().called)
+        self.rdm.addMessage(self.theMessage)
+        self.assertFalse(self.rdm.hasSpace())
+        waiting = self.rdm.notifyOnSpace()
+        self.assertFalse(waiting.called)
+        self.rdm.basketCaseReceived(None, [-1, []])
+        self.assertFalse(waiting.called)
+        self.rdm.basketCaseReceived(None, [0, []])
+        self.assertTrue(waiting.called)
+
+
+    def test_metrics(self):
+        """
+        L{athena.ReliableMessageDelivery} counts its timeouts, refused
+        baskets, queue depths and serialized bytes in its C{metrics}.
+        """
+        metrics = self.rdm.metrics
+        self.rdm.addOutput(mappend(self.transport))
+        n, f, a, kw = self.scheduled.pop()
+        f(*a, **kw)
+        n, f, a, kw = self.scheduled.pop()
+        f(*a, **kw)
+        self.assertEqual(metrics.timeouts, {'idle': 1, 'transportless': 1})
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.addMessage(self.theMessage)
+        self.assertEqual(metrics.pendingMessages.count, 2)
+        self.assertEqual(metrics.pendingMessages.sum, 3)
+        self.rdm.basketCaseReceived(None, [-1, [(5, self.theMessage)]])
+        self.assertEqual(metrics.sequenceGaps, 1)
+        self.assertEqual(self.rdm.serializeBasket([0, []]), '[0,[]]')
+        self.assertEqual(metrics.bytesSerialized, 6)
+
+
+
+class WebSocketTransportTests(unittest.TestCase):
+    """
+    Tests for L{athena.LivePageWebSocketTransport} and the protocol it
+    connects to a L{athena.ReliableMessageDelivery}.
+    """
+    def liveTransportMessageReceived(self, ctx, message):
+        self.received.append((ctx, message))
+
+
+    def setUp(self):
+        self.received = []
+        self.rdm = athena.ReliableMessageDelivery(
+            self, connectionMade=lambda: None,
+            connectionLost=lambda reason: None,
+            scheduler=Clock().callLater)
+        self.ctx = object()
+        self.protocol = athena._LivePageWebSocketProtocol(self.rdm, self.ctx)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+
+    def _sent(self):
+        """
+        Return the baskets sent to the client so far.
+        """
+        baskets = []
+        data = self.transport.value()
+        while data:
+            length = ord(data[1])
+            baskets.append(json.parse(data[2:2 + length]))
+            data = data[2 + length:]
+        return baskets
+
+
+    def test_notWebSocket(self):
+        """
+        L{athena.LivePageWebSocketTransport} responds to requests which are not
+        WebSocket requests with a I{400} response.
+        """
+        resource = athena.LivePageWebSocketTransport(self.rdm)
+        req = FakeRequest()
+        self.assertEqual(resource.renderHTTP(RequestContext(tag=req)), '')
+        self.assertEqual(req.code, http.BAD_REQUEST)
+
+
+    def test_crossOrigin(self):
+        """
+        L{athena.LivePageWebSocketTransport} responds to WebSocket requests
+        from pages served by another host with a I{403} response.
+        """
+        resource = athena.LivePageWebSocketTransport(self.rdm)
+        req = FakeRequest(headers={
+            'upgrade': 'websocket',
+            'connection': 'Upgrade',
+            'sec-websocket-version': '13',
+            'sec-websocket-key': 'dGhlIHNhbXBsZSBub25jZQ==',
+            'host': 'example.com',
+            'origin': 'http://evil.example'})
+        self.assertEqual(resource.renderHTTP(RequestContext(tag=req)), '')
+        self.assertEqual(req.code, http.FORBIDDEN)
+
+
+    def test_malformedBasket(self):
+        """
+        A message which is not JSON closes the connection with status
+        I{1007} instead of raising an exception.
+        """
+        self.protocol.messageReceived('[-1, [')
+        self.assertEqual(self.received, [])
+        self.assertEqual(self.transport.value(), '\x88\x02\x03\xef')
+        self.assertTrue(self.transport.disconnecting)
+
+
+    def test_messages(self):
+        """
+        Baskets received over the connection are delivered to the page with
+        the connection's context, and each opens an output whose basket is
+        sent over the connection when it is used.
+        """
+        self.protocol.messageReceived('[-1, [[0, ["call", []]]]]')
+        self.assertEqual(self.received, [(self.ctx, [u'call', []])])
+        self.assertEqual(self._sent(), [])
+        self.rdm.addMessage([u'noop', []])
+        self.assertEqual(self._sent(), [[0, [[0, [u'noop', []]]]]])
+        self.assertEqual(self.protocol._outputs, [])
+
+
+    def test_supersededOutput(self):
+        """
+        When another basket is received, the output opened by an earlier one
+        is used up with an empty basket.
+        """
+        self.protocol.messageReceived('[-1, []]')
+        self.protocol.messageReceived('[-1, []]')
+        self.assertEqual(self._sent(), [[-1, []]])
+        self.assertEqual(len(self.protocol._outputs), 1)
+
+
+    def test_connectionLost(self):
+        """
+        When the connection is lost, its outputs are withdrawn and messages
+        are kept for another transport.
+        """
+        self.protocol.messageReceived('[-1, []]')
+        self.protocol.connectionLost(None)
+        self.assertEqual(list(self.rdm.outputs), [])
+        self.rdm.addMessage([u'noop', []])
+        self.assertEqual(self._sent(), [])
+        self.assertEqual(list(self.rdm.messages), [(0, [u'noop', []])])
+
+
+
+class StreamingRequest(FakeRequest):
+    """
+    L{FakeRequest} with the parts of L{twisted.web.http.Request} that
+    L{athena.LivePageTransport} uses.
+    """
+    def __init__(self, content, **kw):
+        FakeRequest.__init__(self, **kw)
+        self.content = StringIO(content)
+        self.finishNotifications = []
+
+
+    def notifyFinish(self):
+        d = Deferred()
+        self.finishNotifications.append(d)
+        return d
+
+
+
+class StreamingTransportTests(unittest.TestCase):
+    """
+    Tests for streamed responses from L{athena.LivePageTransport}.
+    """
+    def liveTransportMessageReceived(self, ctx, message):
+        pass
+
+
+    def setUp(self):
+        self.clock = Clock()
+        self.rdm = athena.ReliableMessageDelivery(
+            self, idleTimeout=30, connectionMade=lambda: None,
+            connectionLost=lambda reason: None,
+            scheduler=self.clock.callLater)
+        self.resource = athena.LivePageTransport(self.rdm)
+
+
+    def _render(self, basket='[-1, []]'):
+        """
+        Render the transport for a request asking for C{basket} to be
+        answered with a stream, and return the request and a list which will
+        contain the result.
+        """
+        req = StreamingRequest(
+            basket, headers={athena.STREAMING_HEADER: '1'})
+        req.method = 'POST'
+        results = []
+        self.resource.renderHTTP(RequestContext(tag=req)).addCallback(
+            results.append)
+        return req, results
+
+
+    def _baskets(self, req):
+        """
+        Return the baskets written to C{req}.
+        """
+        return [json.parse(line) for line in req.accumulator.splitlines()]
+
+
+    def test_severalBaskets(self):
+        """
+        Each time messages are added, they are written to the response as a
+        line, and the response stays open.
+        """
+        req, results = self._render()
+        self.rdm.addMessage([u'first', []])
+        self.rdm.addMessage([u'second', []])
+        self.assertEqual(
+            self._baskets(req),
+            [[-1, [[0, [u'first', []]]]], [-1, [[1, [u'second', []]]]]])
+        self.assertEqual(results, [])
+        self.assertEqual(len(self.rdm.outputs), 1)
+
+
+    def test_contentType(self):
+        """
+        A streamed response has the same content type as a response which is
+        not streamed.
+        """
+        req, results = self._render()
+        plain = StreamingRequest('[-1, []]')
+        plain.method = 'POST'
+        self.resource.renderHTTP(RequestContext(tag=plain))
+        self.assertEqual(
+            req.responseHeaders.getRawHeaders('content-type'),
+            ['text/html; charset=UTF-8'])
+        self.assertEqual(
+            plain.responseHeaders.getRawHeaders('content-type'),
+            req.responseHeaders.getRawHeaders('content-type'))
+
+
+    def test_pendingMessages(self):
+        """
+        Messages which are waiting when the request is received are written
+        at once, and not again.
+        """
+        self.rdm.addMessage([u'first', []])
+        req, results = self._render()
+        self.assertEqual(self._baskets(req), [[-1, [[0, [u'first', []]]]]])
+        self.assertEqual(results, [])
+        self.assertEqual(len(self.rdm.outputs), 1)
+
+
+    def test_superseded(self):
+        """
+        When another basket is received, the streamed response is finished
+        with an empty basket.
+        """
+        req, results = self._render()
+        self.rdm.addMessage([u'first', []])
+        self.rdm.basketCaseReceived(None, [0, []])
+        self.assertEqual(
+            self._baskets(req), [[-1, [[0, [u'first', []]]]], [-1, []]])
+        self.assertEqual(results, [''])
+        self.assertEqual(len(self.rdm.outputs), 1)
+
+
+    def test_expired(self):
+        """
+        Once a streamed response has been open for the message delivery's
+        C{idleTimeout}, it is finished after its next basket, or at once if
+        it is waiting for messages.
+        """
+        req, results = self._render()
+        self.clock.advance(20)
+        self.rdm.addMessage([u'first', []])
+        self.clock.advance(10)
+        self.assertEqual(
+            self._baskets(req), [[-1, [[0, [u'first', []]]]], [-1, []]])
+        self.assertEqual(results, [''])
+        self.assertEqual(list(self.rdm.outputs), [])
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 60)
+
+
+    def test_closed(self):
+        """
+        When the message delivery is closed, the streamed response is
+        finished after it has been sent the closing message.
+        """
+        req, results = self._render()
+        self.rdm.close()
+        self.assertEqual(
+            self._baskets(req), [[-1, [[0, [athena.CLOSE, []]]]], [-1, []]])
+        self.assertEqual(results, [''])
+
+
+    def test_connectionLost(self):
+        """
+        When the connection is lost, the stream is no longer an output, and
+        messages are kept for another transport.
+        """
+        req, results = self._render()
+        req.finishNotifications[0].errback(RuntimeError("lost"))
+        self.assertEqual(list(self.rdm.outputs), [])
+        self.rdm.addMessage([u'first', []])
+        self.assertEqual(req.accumulator, '')
+        self.assertEqual(list(self.rdm.messages), [(0, [u'first', []])])
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 30)
+
+
 
 class LiveMixinTestsMixin(CSSModuleTestMixin):
     """
@@ -1557,10 +2139,12 @@ class LivePageTests(unittest.TestCase, CSSModuleTestMixin):
 
     def tearDown(self):
         """
-        Shut this test's L{LivePage} timers down, if the test started them up.
+        Shut this test's L{LivePage} timers down, if the test started them up
+        and they have not been shut down by a disconnection.
         """
-        if hasattr(self.page, '_messageDeliverer'):
-            self.page._messageDeliverer.close()
+        deliverer = getattr(self.page, '_messageDeliverer', None)
+        if deliverer is not None and not deliverer._stopped:
+            deliverer.close()
 
 
     def test_bootstrapCall(self):
@@ -1580,6 +2164,7 @@ class LivePageTests(unittest.TestCase, CSSModuleTestMixin):
         L{LivePage}'s jsClass depends on.
         """
         self.page.jsClass = u'PythonTestSupport.Dependor.PageTest'
+        self.page.bundleJSModules = False
         freq = FakeRequest()
         self.page._becomeLive(url.URL.fromRequest(freq))
         ctx = WovenContext(tag=tags.div())
@@ -1592,6 +2177,118 @@ class LivePageTests(unittest.TestCase, CSSModuleTestMixin):
         self.assertIn(expectDependee, result)
 
 
+    def test_pageJsClassDependenciesBundled(self):
+        """
+        If L{LivePage.bundleJSModules} is set, L{LivePage.render_liveglue}
+        imports the modules that the L{LivePage}'s jsClass depends on with a
+        single script, which the page's C{jsmodule} child serves.
+        """
+        self.page.jsClass = u'PythonTestSupport.Dependor.PageTest'
+        freq = FakeRequest()
+        self.page._becomeLive(url.URL.fromRequest(freq))
+        ctx = WovenContext(tag=tags.div())
+        ctx.remember(freq, IRequest)
+        self.page.render_liveglue(ctx, None)
+        result = flat.flatten(ctx.tag, ctx)
+        self.assertNotIn(
+            flat.flatten(self.page.getImportStan(u'PythonTestSupport.Dependor')),
+            result)
+
+        bundleURL = flat.flatten(self.page.jsModuleRoot.child(
+            athena._BUNDLE_SEGMENT))
+        start = result.index(bundleURL) + len(bundleURL) + 1
+        (digest, names) = result[start:result.index('"', start)].split('/')
+
+        (res, segments) = self.page.locateChild(None, ('jsmodule',))
+        self.assertTrue(isinstance(res, athena.JSModuleResource))
+        (bundle, segments) = res.locateChild(
+            None, (athena._BUNDLE_SEGMENT, digest, urllib.unquote(names)))
+        self.assertEqual(segments, [])
+        body = bundle.content.data
+        dependee = body.index(
+            athena.jsModuleDeclaration(u'PythonTestSupport.Dependee'))
+        dependor = body.index(
+            athena.jsModuleDeclaration(u'PythonTestSupport.Dependor'))
+        self.assertTrue(dependee < dependor)
+        self.assertIn(
+            file(athena.jsDeps.mapping[u'PythonTestSupport.Dependor']).read(),
+            body)
+
+
+    def test_jsBundleChanged(self):
+        """
+        The URL returned by L{LivePage.getJSBundleURL} changes when one of the
+        modules changes, and the bundle at the old URL is discarded.
+        """
+        path = self.mktemp()
+        file(path, 'w').write('// one\n')
+        os.utime(path, (1000, 1000))
+        class MyJSModules:
+            mapping = {u'A': path}
+        self.page.jsModules = MyJSModules()
+        self.page._becomeLive(url.URL())
+        resource = self.page.child_jsmodule(None)
+
+        first = self.page.getJSBundleURL([u'A'])
+        self.assertEqual(self.page.getJSBundleURL([u'A']), first)
+        self.assertEqual(
+            resource.locateChild(None, first.pathList()[-3:])[0].content.data,
+            athena.jsModuleDeclaration(u'A') + '\n// one\n\n')
+
+        file(path, 'w').write('// two\n')
+        os.utime(path, (2000, 2000))
+        second = self.page.getJSBundleURL([u'A'])
+        self.assertNotEqual(second, first)
+        self.assertIdentical(
+            resource.locateChild(None, first.pathList()[-3:]), rend.NotFound)
+        self.assertIn(
+            '// two',
+            resource.locateChild(None, second.pathList()[-3:])[0].content.data)
+
+
+    def test_jsBundleOtherProcess(self):
+        """
+        A bundle can be fetched from its URL by a process which did not build
+        it, since the URL names the modules in it.
+        """
+        path = self.mktemp()
+        file(path, 'w').write('// one\n')
+        class MyJSModules:
+            mapping = {u'A': path, u'B': path}
+        self.page.jsModules = MyJSModules()
+        self.page._becomeLive(url.URL())
+        bundleURL = self.page.getJSBundleURL([u'A', u'B'])
+        segments = bundleURL.pathList()[-3:]
+        content = athena._theJSBundler.getBundle(
+            MyJSModules.mapping, [u'A', u'B'], segments[1])
+
+        self.patch(athena, '_theJSBundler', athena._JSBundler())
+        resource = self.page.child_jsmodule(None)
+        (bundle, rest) = resource.locateChild(None, segments)
+        self.assertEqual(bundle.content.data, content.data)
+        self.assertEqual(rest, [])
+
+
+    def test_jsmoduleUnknownBundle(self):
+        """
+        L{athena.JSModuleResource} returns L{rend.NotFound} for a bundle which
+        does not exist, names an unknown module or has a digest which does
+        not match its modules.
+        """
+        path = self.mktemp()
+        file(path, 'w').write('// one\n')
+        res = athena.JSModuleResource({u'A': path})
+        digest = athena._JSBundler().getDigest(res.mapping, [u'A'])
+        self.assertIsInstance(
+            res.locateChild(None, (athena._BUNDLE_SEGMENT, digest, 'A'))[0],
+            athena._ImmutableModuleResource)
+        for segments in [(athena._BUNDLE_SEGMENT, 'abc'),
+                         (athena._BUNDLE_SEGMENT, 'abc', 'A'),
+                         (athena._BUNDLE_SEGMENT, digest, 'A,B'),
+                         (athena._BUNDLE_SEGMENT, digest, '\xff')]:
+            self.assertIdentical(res.locateChild(None, segments), rend.NotFound)
+
+
     def test_pageCSSModuleDependencies(self):
         """
         L{athena.LivePage.render_liveglue} should include CSS modules that
@@ -1636,6 +2333,221 @@ class LivePageTests(unittest.TestCase, CSSModuleTestMixin):
               [u'Nevow.Athena.PageWidget', u'asdf'])])
 
 
+    def test_bootstrapsWebSocket(self):
+        """
+        If L{LivePage.useWebSocketTransport} is set, L{LivePage._bootstraps}
+        enables the WebSocket transport before the page is bootstrapped, and
+        the page has a C{websocket} child.
+        """
+        req = FakeRequest()
+        ctx = WovenContext()
+        ctx.remember(req, IRequest)
+        self.page.clientID = 'asdf'
+        self.page.useWebSocketTransport = True
+        self.assertEqual(
+            [name for (name, args) in self.page._bootstraps(ctx)],
+            ["Divmod.bootstrap",
+             "Nevow.Athena.enableWebSocketTransport",
+             "Nevow.Athena.bootstrap"])
+        self.page._becomeLive(url.URL.fromRequest(req))
+        (res, segments) = self.page.locateChild(None, ('websocket',))
+        self.assertTrue(isinstance(res, athena.LivePageWebSocketTransport))
+        self.assertIdentical(res.messageDeliverer, self.page._messageDeliverer)
+
+
+    def test_bootstrapsStreaming(self):
+        """
+        If L{LivePage.useStreamingTransport} is set, L{LivePage._bootstraps}
+        enables the streaming transport before the page is bootstrapped.
+        """
+        req = FakeRequest()
+        ctx = WovenContext()
+        ctx.remember(req, IRequest)
+        self.page.clientID = 'asdf'
+        self.page.useStreamingTransport = True
+        self.assertEqual(
+            [name for (name, args) in self.page._bootstraps(ctx)],
+            ["Divmod.bootstrap",
+             "Nevow.Athena.enableStreamingTransport",
+             "Nevow.Athena.bootstrap"])
+
+
+    def test_transportTimerWheel(self):
+        """
+        If L{LivePage.transportTimerWheel} is set, the page's transport
+        timeouts are kept by it.
+        """
+        wheel = TimerWheel(clock=Clock())
+        self.page.transportTimerWheel = wheel
+        self.page._becomeLive(url.URL.fromRequest(FakeRequest()))
+        [call] = wheel.getDelayedCalls()
+        self.assertEqual(
+            call.getTime(), self.page.TRANSPORTLESS_DISCONNECT_TIMEOUT * 2)
+
+
+    def test_callRemoteCoalesced(self):
+        """
+        A call made with a C{coalesceKey} which takes the place of an unsent
+        call gives its result to both calls, and a call which cannot be sent
+        fails with L{athena.MessageQueueFull}.
+        """
+        self.page.TRANSPORT_MAX_PENDING_MESSAGES = 1
+        self.page.TRANSPORT_OVERFLOW_POLICY = athena.OVERFLOW_COALESCE
+        self.page._becomeLive(url.URL.fromRequest(FakeRequest()))
+        first = self.page.callRemote('update', 1, coalesceKey='update')
+        second = self.page.callRemote('update', 2, coalesceKey='update')
+        [(seq, (kind, (name, requestID, args)))] = (
+            self.page._messageDeliverer.messages)
+        self.assertEqual(args, (2,))
+        self.assertEqual(self.page._remoteCalls.keys(), [requestID])
+        self.assertFailure(
+            self.page.callRemote('other'), athena.MessageQueueFull)
+        self.page.action_respond(None, requestID, True, u'done')
+        results = []
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+        self.assertEqual(results, [u'done', u'done'])
+
+
+    def test_callRemoteOverflowDisconnect(self):
+        """
+        A call which overflows the outgoing messages of a page using
+        L{athena.OVERFLOW_DISCONNECT} fails with L{athena.MessageQueueFull}
+        through the L{Deferred} returned to its caller alone, leaving no
+        unhandled failure behind, while calls already made fail with the
+        disconnection.
+        """
+        self.page.TRANSPORT_MAX_PENDING_MESSAGES = 1
+        self.page.TRANSPORT_OVERFLOW_POLICY = athena.OVERFLOW_DISCONNECT
+        self.page._becomeLive(url.URL.fromRequest(FakeRequest()))
+        first = self.page.callRemote('first')
+        self.assertFailure(
+            self.page.callRemote('second'), athena.MessageQueueFull)
+        self.assertFailure(first, athena.MessageQueueFull)
+        self.assertEqual(self.page._remoteCalls, {})
+        gc.collect()
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+
+    def test_respondWhenFull(self):
+        """
+        The response to a call from the client is sent even if the page's
+        outgoing messages are full.
+        """
+        self.page.TRANSPORT_MAX_PENDING_MESSAGES = 1
+        self.page.TRANSPORT_OVERFLOW_POLICY = athena.OVERFLOW_DROP
+        self.page._becomeLive(url.URL.fromRequest(FakeRequest()))
+        class Widget(LiveElement):
+            def echo(self, value):
+                return value
+            athena.expose(echo)
+        widget = Widget()
+        widget.setFragmentParent(self.page)
+        widget._athenaID = self.page.addLocalObject(widget)
+        self.page.addMessage((u'noop', ()))
+        self.page.action_call(
+            None, u'c2s0', u'echo', widget._athenaID, (u'x',), {})
+        self.assertEqual(
+            list(self.page._messageDeliverer.messages),
+            [(0, (u'noop', ())), (1, (u'respond', (u'c2s0', True, u'x')))])
+
+
+    def _metricsPage(self):
+        """
+        Give C{self.page} a factory of its own, with metrics measured with a
+        fake clock, and make it live.
+
+        @return: The metrics, and the clock.
+        """
+        clock = Clock()
+        metrics = AthenaMetrics(clock)
+        self.page.factory = athena.LivePageFactory(metrics=metrics)
+        self.page.factory.noisy = False
+        self.page._becomeLive(url.URL.fromRequest(FakeRequest()))
+        return metrics, clock
+
+
+    def test_metrics(self):
+        """
+        A page's message deliverer uses the metrics of the page's factory,
+        which counts the pages which are live.
+        """
+        metrics, clock = self._metricsPage()
+        self.assertIdentical(self.page._messageDeliverer.metrics, metrics)
+        self.assertEqual(metrics.livePages, 1)
+        self.page._disconnected(ConnectionLost('test'))
+        self.assertEqual(metrics.livePages, 0)
+
+
+    def test_callRemoteLatency(self):
+        """
+        The time until the result of a L{LivePage.callRemote} arrives is
+        counted for the name of the method called, unless the page disconnects
+        first.
+        """
+        metrics, clock = self._metricsPage()
+        d = self.page.callRemote('update')
+        [(seq, (kind, (name, requestID, args)))] = (
+            self.page._messageDeliverer.messages)
+        clock.advance(2)
+        self.page.action_respond(None, requestID, True, None)
+        histogram = metrics.callRemoteLatency['update']
+        self.assertEqual((histogram.count, histogram.sum), (1, 2))
+        self.assertFailure(self.page.callRemote('update'), ConnectionLost)
+        self.page._disconnected(ConnectionLost('test'))
+        self.assertEqual(histogram.count, 1)
+        return d
+
+
+    def test_widgetCallRemoteLatency(self):
+        """
+        The time until the result of a widget's C{callRemote} arrives is
+        counted for the qualified name of the widget's class and the name of
+        the method called.
+        """
+        metrics, clock = self._metricsPage()
+        widget = LiveElement()
+        widget.setFragmentParent(self.page)
+        widget._athenaID = self.page.addLocalObject(widget)
+        d = widget.callRemote('update', 1)
+        [(seq, (kind, (name, requestID, args)))] = (
+            self.page._messageDeliverer.messages)
+        self.assertEqual(name, u'Nevow.Athena.callByAthenaID')
+        self.assertEqual(args, (widget._athenaID, u'update', (1,)))
+        clock.advance(3)
+        self.page.action_respond(None, requestID, True, None)
+        self.assertEqual(
+            metrics.callRemoteLatency.keys(), [qual(LiveElement) + '.update'])
+        self.assertEqual(metrics.callRemoteLatency.values()[0].sum, 3)
+        return d
+
+
+    def test_actionCallLatency(self):
+        """
+        The time a server method called by the client takes to produce its
+        result is counted for the qualified name of the method.
+        """
+        metrics, clock = self._metricsPage()
+        result = Deferred()
+        class Widget(LiveElement):
+            def slow(self):
+                return result
+            athena.expose(slow)
+        widget = Widget()
+        widget.setFragmentParent(self.page)
+        widget._athenaID = self.page.addLocalObject(widget)
+        self.page.action_call(None, u'c2s0', u'slow', widget._athenaID, (), {})
+        clock.advance(0.25)
+        result.callback(None)
+        self.assertEqual(
+            metrics.actionCallLatency.keys(), [qual(Widget) + '.slow'])
+        self.assertEqual(metrics.actionCallLatency.values()[0].sum, 0.25)
+        self.page.action_call(
+            None, u'c2s1', u'missing', widget._athenaID, (), {})
+        self.assertEqual(len(metrics.actionCallLatency), 1)
+        self.flushLoggedErrors(athena.NoSuchMethod)
+
+
     def test_renderReconnect(self):
         """
         L{LivePage.renderHTTP} should render a JSON-encoded version of its
@@ -1650,6 +2562,20 @@ class LivePageTests(unittest.TestCase, CSSModuleTestMixin):
         self.assertEqual(string, jsonifiedID)
 
 
+    def test_reconnectMetric(self):
+        """
+        L{LivePage.renderHTTP} counts the reconnects it renders in the
+        factory's metrics.
+        """
+        self.page.factory = athena.LivePageFactory()
+        self.page.factory.noisy = False
+        req = FakeRequest(args={athena.ATHENA_RECONNECT: ["1"]})
+        ctx = WovenContext()
+        ctx.remember(req, IRequest)
+        self.page.renderHTTP(ctx)
+        self.assertEqual(self.page.factory.metrics.reconnects, 1)
+
+
     def test_cssModules(self):
         """
         L{athena.LivePage.cssModules} should default to
@@ -1674,6 +2600,36 @@ class LivePageTests(unittest.TestCase, CSSModuleTestMixin):
         self.assertIdentical(res.mapping, theCSSMapping)
 
 
+    def test_moduleURLVersion(self):
+        """
+        L{athena.LivePage.getJSModuleURL} and
+        L{athena.LivePage.getCSSModuleURL} include the digest of the module
+        after its name, which changes when the module does.
+        """
+        path = self.mktemp()
+        file(path, 'w').write('one')
+        os.utime(path, (1000, 1000))
+        class MyModules:
+            mapping = {u'X.Y': path}
+        page = athena.LivePage(
+            jsModules=MyModules(), cssModules=MyModules(),
+            jsModuleRoot=url.URL.fromString('/js'),
+            cssModuleRoot=url.URL.fromString('/css'))
+        digest = athena._loadModuleContent(path).digest
+        self.assertEqual(
+            page.getJSModuleURL(u'X.Y'),
+            url.URL.fromString('/js').child('X.Y').child(digest))
+        self.assertEqual(
+            page.getCSSModuleURL(u'X.Y'),
+            url.URL.fromString('/css').child('X.Y').child(digest))
+
+        file(path, 'w').write('two')
+        os.utime(path, (2000, 2000))
+        self.assertNotEqual(
+            page.getJSModuleURL(u'X.Y'),
+            url.URL.fromString('/js').child('X.Y').child(digest))
+
+
     def test_cssModuleRoot(self):
         """
         L{athena.LivePage}'s C{cssModuleRoot} argument should be observed by
@@ -1710,6 +2666,300 @@ class LivePageTests(unittest.TestCase, CSSModuleTestMixin):
 
 
 
+class PublishTests(unittest.TestCase):
+    """
+    Tests for L{athena.LivePageFactory.publish} and the subscriptions it
+    publishes to.
+    """
+    def setUp(self):
+        self.factory = athena.LivePageFactory()
+        self.factory.noisy = False
+
+
+    def makeWidget(self, **pageAttributes):
+        """
+        Make a live page using C{self.factory}, and a widget on it.
+        """
+        page = athena.LivePage()
+        page.factory = self.factory
+        for (name, value) in pageAttributes.items():
+            setattr(page, name, value)
+        page._becomeLive(url.URL.fromRequest(FakeRequest()))
+        self.addCleanup(page._messageDeliverer.close)
+        element = LiveElement()
+        element.setFragmentParent(page)
+        element._athenaID = page.addLocalObject(element)
+        return element
+
+
+    def _notifications(self, widget):
+        """
+        Return the arguments of the notifications waiting to be sent to the
+        page of C{widget}.
+        """
+        notifications = []
+        for (seq, (kind, args)) in widget.page._messageDeliverer.messages:
+            self.assertEqual(kind, u'notify')
+            notifications.append(args)
+        return notifications
+
+
+    def test_publish(self):
+        """
+        L{athena.LivePageFactory.publish} serializes its arguments once and
+        sends them to each widget subscribed to the topic, and returns the
+        number of widgets.
+        """
+        first = self.makeWidget()
+        second = self.makeWidget()
+        other = self.makeWidget()
+        first.subscribe('ticker', 'update')
+        second.subscribe('ticker', 'refresh')
+        other.subscribe('news', 'update')
+        self.assertEqual(self.factory.publish('ticker', 1.5, u'up'), 2)
+        [(function, (athenaID, method, firstPayload))] = (
+            self._notifications(first))
+        self.assertEqual(function, u'Nevow.Athena.callByAthenaID')
+        self.assertEqual((athenaID, method), (first._athenaID, u'update'))
+        self.assertEqual(firstPayload, '[1.5,"up"]')
+        [(function, (athenaID, method, secondPayload))] = (
+            self._notifications(second))
+        self.assertEqual(method, u'refresh')
+        self.assertIdentical(firstPayload, secondPayload)
+        self.assertEqual(self._notifications(other), [])
+        self.assertEqual(
+            json.serialize(list(first.page._messageDeliverer.messages)),
+            '[[0,["notify",["Nevow.Athena.callByAthenaID",'
+            '[%d,"update",[1.5,"up"]]]]]]' % (first._athenaID,))
+
+
+    def test_unsubscribe(self):
+        """
+        Widgets which have unsubscribed, been detached or whose pages have
+        disconnected are forgotten at once, and not sent published calls.
+        """
+        unsubscribed = self.makeWidget()
+        detached = self.makeWidget()
+        disconnected = self.makeWidget()
+        for widget in [unsubscribed, detached, disconnected]:
+            widget.subscribe('ticker', 'update')
+            widget.subscribe('news', 'update')
+        unsubscribed.unsubscribe('ticker')
+        unsubscribed.unsubscribe('news')
+        detachedPage = detached.page
+        detached._athenaDetachServer()
+        disconnectedPage = disconnected.page
+        disconnectedPage._disconnected(ConnectionLost('test'))
+        self.assertEqual(self.factory._subscribers, {})
+        self.assertEqual(self.factory._subscriptions, {})
+        self.assertEqual(self.factory.publish('ticker', 1), 0)
+        for page in [unsubscribed.page, detachedPage, disconnectedPage]:
+            self.assertEqual(list(page._messageDeliverer.messages), [])
+
+
+    def test_publishCoalesced(self):
+        """
+        A published call to a page whose outgoing messages are full takes the
+        place of the unsent call for the same topic, if the page's
+        C{TRANSPORT_OVERFLOW_POLICY} is L{athena.OVERFLOW_COALESCE}, and is
+        not sent otherwise.
+        """
+        coalescing = self.makeWidget(
+            TRANSPORT_MAX_PENDING_MESSAGES=1,
+            TRANSPORT_OVERFLOW_POLICY=athena.OVERFLOW_COALESCE)
+        dropping = self.makeWidget(
+            TRANSPORT_MAX_PENDING_MESSAGES=1,
+            TRANSPORT_OVERFLOW_POLICY=athena.OVERFLOW_DROP)
+        coalescing.subscribe('ticker', 'update')
+        dropping.subscribe('ticker', 'update')
+        self.assertEqual(self.factory.publish('ticker', 1), 2)
+        self.assertEqual(self.factory.publish('ticker', 2), 1)
+        [(function, (athenaID, method, payload))] = (
+            self._notifications(coalescing))
+        self.assertEqual(payload, '[2]')
+        [(function, (athenaID, method, payload))] = (
+            self._notifications(dropping))
+        self.assertEqual(payload, '[1]')
+
+
+
+class ClientRegistryTests(unittest.TestCase):
+    """
+    Tests for the L{inevow.IAthenaClientRegistry} implementations and the
+    forwarding of requests for pages owned by other processes.
+    """
+    clientID = 'a' * 32
+
+    def setUp(self):
+        self.registry = athena.LocalClientRegistry()
+        self.factory = athena.LivePageFactory(self.registry, 'tcp:host:8080')
+        self.factory.noisy = False
+
+
+    def _registryTest(self, registry):
+        """
+        Check that C{registry} looks up the owners registered with it.
+        """
+        self.assertTrue(verifyObject(IAthenaClientRegistry, registry))
+        self.assertIdentical(registry.lookup(self.clientID), None)
+        registry.register(self.clientID, 'tcp:host:8080')
+        self.assertEqual(registry.lookup(self.clientID), 'tcp:host:8080')
+        registry.unregister(self.clientID)
+        self.assertIdentical(registry.lookup(self.clientID), None)
+        registry.unregister(self.clientID)
+
+
+    def test_localRegistry(self):
+        """
+        L{athena.LocalClientRegistry} looks up the owners registered with it.
+        """
+        self._registryTest(athena.LocalClientRegistry())
+
+
+    def test_directoryRegistry(self):
+        """
+        L{athena.DirectoryClientRegistry} looks up the owners registered with
+        any instance for the same directory.
+        """
+        path = self.mktemp()
+        os.mkdir(path)
+        self._registryTest(athena.DirectoryClientRegistry(path))
+        athena.DirectoryClientRegistry(path).register(self.clientID, 'unix:x')
+        self.assertEqual(
+            athena.DirectoryClientRegistry(path).lookup(self.clientID),
+            'unix:x')
+
+
+    def test_registered(self):
+        """
+        L{athena.LivePageFactory} registers its clients as owned by its
+        C{owner} while they are connected.
+        """
+        clientID = self.factory.addClient(object())
+        self.assertEqual(self.registry.lookup(clientID), 'tcp:host:8080')
+        self.factory.removeClient(clientID)
+        self.assertIdentical(self.registry.lookup(clientID), None)
+
+
+    def test_forwardClient(self):
+        """
+        L{athena.LivePageFactory.forwardClient} returns a resource forwarding
+        to the owner of a client which another factory registered.
+        """
+        self.registry.register(self.clientID, 'tcp:other:8080')
+        forwarder = self.factory.forwardClient(FakeRequest(), self.clientID)
+        self.assertIsInstance(forwarder, athena._ForwardingResource)
+        self.assertEqual(forwarder.owner, 'tcp:other:8080')
+
+
+    def test_notForwarded(self):
+        """
+        L{athena.LivePageFactory.forwardClient} returns C{None} for unknown
+        clients, clients registered by the factory's own process, requests
+        which have already been forwarded, and factories with no registry.
+        """
+        self.registry.register(self.clientID, 'tcp:host:8080')
+        self.registry.register('b' * 32, 'tcp:other:8080')
+        self.registry.register('not an ID', 'tcp:other:8080')
+        self.assertIdentical(
+            self.factory.forwardClient(FakeRequest(), 'c' * 32), None)
+        self.assertIdentical(
+            self.factory.forwardClient(FakeRequest(), self.clientID), None)
+        self.assertIdentical(
+            self.factory.forwardClient(FakeRequest(), 'not an ID'), None)
+        forwarded = FakeRequest(headers={athena.FORWARDED_HEADER: '1'})
+        self.assertIdentical(
+            self.factory.forwardClient(forwarded, 'b' * 32), None)
+        self.assertIdentical(
+            athena.LivePageFactory().forwardClient(FakeRequest(), 'b' * 32),
+            None)
+
+
+    def test_deferredLookup(self):
+        """
+        L{athena.LivePageFactory.forwardClient} returns a L{Deferred} if the
+        registry's C{lookup} does.
+        """
+        self.registry.lookup = lambda clientID: succeed('tcp:other:8080')
+        d = self.factory.forwardClient(FakeRequest(), self.clientID)
+        d.addCallback(lambda forwarder: self.assertEqual(
+            forwarder.owner, 'tcp:other:8080'))
+        return d
+
+
+    def test_locateForwarded(self):
+        """
+        L{LivePage.locateChild} returns the forwarding resource for a page
+        owned by another process.
+        """
+        self.registry.register(self.clientID, 'tcp:other:8080')
+        page = athena.LivePage()
+        page.factory = self.factory
+        ctx = WovenContext()
+        ctx.remember(FakeRequest(), IRequest)
+        forwarder, segments = page.locateChild(
+            ctx, (self.clientID, 'transport'))
+        self.assertIsInstance(forwarder, athena._ForwardingResource)
+        self.assertEqual(segments, ())
+
+
+    def _forward(self):
+        """
+        Render a forwarding resource with a fake reactor.
+
+        @return: The request, and the reactor.
+        """
+        reactor = MemoryReactor()
+        request = DummyRequest([])
+        request.method = 'POST'
+        request.uri = '/live/%s/transport' % (self.clientID,)
+        request.content = StringIO('[]')
+        request.requestHeaders.setRawHeaders('x-example', ['yes'])
+        forwarder = athena._ForwardingResource('tcp:other:8080', reactor)
+        self.assertEqual(forwarder.render(request), NOT_DONE_YET)
+        return request, reactor
+
+
+    def test_forwarding(self):
+        """
+        L{athena._ForwardingResource} sends the request to the owning process,
+        marked as forwarded, and relays the response.
+        """
+        request, reactor = self._forward()
+        [(host, port, factory, timeout, bindAddress)] = reactor.tcpClients
+        self.assertEqual((host, port), ('other', 8080))
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        sent = transport.value()
+        self.assertTrue(sent.startswith(
+            'POST /live/%s/transport HTTP/1.0\r\n' % (self.clientID,)))
+        self.assertIn('\r\n%s: 1\r\n' % (athena.FORWARDED_HEADER,), sent)
+        self.assertIn('\r\nx-example: yes\r\n', sent)
+        self.assertTrue(sent.endswith('\r\n\r\n[]'))
+        protocol.dataReceived(
+            'HTTP/1.0 200 OK\r\nContent-Length: 2\r\n\r\n[]')
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(request.written, ['[]'])
+        self.assertTrue(request.finished)
+
+
+    def test_forwardingFailed(self):
+        """
+        L{athena._ForwardingResource} responds with I{Bad Gateway} if it cannot
+        connect to the owning process.
+        """
+        request, reactor = self._forward()
+        [(host, port, factory, timeout, bindAddress)] = reactor.tcpClients
+        factory.clientConnectionFailed(
+            reactor.connectors[0], Failure(ConnectionRefusedError()))
+        self.assertEqual(request.responseCode, http.BAD_GATEWAY)
+        self.assertTrue(request.finished)
+        self.assertEqual(len(self.flushLoggedErrors(ConnectionRefusedError)),
+                         1)
+
+
+
 class ConnectionTestElement(LiveElement):
     """
     Element for testing connectionMade and connectionLost callbacks.
@@ -0,0 +1,118 @@
+"""
+Tests for L{nevow.athenametrics}.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+from nevow.athenametrics import (
+    Histogram, AthenaMetrics, LATENCY_BUCKETS, formatMetrics, MetricsResource)
+from nevow.context import WovenContext
+from nevow.inevow import IRequest
+from nevow.testutil import FakeRequest
+
+
+
+class HistogramTests(TestCase):
+    """
+    Tests for L{Histogram}.
+    """
+    def test_snapshot(self):
+        """
+        L{Histogram.snapshot} gives the cumulative count of the values in each
+        bucket, and the number and sum of all values.
+        """
+        histogram = Histogram((1, 10))
+        for value in [0, 1, 2, 10, 11]:
+            histogram.observe(value)
+        self.assertEqual(
+            histogram.snapshot(),
+            {'count': 5, 'sum': 24, 'buckets': [(1, 2), (10, 4)]})
+
+
+
+class AthenaMetricsTests(TestCase):
+    """
+    Tests for L{AthenaMetrics}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = AthenaMetrics(self.clock)
+
+
+    def test_observeLatency(self):
+        """
+        L{AthenaMetrics.observeLatency} counts the time since the given time
+        in a histogram for the given name.
+        """
+        started = self.clock.seconds()
+        self.clock.advance(0.5)
+        self.metrics.observeLatency(
+            self.metrics.actionCallLatency, 'Widget.method', started)
+        [histogram] = self.metrics.actionCallLatency.values()
+        self.assertEqual(histogram.bounds, LATENCY_BUCKETS)
+        self.assertEqual((histogram.count, histogram.sum), (1, 0.5))
+        self.assertEqual(
+            self.metrics.snapshot()['actionCallLatency']['Widget.method'],
+            histogram.snapshot())
+        self.assertEqual(self.metrics.snapshot()['callRemoteLatency'], {})
+
+
+    def test_snapshot(self):
+        """
+        L{AthenaMetrics.snapshot} gives the current values of the metrics, and
+        does not change with them.
+        """
+        self.metrics.livePages = 2
+        self.metrics.timedOut('idle')
+        self.metrics.timedOut('idle')
+        snapshot = self.metrics.snapshot()
+        self.metrics.timedOut('connect')
+        self.assertEqual(snapshot['livePages'], 2)
+        self.assertEqual(snapshot['timeouts'], {'idle': 2})
+        self.assertEqual(snapshot['pendingMessages']['count'], 0)
+
+
+    def test_formatMetrics(self):
+        """
+        L{formatMetrics} gives the samples of a snapshot in the Prometheus
+        text format.
+        """
+        self.metrics.livePages = 3
+        self.metrics.bytesSerialized = 1024
+        self.metrics.timedOut('transportless')
+        self.metrics.pendingMessages.observe(4)
+        self.metrics.observeLatency(
+            self.metrics.callRemoteLatency, u'say"hi"', self.clock.seconds())
+        lines = formatMetrics(self.metrics.snapshot()).splitlines()
+        self.assertIn('athena_live_pages 3', lines)
+        self.assertIn('athena_serialized_bytes_total 1024', lines)
+        self.assertIn('athena_timeouts_total{type="transportless"} 1', lines)
+        self.assertIn('athena_pending_messages_bucket{le="2.0"} 0', lines)
+        self.assertIn('athena_pending_messages_bucket{le="5.0"} 1', lines)
+        self.assertIn('athena_pending_messages_bucket{le="+Inf"} 1', lines)
+        self.assertIn('athena_pending_messages_sum 4', lines)
+        self.assertIn(
+            'athena_call_remote_seconds_count{method="say\\"hi\\""} 1', lines)
+        self.assertIn('# TYPE athena_action_call_seconds histogram', lines)
+
+
+
+class MetricsResourceTests(TestCase):
+    """
+    Tests for L{MetricsResource}.
+    """
+    def test_render(self):
+        """
+        L{MetricsResource} renders the current metrics as plain text.
+        """
+        metrics = AthenaMetrics(Clock())
+        metrics.sequenceGaps = 7
+        request = FakeRequest()
+        ctx = WovenContext()
+        ctx.remember(request, IRequest)
+        body = MetricsResource(metrics).renderHTTP(ctx)
+        self.assertEqual(body, formatMetrics(metrics.snapshot()))
+        self.assertIn('athena_sequence_gaps_total 7\n', body)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-type'),
+            ['text/plain; version=0.0.4'])
@@ -0,0 +1,368 @@
+"""
+Tests for L{nevow.caching}.
+"""
+from zope.interface import implements
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from nevow.inevow import IResource, IRequest
+from nevow.testutil import FakeRequest
+from nevow.context import RequestContext, PageContext
+from nevow.appserver import errorMarker
+from nevow.rend import NotFound
+from nevow.page import RenderCache
+from nevow.caching import CachingResourceWrapper, CachedResponse
+
+
+
+class TestResource(object):
+    """
+    L{IResource} implementation for testing.
+
+    @ivar renders: The requests this resource has rendered.
+    @ivar html: The data to return from C{renderHTTP}, or a L{Deferred} to
+        return instead.
+    @ivar written: Data to write to the request before returning C{html}.
+    @ivar located: The segments passed to C{locateChild}.
+    """
+    implements(IResource)
+
+    def __init__(self, html='o hi', written=''):
+        self.renders = []
+        self.located = []
+        self.html = html
+        self.written = written
+
+
+    def locateChild(self, ctx, segments):
+        """
+        Hand out this resource for any segments.
+        """
+        self.located.append(segments)
+        return self, []
+
+
+    def renderHTTP(self, ctx):
+        """
+        Record the request and write and return the configured data.
+        """
+        req = IRequest(ctx)
+        self.renders.append(req)
+        req.setHeader('content-type', 'text/plain')
+        if self.written:
+            req.write(self.written)
+        return self.html
+
+
+
+class CachingResourceWrapperTests(TestCase):
+    """
+    Tests for L{CachingResourceWrapper}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.resource = TestResource()
+        self.wrapped = CachingResourceWrapper(
+            self.resource, RenderCache(clock=self.clock), maxAge=10,
+            clock=self.clock)
+
+
+    def _render(self, wrapped=None, uri='/', **kw):
+        """
+        Render C{wrapped} for a new request and return the request and a list
+        which will contain the result or failure.
+        """
+        if wrapped is None:
+            wrapped = self.wrapped
+        req = FakeRequest(uri=uri, **kw)
+        results = []
+        d = wrapped.renderHTTP(RequestContext(tag=req))
+        if isinstance(d, Deferred):
+            d.addCallbacks(results.append, results.append)
+        else:
+            results.append(d)
+        return req, results
+
+
+    def test_cached(self):
+        """
+        A response is rendered once and replayed for later requests, with its
+        headers, until C{maxAge} seconds have passed.
+        """
+        self.resource.written = 'hello, '
+        self.resource.html = 'world'
+        req, results = self._render()
+        self.assertEqual(req.accumulator + results[0], 'hello, world')
+        self.resource.html = 'other'
+        self.clock.advance(9)
+        req, results = self._render()
+        self.assertEqual(results, ['hello, world'])
+        self.assertEqual(req.accumulator, '')
+        self.assertEqual(
+            req.responseHeaders.getRawHeaders('content-type'), ['text/plain'])
+        self.assertEqual(len(self.resource.renders), 1)
+        self.clock.advance(1)
+        req, results = self._render()
+        self.assertEqual(results, ['other'])
+        self.assertEqual(len(self.resource.renders), 2)
+
+
+    def test_key(self):
+        """
+        Responses are kept separately for each path, selected query argument,
+        selected header and result of C{keyFunction}, and not at all when
+        C{keyFunction} returns C{None}.
+        """
+        self.wrapped.queryArgs = ('page',)
+        self.wrapped.varyHeaders = ('accept-language',)
+        self.wrapped.keyFunction = lambda req: req.args.get('user', [1])[0]
+        self._render(uri='/a')
+        self._render(uri='/a', args={'other': ['1']})
+        self.assertEqual(len(self.resource.renders), 1)
+        self._render(uri='/b')
+        self._render(uri='/a', args={'page': ['2']})
+        self._render(uri='/a', headers={'accept-language': 'fr'})
+        self._render(uri='/a', args={'user': ['2']})
+        self.assertEqual(len(self.resource.renders), 5)
+        self._render(uri='/a', args={'user': [None]})
+        self._render(uri='/a', args={'user': [None]})
+        self.assertEqual(len(self.resource.renders), 7)
+
+
+    def test_notCached(self):
+        """
+        Responses which are not for I{GET} requests, which set a cookie, have
+        a code other than 200, are private or are not strings are not kept.
+        """
+        req = FakeRequest()
+        req.method = 'POST'
+        self.wrapped.renderHTTP(RequestContext(tag=req))
+        self._render()
+        self.assertEqual(len(self.resource.renders), 2)
+
+        self.resource.renderHTTP = lambda ctx: IRequest(ctx).addCookie('a', 'b') or ''
+        self._render(uri='/cookie')
+        self.assertIdentical(self.wrapped.cache.get(('/cookie', (), ())), None)
+
+        def renderHTTP(ctx):
+            IRequest(ctx).setResponseCode(404)
+            return ''
+        self.resource.renderHTTP = renderHTTP
+        self._render(uri='/missing')
+        self.assertIdentical(self.wrapped.cache.get(('/missing', (), ())), None)
+
+        def renderHTTP(ctx):
+            IRequest(ctx).setHeader('cache-control', 'private')
+            return ''
+        self.resource.renderHTTP = renderHTTP
+        self._render(uri='/private')
+        self.assertIdentical(self.wrapped.cache.get(('/private', (), ())), None)
+
+        self.resource.renderHTTP = lambda ctx: errorMarker
+        req, results = self._render(uri='/error')
+        self.assertIdentical(results[0], errorMarker)
+        self.assertIdentical(self.wrapped.cache.get(('/error', (), ())), None)
+
+
+    def test_coalesced(self):
+        """
+        Requests for a key which is being rendered wait for that render and
+        are served its response.
+        """
+        self.resource.html = Deferred()
+        first, firstResults = self._render()
+        second, secondResults = self._render()
+        self.assertEqual(len(self.resource.renders), 1)
+        self.assertEqual(secondResults, [])
+        self.resource.html.callback('done')
+        self.assertEqual(firstResults, ['done'])
+        self.assertEqual(secondResults, ['done'])
+
+
+    def test_coalescedUncacheable(self):
+        """
+        Requests waiting for a render whose response cannot be kept render the
+        resource themselves.
+        """
+        waiting = Deferred()
+        def renderHTTP(ctx):
+            self.resource.renders.append(IRequest(ctx))
+            IRequest(ctx).setResponseCode(500)
+            return waiting
+        self.resource.renderHTTP = renderHTTP
+        self._render()
+        self._render()
+        waiting.callback('oops')
+        self.assertEqual(len(self.resource.renders), 2)
+        self.assertEqual(self.wrapped._rendering, {})
+
+
+    def test_coalescedError(self):
+        """
+        If a render fails, requests waiting for it render the resource
+        themselves.
+        """
+        self.resource.html = Deferred()
+        first, firstResults = self._render()
+        second, secondResults = self._render()
+        html, self.resource.html = self.resource.html, 'second'
+        html.errback(RuntimeError("oops"))
+        firstResults[0].trap(RuntimeError)
+        self.assertEqual(secondResults, ['second'])
+        self.assertEqual(self.wrapped._rendering, {})
+
+
+    def test_staleWhileRevalidate(self):
+        """
+        A response older than C{maxAge} by no more than
+        C{staleWhileRevalidate} seconds is served at once, while it is
+        rendered again in the background, only once.
+        """
+        self.wrapped.staleWhileRevalidate = 5
+        self._render()
+        self.clock.advance(12)
+        self.resource.html = Deferred()
+        first, firstResults = self._render()
+        self.assertEqual(firstResults, ['o hi'])
+        second, secondResults = self._render()
+        self.assertEqual(secondResults, ['o hi'])
+        self.assertEqual(len(self.resource.renders), 2)
+        self.resource.html.callback('new')
+        req, results = self._render()
+        self.assertEqual(results, ['new'])
+        self.assertEqual(len(self.resource.renders), 2)
+
+
+    def test_revalidateDetached(self):
+        """
+        A response rendered again in the background is kept from the request
+        which found it out of date, which is served only the old response.
+        """
+        self.wrapped.staleWhileRevalidate = 5
+        self._render()
+        self.clock.advance(12)
+        def renderHTTP(ctx):
+            req = IRequest(ctx)
+            self.resource.renders.append(req)
+            req.setHeader('content-type', 'text/html')
+            req.write('written ')
+            return 'new'
+        self.resource.renderHTTP = renderHTTP
+        req, results = self._render()
+        self.assertEqual(results, ['o hi'])
+        self.assertEqual(req.accumulator, '')
+        self.assertEqual(
+            req.responseHeaders.getRawHeaders('content-type'), ['text/plain'])
+        self.assertNotIdentical(self.resource.renders[-1], req)
+        self.assertEqual(self.resource.renders[-1].path, '/')
+        req, results = self._render()
+        self.assertEqual(results, ['written new'])
+        self.assertEqual(
+            req.responseHeaders.getRawHeaders('content-type'), ['text/html'])
+
+
+    def test_revalidateChild(self):
+        """
+        A response rendered by a child is rendered again by that child, not by
+        the wrapped resource, when it is found out of date while locating the
+        child.
+        """
+        child = TestResource('child')
+        self.resource.locateChild = lambda ctx, segments: (child, ())
+        self.wrapped.staleWhileRevalidate = 5
+        results = []
+        ctx = RequestContext(tag=FakeRequest(uri='/a'))
+        self.wrapped.locateChild(ctx, ['a']).addCallback(results.append)
+        [(wrappedChild, segments)] = results
+        self._render(wrappedChild, uri='/a')
+        self.clock.advance(12)
+        child.html = 'new child'
+        req = FakeRequest(uri='/a')
+        response, segments = self.wrapped.locateChild(
+            RequestContext(tag=req), ['a'])
+        self.assertEqual(response.body, 'child')
+        self.assertEqual(len(child.renders), 2)
+        self.assertEqual(self.resource.renders, [])
+        req, results = self._render(uri='/a')
+        self.assertEqual(results, ['new child'])
+
+
+    def test_revalidateError(self):
+        """
+        If rendering a response again in the background fails, the failure is
+        logged and the old response is served until it expires.
+        """
+        self.wrapped.staleWhileRevalidate = 5
+        self._render()
+        self.clock.advance(12)
+        self.resource.html = Deferred()
+        self._render()
+        self.resource.html.errback(RuntimeError("oops"))
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertEqual(self.wrapped._rendering, {})
+        self.resource.html = 'new'
+        req, results = self._render()
+        self.assertEqual(results, ['o hi'])
+        self.assertEqual(len(self.resource.renders), 3)
+
+
+    def test_keyOnce(self):
+        """
+        The key for a request is found once, however many wrappers locate
+        children for it and render it.
+        """
+        keys = []
+        def keyFunction(req):
+            keys.append(req)
+            return 'key'
+        self.wrapped.keyFunction = keyFunction
+        req = FakeRequest(uri='/a')
+        ctx = RequestContext(tag=req)
+        results = []
+        self.wrapped.locateChild(ctx, ['a']).addCallback(results.append)
+        [(child, segments)] = results
+        child.renderHTTP(PageContext(tag=child, parent=ctx))
+        self.assertEqual(keys, [req])
+
+
+    def test_locateCached(self):
+        """
+        Locating a child for a request with a kept response returns the
+        response without consulting the wrapped resource.
+        """
+        self._render(uri='/a/b')
+        req = FakeRequest(uri='/a/b')
+        response, segments = self.wrapped.locateChild(
+            RequestContext(tag=req), ['a', 'b'])
+        self.assertTrue(isinstance(response, CachedResponse))
+        self.assertEqual(segments, ())
+        self.assertEqual(self.resource.located, [])
+
+
+    def test_wrapChildren(self):
+        """
+        Children of the wrapped resource are wrapped and share its cache.
+        """
+        results = []
+        ctx = RequestContext(tag=FakeRequest(uri='/a'))
+        self.wrapped.locateChild(ctx, ['a']).addCallback(results.append)
+        [(child, segments)] = results
+        self.assertIdentical(type(child), CachingResourceWrapper)
+        self.assertIdentical(child.underlying, self.resource)
+        self.assertIdentical(child.cache, self.wrapped.cache)
+        self._render(child, uri='/a')
+        self._render(uri='/a')
+        self.assertEqual(len(self.resource.renders), 1)
+
+
+    def test_childNotFound(self):
+        """
+        C{NotFound} from the wrapped resource is passed through.
+        """
+        self.resource.locateChild = lambda ctx, segments: NotFound
+        results = []
+        ctx = RequestContext(tag=FakeRequest(uri='/a'))
+        self.wrapped.locateChild(ctx, ['a']).addCallback(results.append)
+        self.assertEqual(results, [NotFound])
@@ -6,6 +6,7 @@ Tests for L{nevow.page.Element}
 from zope.interface.verify import verifyObject
 
 from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 
 from nevow.rend import Page
@@ -13,10 +14,12 @@ from nevow.inevow import IRequest, IRenderable
 from nevow.testutil import FakeRequest
 from nevow.context import WovenContext
 from nevow.loaders import stan, xmlstr
-from nevow.tags import directive, invisible, p
+from nevow.tags import directive, invisible, p, slot
 from nevow.errors import MissingRenderMethod, MissingDocumentFactory
 from nevow.page import FlattenerError, Element, renderer
 from nevow.page import deferflatten as newFlatten
+from nevow.page import RenderCache, RenderCacheMixin, preventCaching
+from nevow._flat import _CompiledDocument, UnfilledSlot
 from nevow.flat import flatten as synchronousFlatten
 from nevow.flat import flattenFactory as oldFlatten
 
@@ -93,6 +96,73 @@ class ElementTests(TestCase):
         self.assertEqual(foo(None, None), "bar")
 
 
+    def test_subclassRenderer(self):
+        """
+        L{Element.renderer} finds render methods overridden or hidden by a
+        subclass after the same name has been looked up on the base class.
+        """
+        class Base(Element):
+            def foo(self, request, tag):
+                return "base"
+            renderer(foo)
+            def bar(self, request, tag):
+                return "bar"
+            renderer(bar)
+        class Derived(Base):
+            def foo(self, request, tag):
+                return "derived"
+            renderer(foo)
+            def bar(self, request, tag):
+                return "hidden"
+        self.assertEqual(Base().renderer("foo")(None, None), "base")
+        self.assertEqual(Base().renderer("bar")(None, None), "bar")
+        self.assertEqual(Derived().renderer("foo")(None, None), "derived")
+        self.assertRaises(MissingRenderMethod, Derived().renderer, "bar")
+        self.assertEqual(Base().renderer("foo")(None, None), "base")
+
+
+    def test_rendererChanged(self):
+        """
+        L{Element.renderer} finds render methods added to, replaced on or
+        removed from a class or its base after the class has been used.
+        """
+        class Base(Element):
+            def foo(self, request, tag):
+                return "foo"
+            renderer(foo)
+        class Derived(Base):
+            pass
+        element = Derived()
+        self.assertEqual(element.renderer("foo")(None, None), "foo")
+        self.assertRaises(MissingRenderMethod, element.renderer, "bar")
+        Base.foo = renderer(lambda self, request, tag: "replaced")
+        Derived.bar = renderer(lambda self, request, tag: "added")
+        self.assertEqual(element.renderer("foo")(None, None), "replaced")
+        self.assertEqual(element.renderer("bar")(None, None), "added")
+        Derived.foo = lambda self, request, tag: "hidden"
+        self.assertRaises(MissingRenderMethod, element.renderer, "foo")
+        del Derived.foo
+        del Base.foo
+        self.assertRaises(MissingRenderMethod, element.renderer, "foo")
+
+
+    def test_instanceRenderer(self):
+        """
+        L{Element.renderer} respects an instance attribute which shadows a
+        render method of the class.
+        """
+        class ElementWithRenderMethod(Element):
+            def foo(self, request, tag):
+                return "bar"
+            renderer(foo)
+        element = ElementWithRenderMethod()
+        self.assertEqual(element.renderer("foo")(None, None), "bar")
+        element.foo = lambda request, tag: "baz"
+        self.assertRaises(MissingRenderMethod, element.renderer, "foo")
+        element.foo = renderer(lambda request, tag: "baz")
+        self.assertEqual(element.renderer("foo")(None, None), "baz")
+
+
     def test_render(self):
         """
         L{Element.render} loads a document from the C{docFactory} attribute and
@@ -112,6 +182,19 @@ class ElementTests(TestCase):
         self.assertEqual(args, [(preproc,)])
 
 
+    def test_renderCompiled(self):
+        """
+        L{Element.render} returns a L{_CompiledDocument} for a document loaded
+        as a list, and the same one each time the same document is loaded.
+        """
+        element = Element(docFactory=stan(p["Hello, world!"]))
+        document = element.render(None)
+        self.assertEqual(document, ["<p>Hello, world!</p>"])
+        self.assertTrue(isinstance(document, _CompiledDocument))
+        self.assertIdentical(element.render(None), document)
+        self.assertIdentical(Element(element.docFactory).render(None), document)
+
+
     def test_overriddenRend(self):
         """
         If an L{Element} subclass overrides C{rend}, L{Element.render} calls
@@ -399,3 +482,231 @@ class FlattenIntegrationTests(TestCase):
         finished = self.assertFailure(finished, RuntimeError)
         result.errback(RuntimeError("test error"))
         return finished
+
+
+
+class RenderCacheTests(TestCase):
+    """
+    Tests for L{RenderCache}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = RenderCache(10, self.clock)
+
+
+    def test_getSet(self):
+        """
+        L{RenderCache.get} returns what was kept by L{RenderCache.set}, or
+        C{None} for a key with nothing kept.
+        """
+        self.assertIdentical(self.cache.get('a'), None)
+        self.cache.set('a', 'xyz')
+        self.assertEqual(self.cache.get('a'), 'xyz')
+        self.assertEqual(self.cache.size, 3)
+        self.cache.set('a', 'xy')
+        self.assertEqual(self.cache.get('a'), 'xy')
+        self.assertEqual(self.cache.size, 2)
+
+
+    def test_leastRecentlyUsedEvicted(self):
+        """
+        When more than C{maxSize} bytes are kept, the least recently used
+        output is discarded.
+        """
+        self.cache.set('a', 'aaaa')
+        self.cache.set('b', 'bbbb')
+        self.cache.get('a')
+        self.cache.set('c', 'cccc')
+        self.assertIdentical(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 'aaaa')
+        self.assertEqual(self.cache.get('c'), 'cccc')
+        self.assertEqual(self.cache.size, 8)
+
+
+    def test_tooLarge(self):
+        """
+        Output larger than C{maxSize} is not kept.
+        """
+        self.cache.set('a', 'x' * 11)
+        self.assertIdentical(self.cache.get('a'), None)
+        self.assertEqual(self.cache.size, 0)
+
+
+    def test_expiry(self):
+        """
+        Output kept with a TTL is discarded once that many seconds pass.
+        """
+        self.cache.set('a', 'xyz', 5)
+        self.clock.advance(4)
+        self.assertEqual(self.cache.get('a'), 'xyz')
+        self.clock.advance(1)
+        self.assertIdentical(self.cache.get('a'), None)
+        self.assertEqual(self.cache.size, 0)
+
+
+    def test_invalidate(self):
+        """
+        L{RenderCache.invalidate} discards output for one key and
+        L{RenderCache.clear} discards all of it.
+        """
+        self.cache.set('a', 'aa')
+        self.cache.set('b', 'bb')
+        self.cache.invalidate('a')
+        self.cache.invalidate('missing')
+        self.assertIdentical(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 'bb')
+        self.assertEqual(self.cache.size, 2)
+        self.cache.clear()
+        self.assertIdentical(self.cache.get('b'), None)
+        self.assertEqual(self.cache.size, 0)
+
+
+
+class RenderCacheMixinTests(TestCase):
+    """
+    Tests for L{RenderCacheMixin}.
+    """
+    def setUp(self):
+        self.renders = []
+        renders = self.renders
+        class Cached(RenderCacheMixin, Element):
+            renderCache = RenderCache()
+            docFactory = stan(p(render=directive('foo')))
+            def __init__(self, key, content='Hello'):
+                self.key = key
+                self.content = content
+            def cacheKey(self, request):
+                return self.key
+            def foo(self, request, tag):
+                renders.append(self.key)
+                return tag[self.content]
+            renderer(foo)
+        self.Cached = Cached
+
+
+    def _render(self, element):
+        return synchronousFlatten(element)
+
+
+    def test_cached(self):
+        """
+        An element with a cache key is rendered once and its output is reused
+        for any element with the same key.
+        """
+        self.assertEqual(self._render(self.Cached('a')), '<p>Hello</p>')
+        self.assertEqual(self._render(self.Cached('a', 'Bye')), '<p>Hello</p>')
+        self.assertEqual(self._render(self.Cached('b', 'Bye')), '<p>Bye</p>')
+        self.assertEqual(self.renders, ['a', 'b'])
+
+
+    def test_slots(self):
+        """
+        Slots inside a cached element are filled by tags inside it, and a
+        cached element may itself fill a slot.
+        """
+        inside = invisible[slot('x')].fillSlots('x', 'inside')
+        for i in range(2):
+            self.assertEqual(
+                self._render(self.Cached('a', inside)), '<p>inside</p>')
+        outside = invisible[slot('x')].fillSlots('x', self.Cached('b'))
+        self.assertEqual(self._render(outside), '<p>Hello</p>')
+        self.assertEqual(self._render(outside), '<p>Hello</p>')
+        self.assertEqual(self.renders, ['a', 'b'])
+
+
+    def test_enclosingSlots(self):
+        """
+        Slots inside a cached element are not filled by an enclosing tag,
+        whether or not its output is cached, just as for any other element.
+        """
+        for key in [None, 'a']:
+            outside = invisible[self.Cached(key, slot('x'))].fillSlots(
+                'x', 'outside')
+            err = self.assertRaises(FlattenerError, self._render, outside)
+            self.assertIsInstance(err._exception, UnfilledSlot)
+        self.assertIdentical(self.Cached.renderCache.get('a'), None)
+
+
+    def test_noKey(self):
+        """
+        An element whose cache key is C{None} is rendered every time.
+        """
+        self._render(self.Cached(None))
+        self._render(self.Cached(None))
+        self.assertEqual(self.renders, [None, None])
+
+
+    def test_ttl(self):
+        """
+        Output is cached for C{cacheTTL} seconds.
+        """
+        clock = Clock()
+        self.Cached.renderCache = RenderCache(clock=clock)
+        self.Cached.cacheTTL = 10
+        self._render(self.Cached('a'))
+        clock.advance(9)
+        self._render(self.Cached('a'))
+        clock.advance(1)
+        self._render(self.Cached('a'))
+        self.assertEqual(self.renders, ['a', 'a'])
+
+
+    def test_preventCaching(self):
+        """
+        Output is not cached if L{preventCaching} is called while rendering
+        it, by the element or anything inside it.
+        """
+        class Uncacheable(Element):
+            docFactory = stan(invisible(render=directive('foo')))
+            def foo(self, request, tag):
+                preventCaching()
+                return 'live'
+            renderer(foo)
+        outer = self.Cached('outer', Uncacheable())
+        self.assertEqual(self._render(outer), '<p>live</p>')
+        self._render(outer)
+        self.assertEqual(self.renders, ['outer', 'outer'])
+
+
+    def test_nested(self):
+        """
+        L{preventCaching} prevents the output of every enclosing cached
+        element from being cached, and cached elements may be nested.
+        """
+        class Uncacheable(Element):
+            docFactory = stan(invisible(render=directive('foo')))
+            def foo(self, request, tag):
+                preventCaching()
+                return 'live'
+            renderer(foo)
+        inner = self.Cached('inner', Uncacheable())
+        outer = self.Cached('outer', inner)
+        self.assertEqual(self._render(outer), '<p><p>live</p></p>')
+        self._render(outer)
+        self.assertEqual(self.renders, ['outer', 'inner', 'outer', 'inner'])
+        self._render(self.Cached('static', self.Cached('nested')))
+        self._render(self.Cached('static', self.Cached('nested')))
+        self.assertEqual(self.renders[4:], ['static', 'nested'])
+
+
+    def test_preventCachingAfterDeferred(self):
+        """
+        L{preventCaching} still applies when it is called by a render method
+        reached after flattening has waited for a L{Deferred}.
+        """
+        class Uncacheable(Element):
+            docFactory = stan(invisible(render=directive('foo')))
+            def foo(self, request, tag):
+                preventCaching()
+                return 'live'
+            renderer(foo)
+        waiting = Deferred()
+        results = []
+        element = self.Cached('outer', waiting)
+        finished = newFlatten(None, element, False, True, results.append)
+        waiting.callback(Uncacheable())
+        def cbFlattened(ignored):
+            self.assertEqual(''.join(results), '<p>live</p>')
+            self.assertIdentical(
+                self.Cached.renderCache.get('outer'), None)
+        return finished.addCallback(cbFlattened)
@@ -5,6 +5,9 @@
 Tests for L{nevow.json}.
 """
 
+import sys
+from StringIO import StringIO
+
 from zope.interface import implements
 
 from nevow.inevow import IAthenaTransportable
@@ -149,6 +152,116 @@ class JavascriptObjectNotationTestCase(unittest.TestCase):
             u"\f\b\n\t\r")
 
 
+    def test_tokenise(self):
+        """
+        L{json.tokenise} splits its input into tokens, discarding whitespace
+        and comments.
+        """
+        self.assertEqual(
+            json.tokenise(
+                '{"a\\"b" : [1, 2.5, true, false, null, undefined]}'
+                ' /* block\n comment */ // line comment\n'
+                'foo'),
+            ['{', '"a\\"b"', ':', '[', 1, ',', 2.5, ',', True, ',', False,
+             ',', None, ',', None, ']', '}', 'foo'])
+
+
+    def test_tokeniseTokenTypes(self):
+        """
+        L{json.tokenise} returns L{json.StringToken} for strings and
+        L{json.IdentifierToken} for bare identifiers.
+        """
+        tokens = json.tokenise('"true" foo')
+        self.assertEqual(tokens, ['"true"', 'foo'])
+        self.assertIdentical(type(tokens[0]), json.StringToken)
+        self.assertIdentical(type(tokens[1]), json.IdentifierToken)
+
+
+    def test_tokeniseInvalidInput(self):
+        """
+        L{json.tokenise} raises L{ValueError} naming the offending input when
+        it encounters something which is not a token, such as an unterminated
+        string.
+        """
+        exception = self.assertRaises(
+            ValueError, json.tokenise, '[1, "abc\\"]')
+        self.assertEqual(str(exception), "Invalid Input, '\"abc\\\\\"]'")
+
+
+    def test_parseLongString(self):
+        """
+        L{json.parse} handles strings containing many escape sequences.
+        """
+        value = u'\\"\n' * 100000
+        self.assertEqual(json.parse(json.serialize(value)), value)
+
+
+    def test_parseLongList(self):
+        """
+        L{json.parse} handles lists with many elements.
+        """
+        value = range(100000)
+        self.assertEqual(json.parse(json.serialize(value)), value)
+
+
+    def test_serializeDeeplyNested(self):
+        """
+        L{json.serialize} handles structures nested more deeply than the
+        recursion limit.
+        """
+        depth = sys.getrecursionlimit() * 2
+        value = []
+        for i in range(depth):
+            value = [{u'x': value}]
+        self.assertEqual(
+            json.serialize(value), '[{"x":' * depth + '[]' + '}]' * depth)
+
+
+    def test_serializeCycle(self):
+        """
+        L{json.serialize} raises L{json.CycleError} when passed a structure
+        which contains itself.
+        """
+        value = [1, 2]
+        value.append({u'value': value})
+        self.assertRaises(json.CycleError, json.serialize, value)
+
+
+    def test_serializeSharedReferences(self):
+        """
+        A structure which appears more than once, but not inside itself, is
+        serialized each time it appears.
+        """
+        shared = [1, {u'a': None}]
+        self.assertEqual(
+            json.serialize([shared, {u'b': shared}, shared]),
+            '[[1,{"a":null}],{"b":[1,{"a":null}]},[1,{"a":null}]]')
+
+
+    def test_serializeTo(self):
+        """
+        L{json.serializeTo} writes the serialized form of an object to the
+        given callable in chunks of about the given size.
+        """
+        value = [u'x' * 10] * 100
+        chunks = []
+        json.serializeTo(value, chunks.append, 100)
+        self.assertEqual(''.join(chunks), json.serialize(value))
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assertTrue(100 <= len(chunk) < 112)
+
+
+    def test_serializeToFile(self):
+        """
+        L{json.serializeTo} can write to a file.
+        """
+        value = {u'foo': [1, u'bar', None]}
+        f = StringIO()
+        json.serializeTo(value, f.write)
+        self.assertEqual(f.getvalue(), json.serialize(value))
+
+
     def _rendererTest(self, cls):
         self.assertEquals(
             json.serialize(
@@ -291,3 +404,167 @@ class JavascriptObjectNotationTestCase(unittest.TestCase):
         self.assertEqual(
             json.serialize(Transportable(u"Quux", (u"Foo",))),
             '(new Quux("Foo"))')
+
+
+    def test_serialized(self):
+        """
+        A L{json.Serialized} value is copied into the output as it is.
+        """
+        payload = json.Serialized(json.serialize([u'\N{SNOWMAN}', 1.5]))
+        self.assertEqual(
+            json.serialize((u'notify', {u'args': payload}, [payload])),
+            '["notify",{"args":["\xe2\x98\x83",1.5]},'
+            '[["\xe2\x98\x83",1.5]]]')
+
+
+
+class PythonCodecTests(JavascriptObjectNotationTestCase):
+    """
+    Like L{JavascriptObjectNotationTestCase}, but always using
+    L{json.PythonCodec}.
+    """
+    def setUp(self):
+        self.patch(json, 'codec', json.PythonCodec())
+
+
+
+class StdlibCodecTests(unittest.TestCase):
+    """
+    Tests for L{json.StdlibCodec}.
+    """
+    if not isinstance(json.codec, json.StdlibCodec):
+        skip = "The json C accelerator is not available."
+
+    def setUp(self):
+        self.python = json.PythonCodec()
+        self.stdlib = json.StdlibCodec()
+
+
+    def assertSameSerialization(self, obj):
+        """
+        Assert that both codecs serialize C{obj} to the same bytes.
+        """
+        self.assertEqual(self.stdlib.serialize(obj), self.python.serialize(obj))
+
+
+    def assertSameParse(self, s):
+        """
+        Assert that both codecs parse C{s} to equal values of the same types.
+        """
+        expected = self.python.parse(s)
+        result = self.stdlib.parse(s)
+        self.assertEqual(result, expected)
+        self.assertEqual(repr(result), repr(expected))
+
+
+    def test_serializePlainData(self):
+        """
+        L{json.StdlibCodec.serialize} produces the same output as
+        L{json.PythonCodec.serialize} for plain data.
+        """
+        for obj in TEST_OBJECTS + TEST_STRINGLIKE_OBJECTS:
+            self.assertSameSerialization(obj)
+        self.assertSameSerialization(
+            dict([(unicode(i), [i, 2 ** 70, (True, None)])
+                  for i in range(100)]))
+
+
+    def test_serializeFloats(self):
+        """
+        Floats are serialized the way L{json.PythonCodec} does, even where
+        C{repr} and C{str} disagree.
+        """
+        self.assertSameSerialization([0.1 + 0.2, 1e12, {u'x': [1.0 / 3]}])
+
+
+    def test_serializeNonUnicodeKeys(self):
+        """
+        Dictionaries with keys which are not unicode are serialized the way
+        L{json.PythonCodec} does.
+        """
+        self.assertSameSerialization({1: u'one', None: u'none'})
+
+
+    def test_serializeNevowValues(self):
+        """
+        Nevow-specific values nested in plain data are serialized by
+        L{json.PythonCodec} and the result is spliced into the output.
+        """
+        class Transportable(object):
+            implements(IAthenaTransportable)
+            jsClass = u'Foo'
+            def getInitialArguments(self):
+                return (1.5, u'\u2028')
+
+        fragment = rend.Fragment(docFactory=loaders.stan(
+            tags.p[u'Hello, \xe9.']))
+        self.assertSameSerialization(
+            [Transportable(), {u'fragment': fragment}, u'\xe9'])
+
+
+    def test_fallbackDoesNotRenderAgain(self):
+        """
+        When plain data nested too deeply for the C encoder is serialized by
+        L{json.PythonCodec} instead, Nevow-specific values which the C encoder
+        had already serialized are not serialized again.
+        """
+        calls = []
+        class Transportable(object):
+            implements(IAthenaTransportable)
+            jsClass = u'Foo'
+            def getInitialArguments(self):
+                calls.append(self)
+                return (1,)
+
+        nested = []
+        for i in xrange(sys.getrecursionlimit() * 2):
+            nested = [nested]
+        transportable = Transportable()
+        result = self.stdlib.serialize([transportable, nested])
+        self.assertEqual(calls, [transportable])
+        self.assertTrue(result.startswith('[(new Foo(1)),[[['))
+
+
+    def test_serializeByteString(self):
+        """
+        L{json.StdlibCodec.serialize} rejects byte strings just like
+        L{json.PythonCodec.serialize} does.
+        """
+        exception = self.assertRaises(TypeError, self.stdlib.serialize, ['x'])
+        self.assertEqual(
+            str(exception), "Unsupported type <type 'str'>: 'x'")
+
+
+    def test_serializeUnsupported(self):
+        """
+        L{json.StdlibCodec.serialize} raises L{TypeError} for unsupported
+        objects.
+        """
+        self.assertRaises(TypeError, self.stdlib.serialize, [object()])
+
+
+    def test_parsePlainData(self):
+        """
+        L{json.StdlibCodec.parse} produces the same values as
+        L{json.PythonCodec.parse} for plain data.
+        """
+        for obj in TEST_OBJECTS + TEST_STRINGLIKE_OBJECTS:
+            self.assertSameParse(self.python.serialize(obj))
+        self.assertSameParse('[1e10, -0, 1.5e3, 2.5, "\\u00e9\xc3\xa9\x01"]')
+
+
+    def test_parseExtensions(self):
+        """
+        L{json.StdlibCodec.parse} accepts the input L{json.PythonCodec.parse}
+        accepts beyond JSON.
+        """
+        self.assertSameParse('[undefined, /* comment */ 1] // comment\n')
+        self.assertSameParse('"\\xe9 \\/ \\ud800\\udc00"')
+
+
+    def test_parseConstants(self):
+        """
+        L{json.StdlibCodec.parse} rejects C{NaN} and C{Infinity}.
+        """
+        self.assertRaises(json.ParseError, self.stdlib.parse, 'NaN')
+        self.assertRaises(json.ParseError, self.stdlib.parse, '[Infinity]')
@@ -14,7 +14,9 @@ from twisted.internet.defer import Deferred, succeed
 
 from nevow.inevow import IRequest, IQ, IRenderable, IData
 from nevow._flat import FlattenerError, UnsupportedType, UnfilledSlot
-from nevow._flat import flatten, deferflatten
+from nevow._flat import flatten, deferflatten, escapedData
+from nevow._flat import _CompiledDocument, _compiledDocument
+from nevow import _flat
 from nevow.tags import Proto, Tag, slot, raw, xml
 from nevow.tags import invisible, br, div, directive
 from nevow.entities import nbsp
@@ -935,8 +937,134 @@ class FlattenTests(TestCase, FlattenMixin):
             # There are probably some frames above this, but I don't care what
             # they are.
             exc._traceback[-2:],
-            [(HERE, 927, 'render', 'broken()'),
-             (HERE, 920, 'broken', 'raise RuntimeError("foo")')])
+            [(HERE, 929, 'render', 'broken()'),
+             (HERE, 922, 'broken', 'raise RuntimeError("foo")')])
+
+
+
+class CompiledFlattenTests(FlattenTests):
+    """
+    Like L{FlattenTests}, but with each object to be flattened wrapped in a
+    L{_CompiledDocument}.
+    """
+    def flatten(self, root, request=None, inAttribute=False, inXML=False):
+        """
+        Helper to get a string from L{flatten} by way of a compiled program.
+        """
+        return FlattenTests.flatten(
+            self, _CompiledDocument([root]), request, inAttribute, inXML)
+
+
+    def test_unflattenable(self):
+        """
+        Flattening a compiled document which references an unflattenable
+        object fails with L{FlattenerError} which gives the unflattenable
+        object as the most deeply nested root and which has an
+        L{UnsupportedType} exception in its arguments.
+        """
+        unflattenable = object()
+        err = self.assertRaises(
+            FlattenerError, self.flatten, [([unflattenable],)])
+        self.assertIdentical(err._roots[-1], unflattenable)
+        self.assertTrue(isinstance(err.args[0], UnsupportedType))
+
+
+    def test_literalsJoined(self):
+        """
+        Adjacent static content is compiled to a single literal instruction.
+        """
+        document = _CompiledDocument([
+                div(id="x")[u"foo", raw("<br />"), nbsp],
+                slot("bar"), "baz", invisible["quux"]])
+        self.assertEqual(
+            [op for (op, arg) in document.getProgram(False, True)],
+            [_flat._LITERAL, _flat._SLOT, _flat._LITERAL])
+
+
+    def test_programCached(self):
+        """
+        L{_CompiledDocument.getProgram} compiles a program once for each
+        combination of quoting flags.
+        """
+        document = _CompiledDocument(["<>"])
+        program = document.getProgram(False, True)
+        self.assertIdentical(document.getProgram(False, True), program)
+        self.assertEqual(program, [(_flat._LITERAL, "&lt;&gt;")])
+        self.assertEqual(
+            document.getProgram(False, False), [(_flat._LITERAL, "<>")])
+
+
+    def test_compiledDocumentPerDocFactory(self):
+        """
+        L{_compiledDocument} returns the same L{_CompiledDocument} for a
+        docFactory as long as it keeps loading the same document, and a new
+        one once it loads a different document.
+        """
+        docFactory = stan(div["foo"])
+        document = docFactory.load()
+        compiled = _compiledDocument(docFactory, document)
+        self.assertEqual(compiled, document)
+        self.assertIdentical(compiled.document, document)
+        self.assertIdentical(
+            _compiledDocument(docFactory, document), compiled)
+        newDocument = list(document)
+        newCompiled = _compiledDocument(docFactory, newDocument)
+        self.assertNotIdentical(newCompiled, compiled)
+        self.assertIdentical(newCompiled.document, newDocument)
+
+
+    def test_compiledDocumentNotList(self):
+        """
+        L{_compiledDocument} returns documents which are not lists unchanged.
+        """
+        tag = div["foo"]
+        self.assertIdentical(_compiledDocument(stan(tag), tag), tag)
+
+
+
+class EscapedDataTests(TestCase):
+    """
+    Tests for L{escapedData}.
+    """
+    def test_notEscaped(self):
+        """
+        Outside of XML and attributes, L{escapedData} returns its input.
+        """
+        data = '<a href="x">&</a>'
+        self.assertIdentical(escapedData(data, False, False), data)
+
+
+    def test_nothingToEscape(self):
+        """
+        A short string with no characters needing escaping is returned by
+        L{escapedData} without being copied.
+        """
+        data = 'hello, world'
+        self.assertIdentical(escapedData(data, False, True), data)
+        self.assertIdentical(escapedData(data, True, True), data)
+
+
+    def test_quoteOutsideAttribute(self):
+        """
+        A double quote is only escaped in an attribute.
+        """
+        self.assertEqual(escapedData('"', False, True), '"')
+        self.assertEqual(escapedData('"', True, True), '&quot;')
+
+
+    def test_escaped(self):
+        """
+        L{escapedData} escapes C{&}, C{<} and C{>} in XML, and C{"} as well
+        in an attribute, for both short and long strings.
+        """
+        for padding in ['', 'x' * _flat._PRECHECK_LENGTH]:
+            data = padding + '<a href="x">&amp;</a>'
+            self.assertEqual(
+                escapedData(data, False, True),
+                padding + '&lt;a href="x"&gt;&amp;amp;&lt;/a&gt;')
+            self.assertEqual(
+                escapedData(data, True, True),
+                padding + '&lt;a href=&quot;x&quot;&gt;&amp;amp;&lt;/a&gt;')
 
 
 
@@ -1349,3 +1477,107 @@ class DeferflattenTests(TestCase, FlattenMixin):
         finished.addCallback(lambda ignored: "".join(result))
         finished.addCallback(self.assertStringEqual, '"&amp;&lt;&gt;')
         return finished
+
+
+    def test_buffered(self):
+        """
+        If a buffer size is passed to L{deferflatten}, output is passed to the
+        write function in strings of at least that many bytes, except for the
+        last one.
+        """
+        result = []
+        finished = deferflatten(
+            None, [div(id="x")["abc" * 10] for i in range(100)],
+            False, True, result.append, 100)
+        def cbFinished(ignored):
+            self.assertEqual(
+                "".join(result),
+                "".join(['<div id="x">' + "abc" * 10 + '</div>'] * 100))
+            for data in result[:-1]:
+                self.assertTrue(len(data) >= 100)
+            self.assertTrue(len(result[-1]) > 0)
+        finished.addCallback(cbFinished)
+        return finished
+
+
+    def test_bufferedUntilFinished(self):
+        """
+        Buffered output smaller than the buffer size is passed to the write
+        function in one string when flattening finishes.
+        """
+        result = []
+        finished = deferflatten(
+            None, div["foo", succeed("bar"), "baz"], False, True,
+            result.append, 1024)
+        finished.addCallback(
+            lambda ignored: self.assertEqual(result, ["<div>foobarbaz</div>"]))
+        return finished
+
+
+    def test_bufferedFlushedBeforeWaiting(self):
+        """
+        Buffered output is passed to the write function before flattening
+        waits for a L{Deferred} which has not fired yet.
+        """
+        result = []
+        deferred = Deferred()
+        finished = deferflatten(
+            None, div["foo", deferred, "baz"], False, True,
+            result.append, 1024)
+        self.assertEqual(result, ["<div>foo"])
+        deferred.callback("bar")
+        finished.addCallback(
+            lambda ignored: self.assertEqual(
+                result, ["<div>foo", "barbaz</div>"]))
+        return finished
+
+
+    def test_bufferedFlushedOnError(self):
+        """
+        Buffered output is passed to the write function if flattening fails.
+        """
+        result = []
+        finished = deferflatten(
+            None, div["foo", object()], False, True, result.append, 1024)
+        finished = self.assertFailure(finished, FlattenerError)
+        finished.addCallback(
+            lambda ignored: self.assertEqual(result, ["<div>foo"]))
+        return finished
+
+
+    def test_firedDeferredsNotScheduled(self):
+        """
+        L{Deferred}s which have already fired are flattened without involving
+        the scheduler, so flattening a structure containing only those
+        completes synchronously, however many there are.
+        """
+        scheduled = []
+        result = []
+        limit = sys.getrecursionlimit()
+        finished = deferflatten(
+            None, [succeed("x") for i in range(limit * 2)], False, True,
+            result.append, schedule=lambda *a: scheduled.append(a))
+        self.assertEqual(scheduled, [])
+        self.assertEqual("".join(result), "x" * (limit * 2))
+        return finished
+
+
+    def test_pendingDeferredScheduled(self):
+        """
+        Once a L{Deferred} which had not fired when flattening reached it
+        fires, flattening is resumed by way of the scheduler.
+        """
+        scheduled = []
+        result = []
+        deferred = Deferred()
+        finished = deferflatten(
+            None, ["foo", deferred, "baz"], False, True, result.append,
+            schedule=lambda f, *a: scheduled.append((f, a)))
+        self.assertEqual(result, ["foo"])
+        self.assertEqual(scheduled, [])
+        deferred.callback("bar")
+        self.assertEqual(result, ["foo"])
+        [(f, args)] = scheduled
+        f(*args)
+        self.assertEqual(result, ["foo", "bar", "baz"])
+        return finished
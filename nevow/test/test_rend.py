@@ -18,6 +18,7 @@ from nevow.stan import slot
 from nevow.tags import directive, p, html, ul, li, span, table, tr, th, td
 from nevow.tags import div, invisible, head, title, strong, body, a
 from nevow import testutil
+from nevow._flat import BUFFER_SIZE
 from nevow import url
 from nevow import util
 
@@ -355,6 +356,101 @@ class TestPage(unittest.TestCase):
             lambda result:
             self.assertEquals(result, '<html><head><title>test</title></head></html>'))
 
+
+    def _renderWrites(self, page):
+        """
+        Render C{page}, recording the non-empty strings written to the
+        request.
+
+        @return: A two-tuple of the C{list} of writes, and a L{Deferred} which
+            fires when rendering is done.
+        """
+        request = testutil.FakeRequest()
+        request.d = defer.Deferred()
+        writes = []
+        write = request.write
+        def recordingWrite(data):
+            if data:
+                writes.append(data)
+            write(data)
+        request.write = recordingWrite
+        return writes, deferredRender(page, request)
+
+
+    def test_writeBuffered(self):
+        """
+        A page is written to the request in strings of about
+        C{writeBufferSize} bytes, rather than a piece at a time between the
+        L{Deferred}s in it which have already fired.
+        """
+        class Page(rend.Page):
+            writeBufferSize = BUFFER_SIZE
+            docFactory = loaders.stan(
+                div[[p[defer.succeed(str(i))] for i in range(5)]])
+        writes, d = self._renderWrites(Page())
+        def rendered(result):
+            self.assertEqual(
+                result,
+                '<div><p>0</p><p>1</p><p>2</p><p>3</p><p>4</p></div>')
+            self.assertEqual(len(writes), 1)
+        return d.addCallback(rendered)
+
+
+    def test_writeBufferedBeforeWaiting(self):
+        """
+        Whatever has been flattened is written before waiting for a
+        L{Deferred}.
+        """
+        waiting = defer.Deferred()
+        class Page(rend.Page):
+            writeBufferSize = BUFFER_SIZE
+            docFactory = loaders.stan(div[p['before'], waiting, p['after']])
+        writes, d = self._renderWrites(Page())
+        self.assertEqual(writes, ['<div><p>before</p>'])
+        waiting.callback('waited')
+        def rendered(result):
+            self.assertEqual(writes, ['<div><p>before</p>',
+                                      'waited<p>after</p></div>'])
+        return d.addCallback(rendered)
+
+
+    def test_writeUnbuffered(self):
+        """
+        A page whose C{writeBufferSize} is C{None}, as it is by default, is
+        written a piece at a time.
+        """
+        class Page(rend.Page):
+            docFactory = loaders.stan(
+                div[[p[defer.succeed(str(i))] for i in range(5)]])
+        writes, d = self._renderWrites(Page())
+        def rendered(result):
+            self.assertEqual(
+                result,
+                '<div><p>0</p><p>1</p><p>2</p><p>3</p><p>4</p></div>')
+            self.assertEqual(len(writes), 6)
+        return d.addCallback(rendered)
+
+
+    def test_flattenFactoryUnchanged(self):
+        """
+        Unless C{writeBufferSize} is set, L{rend.Page.flattenFactory} is
+        called with the same four arguments as always, so that overrides of
+        it keep working.
+        """
+        calls = []
+        class Page(rend.Page):
+            docFactory = loaders.stan(div['hello'])
+            def flattenFactory(self, doc, ctx, writer, finisher):
+                calls.append(doc)
+                return rend.Page.flattenFactory(
+                    self, doc, ctx, writer, finisher)
+        writes, d = self._renderWrites(Page())
+        def rendered(result):
+            self.assertEqual(result, '<div>hello</div>')
+            self.assertEqual(len(calls), 1)
+        return d.addCallback(rendered)
+
+
     def test_component(self):
         """
         Test that the data is remembered correctly when a Page is embedded in
@@ -524,6 +620,63 @@ class TestRenderFactory(unittest.TestCase):
         ctx.remember(rend.RenderFactory(), inevow.IRendererFactory)
         self.assertEquals(flat.flatten(p(data='foo', render=directive('data')), ctx), '<p>foo</p>')
 
+    def test_subclassRenderer(self):
+        """
+        L{RenderFactory.renderer} finds render methods overridden by a subclass
+        and on the instance after the same name has been looked up on the base
+        class.
+        """
+        class Base(rend.RenderFactory):
+            def render_foo(self, ctx, data):
+                return "base"
+        class Derived(Base):
+            def render_foo(self, ctx, data):
+                return "derived"
+        ctx = context.WovenContext()
+        self.assertEquals(Base().renderer(ctx, 'foo')(ctx, None), "base")
+        self.assertEquals(Derived().renderer(ctx, 'foo')(ctx, None), "derived")
+        instance = Base()
+        instance.render_foo = lambda ctx, data: "instance"
+        self.assertEquals(instance.renderer(ctx, 'foo')(ctx, None), "instance")
+
+
+    def test_rendererChanged(self):
+        """
+        L{RenderFactory.renderer} finds render methods added to or replaced on
+        a class after the same directive has been looked up.
+        """
+        class Factory(rend.RenderFactory):
+            def render_foo(self, ctx, data):
+                return "foo"
+        ctx = context.WovenContext()
+        factory = Factory()
+        self.assertEquals(factory.renderer(ctx, 'foo')(ctx, None), "foo")
+        factory.renderer(ctx, 'bar')
+        self.assertEquals(len(self.flushWarnings()), 1)
+        Factory.render_foo = lambda self, ctx, data: "replaced"
+        Factory.render_bar = lambda self, ctx, data: "added"
+        self.assertEquals(factory.renderer(ctx, 'foo')(ctx, None), "replaced")
+        self.assertEquals(factory.renderer(ctx, 'bar')(ctx, None), "added")
+        self.assertEquals(self.flushWarnings(), [])
+
+
+    def test_parameterizedRenderer(self):
+        """
+        L{RenderFactory.renderer} calls a parameterized render method with the
+        directive's arguments each time the directive is looked up.
+        """
+        calls = []
+        class Factory(rend.RenderFactory):
+            def render_foo(self, *args):
+                calls.append(args)
+                return args
+        ctx = context.WovenContext()
+        factory = Factory()
+        self.assertEquals(factory.renderer(ctx, 'foo a, b'), ('a', 'b'))
+        self.assertEquals(factory.renderer(ctx, 'foo a, b'), ('a', 'b'))
+        self.assertEquals(factory.renderer(ctx, 'foo c'), ('c',))
+        self.assertEquals(calls, [('a', 'b'), ('a', 'b'), ('c',)])
+
 class TestConfigurableMixin(unittest.TestCase):
     def test_formRender(self):
         class FormPage(rend.Page):
@@ -1,6 +1,10 @@
 from twisted.trial import unittest
+from twisted.internet import defer, protocol, reactor
+from twisted.web import http
+from twisted.python import failure, threadpool
+from twisted.test.proto_helpers import StringTransport
 import os
-from nevow import static, util, context, testutil
+from nevow import static, util, context, testutil, appserver
 
 
 def deferredRender(res, req):
@@ -145,3 +149,912 @@ class Range(unittest.TestCase):
             lambda r: self.assertEquals(
                 r.responseHeaders.getRawHeaders('content-range'),
                 ['bytes 0-7999/8000']))
+
+    def _render(self, range, **headers):
+        """
+        Render the file for a new request with the given Range header.
+
+        @return: A L{Deferred} which fires with the request.
+        """
+        self.request = testutil.FakeRequest()
+        self.request.requestHeaders.setRawHeaders('range', [range])
+        for (name, value) in headers.items():
+            self.request.requestHeaders.setRawHeaders(
+                name.replace('_', '-'), [value])
+        return deferredRender(self.file, self.request)
+
+    def test_suffix(self):
+        """
+        A suffix range is the given number of bytes at the end of the file.
+        """
+        def cbRendered(r):
+            self.assertEquals(r.v, '56789')
+            self.assertEquals(
+                r.responseHeaders.getRawHeaders('content-range'),
+                ['bytes 7995-7999/8000'])
+        return self._render('bytes=-5').addCallback(cbRendered)
+
+    def test_unsatisfiable(self):
+        """
+        A request for ranges which are all beyond the end of the file is
+        answered with Requested Range Not Satisfiable.
+        """
+        def cbRendered(r):
+            self.assertEquals(r.code, http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.assertEquals(r.v, '')
+            self.assertEquals(
+                r.responseHeaders.getRawHeaders('content-range'),
+                ['bytes */8000'])
+        return self._render('bytes=8000-,9000-9001').addCallback(cbRendered)
+
+    def test_invalid(self):
+        """
+        An invalid Range header is ignored.
+        """
+        def cbRendered(r):
+            self.assertEquals(r.code, http.OK)
+            self.assertEquals(len(r.v), 8000)
+            self.assertEquals(
+                r.responseHeaders.getRawHeaders('content-range'), None)
+        d = self._render('bytes=5-2')
+        d.addCallback(cbRendered)
+        d.addCallback(lambda ignored: self._render('lines=1-2'))
+        d.addCallback(cbRendered)
+        return d
+
+    def test_multipart(self):
+        """
+        A request for several ranges is answered with a multipart/byteranges
+        response with a part for each.
+        """
+        def cbRendered(r):
+            self.assertEquals(r.code, http.PARTIAL_CONTENT)
+            [contentType] = r.responseHeaders.getRawHeaders('content-type')
+            prefix = 'multipart/byteranges; boundary='
+            self.assertTrue(contentType.startswith(prefix))
+            boundary = contentType[len(prefix):]
+            self.assertEquals(r.v, (
+                '\r\n--%(b)s\r\n'
+                'Content-Type: text/html\r\n'
+                'Content-Range: bytes 0-1/8000\r\n\r\n'
+                '01'
+                '\r\n--%(b)s\r\n'
+                'Content-Type: text/html\r\n'
+                'Content-Range: bytes 7998-7999/8000\r\n\r\n'
+                '89'
+                '\r\n--%(b)s--\r\n') % {'b': boundary})
+            self.assertEquals(
+                r.responseHeaders.getRawHeaders('content-length'),
+                [str(len(r.v))])
+        return self._render('bytes=0-1, -2').addCallback(cbRendered)
+
+    def test_multipartShortFile(self):
+        """
+        If the file becomes shorter than a multipart/byteranges response
+        promised, the connection is dropped without the closing boundary.
+        """
+        request = _PushRequest()
+        request.transport = StringTransport()
+        transfer = static.MultipartFileTransfer(
+            file(self.file.fp.path, 'rb'),
+            [('<1>', 0, 2), ('<2>', 7998, 4)], '<end>', request)
+        for i in range(4):
+            transfer.resumeProducing()
+        self.assertTrue(request.transport.disconnecting)
+        self.assertEquals(request.v, '<1>01<2>89')
+        self.assertTrue(transfer.file.closed)
+        self.assertFalse(request.finished)
+
+    def test_merged(self):
+        """
+        Overlapping and adjacent ranges are sent as one.
+        """
+        def cbRendered(r):
+            self.assertEquals(r.v, '0123456789')
+            self.assertEquals(
+                r.responseHeaders.getRawHeaders('content-range'),
+                ['bytes 0-9/8000'])
+        return self._render('bytes=5-9,0-4,3-6').addCallback(cbRendered)
+
+    def test_tooManyRanges(self):
+        """
+        The whole file is sent for a request for more than C{maxRanges}
+        ranges.
+        """
+        self.file.maxRanges = 1
+        def cbRendered(r):
+            self.assertEquals(r.code, http.OK)
+            self.assertEquals(len(r.v), 8000)
+        return self._render('bytes=0-1,10-11').addCallback(cbRendered)
+
+    def test_ifRange(self):
+        """
+        The Range header is honoured if the entity tag or modification time
+        in the If-Range header is the file's, and ignored otherwise.
+        """
+        os.utime(self.file.fp.path, (1000, 1000))
+        ino = os.stat(self.file.fp.path).st_ino
+        etag = '"%x-1f40-3e8"' % (ino,)
+        def cbPartial(r):
+            self.assertEquals(r.code, http.PARTIAL_CONTENT)
+            self.assertEquals(r.v, '01')
+        def cbWhole(r):
+            self.assertEquals(r.code, http.OK)
+            self.assertEquals(len(r.v), 8000)
+        def render(condition):
+            return self._render('bytes=0-1', if_range=condition)
+        d = render(etag)
+        d.addCallback(cbPartial)
+        d.addCallback(lambda ignored: render(http.datetimeToString(1000)))
+        d.addCallback(cbPartial)
+        d.addCallback(lambda ignored: render('"other"'))
+        d.addCallback(cbWhole)
+        d.addCallback(lambda ignored: render('W/' + etag))
+        d.addCallback(cbWhole)
+        d.addCallback(lambda ignored: render(http.datetimeToString(2000)))
+        d.addCallback(cbWhole)
+        return d
+
+
+
+class ParseRange(unittest.TestCase):
+    """
+    Tests for L{static.parseRange}.
+    """
+    def test_ranges(self):
+        """
+        The satisfiable ranges are returned in order, limited to the entity.
+        """
+        self.assertEquals(
+            static.parseRange('bytes=10-, 0-0, -3, 200-300', 100),
+            [(0, 0), (10, 99)])
+        self.assertEquals(static.parseRange('bytes=-500', 100), [(0, 99)])
+        self.assertEquals(static.parseRange('bytes=100-', 100), [])
+
+    def test_invalid(self):
+        """
+        C{None} is returned for invalid range sets.
+        """
+        for header in ['bytes', 'bytes=', 'bytes=-', 'bytes=a-b',
+                       'bytes=1-2-3', 'bytes=+1-2', 'items=1-2']:
+            self.assertIdentical(static.parseRange(header, 100), None, header)
+
+
+
+class Validation(unittest.TestCase):
+    """
+    Tests for the entity tags of L{static.File} and the conditional requests
+    they validate.
+    """
+    def setUp(self):
+        self.path = self.mktemp()
+        f = file(self.path, 'w')
+        f.write('content')
+        f.close()
+        os.utime(self.path, (1000, 1000))
+        self.etag = '"%x-7-3e8"' % (os.stat(self.path).st_ino,)
+
+    def _render(self, **headers):
+        request = testutil.FakeRequest(headers=dict([
+            (name.replace('_', '-'), value)
+            for (name, value) in headers.items()]))
+        return deferredRender(static.File(self.path), request)
+
+    def test_etag(self):
+        """
+        The entity tag of a file is made from its inode number, size and
+        modification time, and is weak if it was modified in the last second.
+        """
+        def cbStrong(r):
+            self.assertEquals(
+                r.responseHeaders.getRawHeaders('etag'), [self.etag])
+            os.utime(self.path, None)
+            return self._render()
+        def cbWeak(r):
+            [etag] = r.responseHeaders.getRawHeaders('etag')
+            self.assertTrue(etag.startswith('W/"'))
+        return self._render().addCallback(cbStrong).addCallback(cbWeak)
+
+    def test_ifNoneMatch(self):
+        """
+        A request whose If-None-Match header lists the file's entity tag, or a
+        weak version of it, is answered with Not Modified.
+        """
+        def cbRendered(r):
+            self.assertEquals(r.code, http.NOT_MODIFIED)
+            self.assertEquals(r.v, '')
+        d = self._render(if_none_match='"other", %s' % (self.etag,))
+        d.addCallback(cbRendered)
+        d.addCallback(lambda ignored: self._render(
+            if_none_match='W/' + self.etag))
+        d.addCallback(cbRendered)
+        return d
+
+    def test_ifNoneMatchFailed(self):
+        """
+        If-Modified-Since is ignored in favour of an If-None-Match header which
+        does not list the file's entity tag.
+        """
+        def cbRendered(r):
+            self.assertEquals(r.code, http.OK)
+            self.assertEquals(r.v, 'content')
+            self.assertEquals(
+                r.responseHeaders.getRawHeaders('last-modified'),
+                [http.datetimeToString(1000)])
+        return self._render(
+            if_none_match='"other"',
+            if_modified_since=http.datetimeToString(2000)).addCallback(
+            cbRendered)
+
+
+
+class _BodyReceiver(protocol.Protocol):
+    """
+    Protocol which sends an HTTP/1.0 request and collects the response.
+    """
+    def __init__(self, request):
+        self.request = request
+        self.received = []
+        self.done = defer.Deferred()
+
+
+    def connectionMade(self):
+        self.transport.write(self.request)
+
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+
+    def connectionLost(self, reason):
+        self.done.callback(''.join(self.received))
+
+
+
+class Sendfile(unittest.TestCase):
+    """
+    Tests for serving files with L{static.SendfileTransfer}.
+    """
+    def setUp(self):
+        self.tmpdir = self.mktemp()
+        os.mkdir(self.tmpdir)
+        self.content = ''.join([chr(i % 251) for i in xrange(3 * 2 ** 20)])
+        f = file(os.path.join(self.tmpdir, 'junk'), 'wb')
+        f.write(self.content)
+        f.close()
+        self.sent = []
+        self.patch(static, '_sendfile', self._sendfile)
+
+
+    def _sendfile(self, out, in_, offset, count):
+        """
+        Stand-in for C{os.sendfile}, which Python 2 does not have.
+        """
+        self.sent.append(count)
+        os.lseek(in_, offset, 0)
+        return os.write(out, os.read(in_, count))
+
+
+    def _get(self, headers=''):
+        """
+        Serve the directory over TCP and request the file from it.
+
+        @return: A L{Deferred} which fires with the response.
+        """
+        site = appserver.NevowSite(static.File(self.tmpdir))
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        receiver = _BodyReceiver('GET /junk HTTP/1.0\r\n%s\r\n' % (headers,))
+        protocol.ClientCreator(reactor, lambda: receiver).connectTCP(
+            '127.0.0.1', port.getHost().port)
+        return receiver.done
+
+
+    def test_wholeFile(self):
+        """
+        The whole of a file is sent with C{sendfile}, after the headers.
+        """
+        def cbResponse(response):
+            headers, body = response.split('\r\n\r\n', 1)
+            self.assertIn('\r\ncontent-length: %d\r\n' % (
+                len(self.content),), headers.lower())
+            self.assertEqual(body, self.content)
+            self.assertTrue(self.sent)
+        return self._get().addCallback(cbResponse)
+
+
+    def test_range(self):
+        """
+        A range of a file is sent with C{sendfile}.
+        """
+        def cbResponse(response):
+            headers, body = response.split('\r\n\r\n', 1)
+            self.assertTrue(headers.startswith('HTTP/1.0 206 '))
+            self.assertEqual(body, self.content[1000:2 ** 20 + 1000])
+            self.assertTrue(self.sent)
+        return self._get('Range: bytes=1000-%d\r\n' % (2 ** 20 + 999,)
+                         ).addCallback(cbResponse)
+
+
+    def test_transportInternals(self):
+        """
+        The TCP transports of the version of Twisted in use have the
+        attributes which L{static.SendfileTransfer} relies on.
+        """
+        connected = defer.Deferred()
+        class Server(protocol.Protocol):
+            def connectionMade(self):
+                connected.callback(self.transport)
+        factory = protocol.ServerFactory()
+        factory.protocol = Server
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        protocol.ClientCreator(reactor, protocol.Protocol).connectTCP(
+            '127.0.0.1', port.getHost().port).addCallback(
+            lambda client: self.addCleanup(client.transport.loseConnection))
+        def cbConnected(transport):
+            transport.loseConnection()
+            self.assertEqual(
+                [name for name in static._TRANSPORT_INTERNALS
+                 if not hasattr(transport, name)],
+                [])
+        return connected.addCallback(cbConnected)
+
+
+    def test_missingTransportInternals(self):
+        """
+        If the transport lacks an attribute which L{static.SendfileTransfer}
+        relies on, the file is sent without C{sendfile}.
+        """
+        self.patch(static, '_TRANSPORT_INTERNALS',
+                   static._TRANSPORT_INTERNALS + ('_noSuchAttribute',))
+        def cbResponse(response):
+            headers, body = response.split('\r\n\r\n', 1)
+            self.assertEqual(body, self.content)
+            self.assertEqual(self.sent, [])
+        return self._get().addCallback(cbResponse)
+
+
+    def test_notSocket(self):
+        """
+        Responses to requests which are not written directly to a socket are
+        sent without C{sendfile}.
+        """
+        f = static.File(os.path.join(self.tmpdir, 'junk'))
+        request = testutil.FakeRequest()
+        def cbRendered(request):
+            self.assertEqual(request.v, self.content)
+            self.assertEqual(self.sent, [])
+        return deferredRender(f, request).addCallback(cbRendered)
+
+
+
+class Cache(unittest.TestCase):
+    """
+    Tests for L{static.File} with a L{static.FileCache}.
+    """
+    def setUp(self):
+        self.tmpdir = self.mktemp()
+        os.mkdir(self.tmpdir)
+        self.now = 5000.0
+        self.cache = static.FileCache(maxBytes=100, maxFileSize=50)
+        self.cache.time = lambda: self.now
+        self.registry = static.Registry(fileCache=self.cache)
+
+
+    def _write(self, name, content, mtime=1000):
+        """
+        Write a file in the temporary directory, modified at C{mtime}.
+
+        @return: The absolute path of the file.
+        """
+        path = os.path.abspath(os.path.join(self.tmpdir, name))
+        f = file(path, 'wb')
+        f.write(content)
+        f.close()
+        os.utime(path, (mtime, mtime))
+        return path
+
+
+    def _render(self, name, **kw):
+        """
+        Render the file C{name} in the temporary directory.
+
+        @return: A L{Deferred} which fires with the request.
+        """
+        resource = static.File(
+            os.path.join(self.tmpdir, name), registry=self.registry)
+        return deferredRender(resource, testutil.FakeRequest(**kw))
+
+
+    def test_cached(self):
+        """
+        A small file is served from the cache, with an entity tag, until it
+        has changed and C{revalidateInterval} has passed.
+        """
+        path = self._write('small.txt', 'hello')
+        d = self._render('small.txt')
+        def cbFirst(request):
+            self.assertEqual(request.v, 'hello')
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('content-type'),
+                ['text/plain'])
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('content-length'),
+                ['5'])
+            self.assertEqual(request.lastModified, 1000)
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('etag'),
+                ['"%x-5-3e8"' % (os.stat(path).st_ino,)])
+            self.assertEqual(self.cache.size, 5)
+            self._write('small.txt', 'goodbye', 2000)
+            return self._render('small.txt')
+        def cbStale(request):
+            self.assertEqual(request.v, 'hello')
+            self.now += self.cache.revalidateInterval
+            return self._render('small.txt')
+        def cbChanged(request):
+            self.assertEqual(request.v, 'goodbye')
+            self.assertEqual(request.lastModified, 2000)
+            self.assertEqual(self.cache.size, 7)
+        d.addCallback(cbFirst)
+        d.addCallback(cbStale)
+        d.addCallback(cbChanged)
+        return d
+
+
+    def test_weakTagRevalidated(self):
+        """
+        The weak entity tag of a file modified less than a second before it
+        was cached becomes strong when the file is found unchanged later, as
+        it would if the file were not cached.
+        """
+        path = self._write('small.txt', 'hello', self.now - 0.5)
+        tag = '"%x-5-1387"' % (os.stat(path).st_ino,)
+        d = self._render('small.txt')
+        def cbWeak(request):
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('etag'), ['W/' + tag])
+            self.now += self.cache.revalidateInterval
+            return self._render('small.txt')
+        def cbStrong(request):
+            self.assertEqual(request.v, 'hello')
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('etag'), [tag])
+        d.addCallback(cbWeak)
+        d.addCallback(cbStrong)
+        return d
+
+
+    def test_evicted(self):
+        """
+        The least recently used files are dropped from the cache to keep it
+        within C{maxBytes}.
+        """
+        first = self._write('first', 'x' * 40)
+        second = self._write('second', 'y' * 40)
+        self._write('third', 'z' * 40)
+        d = self._render('first')
+        d.addCallback(lambda ignored: self._render('second'))
+        d.addCallback(lambda ignored: self._render('first'))
+        d.addCallback(lambda ignored: self._render('third'))
+        def cbRendered(request):
+            self.assertEqual(request.v, 'z' * 40)
+            self.assertEqual(self.cache.size, 80)
+            self.assertNotIdentical(self.cache.get(first), None)
+            self.assertIdentical(self.cache.get(second), None)
+        return d.addCallback(cbRendered)
+
+
+    def test_notCached(self):
+        """
+        Files larger than C{maxFileSize}, and requests for ranges, are served
+        from the file.
+        """
+        self._write('large', 'x' * 51)
+        self._write('small', 'y' * 10)
+        d = self._render('large')
+        def cbLarge(request):
+            self.assertEqual(request.v, 'x' * 51)
+            return self._render('small', headers={'range': 'bytes=2-3'})
+        def cbRange(request):
+            self.assertEqual(request.v, 'yy')
+            self.assertEqual(self.cache.size, 0)
+        d.addCallback(cbLarge)
+        d.addCallback(cbRange)
+        return d
+
+
+    def test_locateCached(self):
+        """
+        L{static.File.locateChild} finds a cached file, but not one which has
+        a processor.
+        """
+        path = self._write('cached.txt', 'hello')
+        self.cache.load(static.File(path))
+        directory = static.File(self.tmpdir, registry=self.registry)
+        child, segments = directory.locateChild(None, ('cached.txt', 'x'))
+        self.assertEqual(child.fp.path, path)
+        self.assertEqual(segments, ('x',))
+        directory.processors = {'.txt': lambda path, registry: static.Data(
+            'processed', 'text/plain')}
+        child, segments = directory.locateChild(None, ('cached.txt',))
+        self.assertIsInstance(child, static.Data)
+
+
+
+class Precompressed(unittest.TestCase):
+    """
+    Tests for serving the precompressed copies of files.
+    """
+    def setUp(self):
+        self.tmpdir = self.mktemp()
+        os.mkdir(self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'script.js')
+        for (name, content) in [('script.js', 'plain' * 10),
+                                ('script.js.gz', 'gzipped'),
+                                ('script.js.br', 'brotli')]:
+            f = file(os.path.join(self.tmpdir, name), 'wb')
+            f.write(content)
+            f.close()
+
+
+    def _render(self, acceptEncoding=None, **kw):
+        """
+        Render C{self.path} for a request with the given Accept-Encoding.
+
+        @return: A L{Deferred} which fires with the request.
+        """
+        resource = static.File(self.path, **kw)
+        headers = {}
+        if acceptEncoding is not None:
+            headers['accept-encoding'] = acceptEncoding
+        return deferredRender(
+            resource, testutil.FakeRequest(headers=headers))
+
+
+    def _header(self, request, name):
+        return request.responseHeaders.getRawHeaders(name, [None])[0]
+
+
+    def test_gzip(self):
+        """
+        The gzipped copy of a file is served to clients which accept gzip, with
+        the file's content type.
+        """
+        def cbRendered(request):
+            self.assertEqual(request.v, 'gzipped')
+            self.assertEqual(self._header(request, 'content-encoding'), 'gzip')
+            self.assertEqual(self._header(request, 'content-length'), '7')
+            self.assertEqual(
+                self._header(request, 'content-type'),
+                static.File.contentTypes['.js'])
+            self.assertEqual(self._header(request, 'vary'), 'accept-encoding')
+        return self._render('deflate, gzip').addCallback(cbRendered)
+
+
+    def test_notAccepted(self):
+        """
+        The file itself is served to clients which do not accept the encoding
+        of a precompressed copy, or prefer no encoding.
+        """
+        def cbRendered(request):
+            self.assertEqual(request.v, 'plain' * 10)
+            self.assertEqual(self._header(request, 'content-encoding'), None)
+            self.assertEqual(self._header(request, 'content-length'), '50')
+            self.assertEqual(self._header(request, 'vary'), 'accept-encoding')
+        d = self._render()
+        d.addCallback(cbRendered)
+        d.addCallback(lambda ignored: self._render('gzip;q=0.5, identity'))
+        d.addCallback(cbRendered)
+        return d
+
+
+    def test_preference(self):
+        """
+        Of the precompressed copies which the client accepts, the one whose
+        encoding it prefers is served.
+        """
+        self.patch(static.File, 'precompressedEncodings',
+                   [('br', '.br'), ('gzip', '.gz')])
+        def cbRendered(request):
+            self.assertEqual(request.v, 'gzipped')
+        d = self._render('br;q=0.5, gzip')
+        d.addCallback(cbRendered)
+        d.addCallback(lambda ignored: self._render('gzip, br'))
+        d.addCallback(lambda request: self.assertEqual(request.v, 'brotli'))
+        return d
+
+
+    def test_noCopies(self):
+        """
+        Responses for files without precompressed copies do not vary with
+        Accept-Encoding.
+        """
+        os.remove(self.path + '.gz')
+        def cbRendered(request):
+            self.assertEqual(request.v, 'plain' * 10)
+            self.assertEqual(self._header(request, 'vary'), None)
+        return self._render('gzip').addCallback(cbRendered)
+
+
+
+class _FakeThreadPool(object):
+    """
+    Stand-in for a L{ThreadPool}, which runs the calls made in it in the
+    calling thread, when told to.
+
+    @ivar calls: The calls waiting to be run.
+    @ivar running: Whether one of the calls is running.
+    """
+    running = False
+
+    def __init__(self):
+        self.calls = []
+
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kw):
+        self.calls.append((onResult, f, args, kw))
+
+
+    def runAll(self):
+        """
+        Run calls until there are none waiting.
+        """
+        while self.calls:
+            onResult, f, args, kw = self.calls.pop(0)
+            self.running = True
+            try:
+                result = f(*args, **kw)
+            except:
+                result = failure.Failure()
+            self.running = False
+            onResult(not isinstance(result, failure.Failure), result)
+
+
+
+class _FakeReactor(object):
+    """
+    Stand-in for the reactor, to which the results of L{_FakeThreadPool} are
+    delivered.
+    """
+    def callFromThread(self, f, *args, **kw):
+        f(*args, **kw)
+
+
+
+class _PushRequest(testutil.FakeRequest):
+    """
+    A L{testutil.FakeRequest} which leaves a push producer to write when it
+    likes, as a real request does.
+    """
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+
+class Threaded(unittest.TestCase):
+    """
+    Tests for L{static.File} with a thread pool, and for
+    L{static.ThreadedFileTransfer}.
+    """
+    def setUp(self):
+        self.tmpdir = os.path.abspath(self.mktemp())
+        os.mkdir(self.tmpdir)
+        self.content = 'abcdefghij'
+        self.path = os.path.join(self.tmpdir, 'junk.txt')
+        f = file(self.path, 'wb')
+        f.write(self.content)
+        f.close()
+        self.pool = _FakeThreadPool()
+        self.registry = static.Registry(
+            threadPool=self.pool, reactor=_FakeReactor())
+        self.patch(static.ThreadedFileTransfer, 'chunkSize', 3)
+
+
+    def _transfer(self, parts, trailer=''):
+        """
+        Start a L{static.ThreadedFileTransfer} of the file.
+
+        @return: The transfer, and the request it is writing to.
+        """
+        request = _PushRequest()
+        request.transport = StringTransport()
+        transfer = static.ThreadedFileTransfer(
+            file(self.path, 'rb'), parts, trailer, request, self.pool,
+            _FakeReactor())
+        return transfer, request
+
+
+    def test_render(self):
+        """
+        The file is opened and read in the thread pool, a chunk at a time.
+        """
+        d = deferredRender(
+            static.File(self.path, registry=self.registry), _PushRequest())
+        rendered = []
+        d.addCallback(rendered.append)
+        self.assertEqual(len(self.pool.calls), 1)
+        self.assertEqual(rendered, [])
+        self.pool.runAll()
+        [request] = rendered
+        self.assertEqual(request.v, self.content)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-length'), ['10'])
+        self.assertEqual(request.producer, None)
+
+
+    def test_precompressed(self):
+        """
+        Precompressed copies of the file are looked for in the thread pool.
+        """
+        f = file(self.path + '.gz', 'wb')
+        f.write('compressed')
+        f.close()
+        self.patch(os.path, 'isfile', self._notInThreadPool(os.path.isfile))
+        d = deferredRender(
+            static.File(self.path, registry=self.registry),
+            _PushRequest(headers={'accept-encoding': 'gzip'}))
+        rendered = []
+        d.addCallback(rendered.append)
+        self.pool.runAll()
+        [request] = rendered
+        self.assertEqual(request.v, 'compressed')
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-encoding'),
+            ['gzip'])
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('vary'),
+            ['accept-encoding'])
+
+
+    def _notInThreadPool(self, f):
+        """
+        Wrap C{f} so that it fails the test if it is called other than from
+        a call in C{self.pool}.
+        """
+        def wrapper(*args):
+            self.assertTrue(self.pool.running, "%r not called in the pool" % (
+                f,))
+            return f(*args)
+        return wrapper
+
+
+    def test_fileCacheUnused(self):
+        """
+        The registry's C{fileCache} is not used if it has a thread pool.
+        """
+        cache = static.FileCache()
+        self.registry.fileCache = cache
+        resource = static.File(self.tmpdir, registry=self.registry)
+        d = resource.locateChild(None, ['junk.txt'])
+        d.addCallback(lambda (child, segments):
+                          deferredRender(child, _PushRequest()))
+        rendered = []
+        d.addCallback(rendered.append)
+        self.pool.runAll()
+        [request] = rendered
+        self.assertEqual(request.v, self.content)
+        self.assertEqual(cache.size, 0)
+
+
+    def test_readAhead(self):
+        """
+        While the transport is paused, chunks are read only until
+        C{readAhead} are waiting, and they are written when it is resumed.
+        """
+        self.patch(static.ThreadedFileTransfer, 'readAhead', 2)
+        transfer, request = self._transfer([('', 0, 10)])
+        transfer.pauseProducing()
+        self.pool.runAll()
+        self.assertEqual(request.v, '')
+        self.assertEqual(list(transfer._chunks), ['abc', 'def'])
+        transfer.resumeProducing()
+        self.assertEqual(request.v, 'abcdef')
+        self.assertEqual(len(self.pool.calls), 1)
+        self.pool.runAll()
+        self.assertEqual(request.v, self.content)
+        self.assertTrue(transfer.file.closed)
+        self.assertTrue(request.deferred.called)
+
+
+    def test_parts(self):
+        """
+        The data before each range and the trailer are written in order with
+        the ranges of the file.
+        """
+        transfer, request = self._transfer(
+            [('<1>', 1, 4), ('<2>', 8, 2)], '<end>')
+        self.pool.runAll()
+        self.assertEqual(request.v, '<1>bcde<2>ij<end>')
+        self.assertTrue(request.deferred.called)
+
+
+    def test_stopWhileReading(self):
+        """
+        If the transfer is stopped while a chunk is being read, the file is
+        closed once it has been read, and nothing more is written.
+        """
+        transfer, request = self._transfer([('', 0, 10)])
+        transfer.stopProducing()
+        self.assertFalse(transfer.file.closed)
+        self.pool.runAll()
+        self.assertTrue(transfer.file.closed)
+        self.assertEqual(request.v, '')
+        self.assertFalse(request.deferred.called)
+
+
+    def test_shortFile(self):
+        """
+        If the file is shorter than the response promised, the connection is
+        dropped.
+        """
+        transfer, request = self._transfer([('', 5, 10)])
+        self.pool.runAll()
+        self.assertEqual(request.v, 'fghij')
+        self.assertTrue(request.transport.disconnecting)
+        self.assertTrue(transfer.file.closed)
+
+
+    def test_readError(self):
+        """
+        An error reading the file is logged and the connection is dropped.
+        """
+        transfer, request = self._transfer([('', 0, 10)])
+        transfer.file.close()
+        self.pool.runAll()
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertTrue(request.transport.disconnecting)
+
+
+    def test_locateChild(self):
+        """
+        Children are looked for in the thread pool.
+        """
+        resource = static.File(self.tmpdir, registry=self.registry)
+        d = resource.locateChild(None, ['junk.txt', 'x'])
+        located = []
+        d.addCallback(located.append)
+        self.assertEqual(located, [])
+        self.pool.runAll()
+        [(child, segments)] = located
+        self.assertEqual(child.fp.path, self.path)
+        self.assertEqual(segments, ['x'])
+
+
+    def test_listing(self):
+        """
+        Directories without index files are listed in the thread pool.
+        """
+        resource = static.File(self.tmpdir, registry=self.registry)
+        located = []
+        resource.locateChild(None, ['']).addCallback(located.append)
+        self.pool.runAll()
+        [(listing, segments)] = located
+        self.assertEqual(listing.dirs, ['junk.txt'])
+        self.assertEqual(segments, [])
+
+
+    def test_threadPool(self):
+        """
+        Files are served with a real thread pool.
+        """
+        pool = threadpool.ThreadPool(0, 2)
+        pool.start()
+        self.addCleanup(pool.stop)
+        self.patch(static.ThreadedFileTransfer, 'chunkSize', 2 ** 16)
+        content = os.urandom(2 ** 20)
+        f = file(self.path, 'wb')
+        f.write(content)
+        f.close()
+        resource = static.File(
+            self.path, registry=static.Registry(threadPool=pool))
+        d = deferredRender(resource, _PushRequest())
+        d.addCallback(lambda request: self.assertEqual(request.v, content))
+        return d
@@ -0,0 +1,131 @@
+"""
+Tests for L{nevow.timerwheel}.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.internet import error
+from twisted.internet.task import Clock
+
+from nevow.timerwheel import TimerWheel
+
+
+
+class TimerWheelTests(TestCase):
+    """
+    Tests for L{TimerWheel}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(granularity=1.0, clock=self.clock)
+        self.calls = []
+
+
+    def test_callLater(self):
+        """
+        A call is made at the end of the slot containing the time it was
+        scheduled for, never before, and with its arguments.
+        """
+        self.clock.advance(0.5)
+        call = self.wheel.callLater(2, self.calls.append, 'x')
+        self.assertEqual(call.getTime(), 2.5)
+        self.assertTrue(call.active())
+        self.clock.advance(2)
+        self.assertEqual(self.calls, [])
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, ['x'])
+        self.assertFalse(call.active())
+        self.assertRaises(error.AlreadyCalled, call.cancel)
+
+
+    def test_oneClockCall(self):
+        """
+        However many calls are scheduled, the clock has only one call, for the
+        end of the next slot, and none once no calls are scheduled.
+        """
+        calls = [self.wheel.callLater(n, self.calls.append, n)
+                 for n in range(1, 100)]
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 2)
+        for call in calls[1:]:
+            call.cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.wheel.getDelayedCalls(), [])
+
+
+    def test_cancel(self):
+        """
+        A cancelled call is not made, and cannot be cancelled again.
+        """
+        call = self.wheel.callLater(3, self.calls.append, 'x')
+        other = self.wheel.callLater(3, self.calls.append, 'y')
+        call.cancel()
+        self.assertFalse(call.active())
+        self.assertRaises(error.AlreadyCancelled, call.cancel)
+        self.clock.advance(3)
+        self.assertEqual(self.calls, ['y'])
+
+
+    def test_cancelledDuringSlot(self):
+        """
+        A call cancelled by an earlier call in the same slot is not made.
+        """
+        later = []
+        def cancelLater():
+            self.calls.append('first')
+            later[0].cancel()
+        self.wheel.callLater(1.2, cancelLater)
+        later.append(self.wheel.callLater(1.5, self.calls.append, 'second'))
+        self.clock.advance(2)
+        self.assertEqual(self.calls, ['first'])
+
+
+    def test_shortDelay(self):
+        """
+        Delays shorter than the granularity are scheduled with the clock.
+        """
+        call = self.wheel.callLater(0.25, self.calls.append, 'x')
+        self.assertEqual(self.clock.getDelayedCalls(), [call])
+        self.clock.advance(0.25)
+        self.assertEqual(self.calls, ['x'])
+
+
+    def test_clockJump(self):
+        """
+        If the clock jumps ahead, all of the calls in the slots which have
+        ended are made, in order.
+        """
+        self.wheel.callLater(5, self.calls.append, 5)
+        self.wheel.callLater(3, self.calls.append, 3)
+        self.wheel.callLater(10000, self.calls.append, 10000)
+        self.clock.advance(5000)
+        self.assertEqual(self.calls, [3, 5])
+        self.clock.advance(5000)
+        self.assertEqual(self.calls, [3, 5, 10000])
+
+
+    def test_scheduleDuringCall(self):
+        """
+        A call scheduled by another call is made in a later slot.
+        """
+        def reschedule():
+            self.calls.append(self.clock.seconds())
+            if len(self.calls) < 3:
+                self.wheel.callLater(1, reschedule)
+        self.wheel.callLater(1, reschedule)
+        self.clock.pump([1, 1, 1, 1])
+        self.assertEqual(self.calls, [1, 2, 3])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_error(self):
+        """
+        An exception raised by a call is logged, and later calls are still
+        made.
+        """
+        self.wheel.callLater(1, lambda: 1 / 0)
+        self.wheel.callLater(1.5, self.calls.append, 'x')
+        self.clock.advance(2)
+        self.assertEqual(self.calls, ['x'])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
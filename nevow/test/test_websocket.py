@@ -0,0 +1,293 @@
+"""
+Tests for L{nevow._websocket}.
+"""
+import struct
+
+from twisted.trial.unittest import TestCase
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.http import HTTPChannel, Request
+
+from nevow.testutil import FakeRequest
+from nevow._websocket import (
+    computeAcceptKey, isWebSocketRequest, isSameOrigin, acceptWebSocket,
+    WebSocketProtocol,
+    TEXT, BINARY, CONTINUATION, CLOSE, PING, PONG, PROTOCOL_ERROR,
+    MESSAGE_TOO_BIG, NORMAL_CLOSURE)
+from nevow._websocket import _makeFrame
+
+
+
+def clientFrame(opcode, payload, final=True, mask='\x12\x34\x56\x78'):
+    """
+    Return a frame as a client would send it, masked with C{mask}.
+    """
+    length = len(payload)
+    first = opcode | (final and 0x80 or 0)
+    if length < 126:
+        header = struct.pack('!BB', first, 0x80 | length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', first, 0x80 | 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 0x80 | 127, length)
+    masked = ''.join([
+        chr(ord(c) ^ ord(mask[i % 4])) for (i, c) in enumerate(payload)])
+    return header + mask + masked
+
+
+
+class RecordingProtocol(WebSocketProtocol):
+    """
+    L{WebSocketProtocol} which records the messages it receives.
+    """
+    def __init__(self):
+        WebSocketProtocol.__init__(self)
+        self.messages = []
+
+
+    def messageReceived(self, message):
+        self.messages.append(message)
+
+
+
+class HandshakeTests(TestCase):
+    """
+    Tests for the opening handshake.
+    """
+    def _request(self, **headers):
+        """
+        Make a request for a WebSocket connection, with some of its headers
+        replaced by C{headers}.
+        """
+        allHeaders = {
+            'upgrade': 'websocket',
+            'connection': 'keep-alive, Upgrade',
+            'sec-websocket-version': '13',
+            'sec-websocket-key': 'dGhlIHNhbXBsZSBub25jZQ=='}
+        allHeaders.update(headers)
+        for (name, value) in allHeaders.items():
+            if value is None:
+                del allHeaders[name]
+        return FakeRequest(headers=allHeaders)
+
+
+    def test_computeAcceptKey(self):
+        """
+        L{computeAcceptKey} computes the value given in RFC 6455's example.
+        """
+        self.assertEqual(
+            computeAcceptKey('dGhlIHNhbXBsZSBub25jZQ=='),
+            's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+
+
+    def test_isWebSocketRequest(self):
+        """
+        L{isWebSocketRequest} is true only for I{GET} requests which ask to
+        upgrade to version 13 of the WebSocket protocol and include a key.
+        """
+        self.assertTrue(isWebSocketRequest(self._request()))
+        self.assertTrue(isWebSocketRequest(self._request(upgrade='WebSocket')))
+        self.assertFalse(isWebSocketRequest(self._request(upgrade=None)))
+        self.assertFalse(isWebSocketRequest(self._request(connection='close')))
+        self.assertFalse(isWebSocketRequest(
+            self._request(**{'sec-websocket-version': '8'})))
+        self.assertFalse(isWebSocketRequest(
+            self._request(**{'sec-websocket-key': None})))
+        request = self._request()
+        request.method = 'POST'
+        self.assertFalse(isWebSocketRequest(request))
+
+
+    def test_acceptWebSocket(self):
+        """
+        L{acceptWebSocket} writes the handshake response to the request's
+        transport and connects the protocol to it in place of the channel.
+        """
+        transport = StringTransport()
+        channel = HTTPChannel()
+        channel.makeConnection(transport)
+        transport.protocol = channel
+        request = Request(channel, False)
+        request.requestHeaders.setRawHeaders(
+            'sec-websocket-key', ['dGhlIHNhbXBsZSBub25jZQ=='])
+        protocol = RecordingProtocol()
+        acceptWebSocket(request, protocol)
+        self.assertEqual(
+            transport.value(),
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n'
+            '\r\n')
+        self.assertIdentical(transport.protocol, protocol)
+        self.assertIdentical(protocol.transport, transport)
+        self.assertIdentical(channel.transport, None)
+        self.assertIdentical(transport.producer, None)
+
+
+    def test_acceptWebSocketResumes(self):
+        """
+        L{acceptWebSocket} resumes reading from a transport which the channel
+        paused, since the channel will not.
+        """
+        transport = StringTransport()
+        channel = HTTPChannel()
+        channel.makeConnection(transport)
+        transport.pauseProducing()
+        request = Request(channel, False)
+        request.requestHeaders.setRawHeaders(
+            'sec-websocket-key', ['dGhlIHNhbXBsZSBub25jZQ=='])
+        acceptWebSocket(request, RecordingProtocol())
+        self.assertEqual(transport.producerState, 'producing')
+
+
+    def test_isSameOrigin(self):
+        """
+        L{isSameOrigin} is true for requests whose I{Origin} header names the
+        host in their I{Host} header, allowing for default ports, and for
+        requests without an I{Origin} header.
+        """
+        def check(origin, host='example.com'):
+            return isSameOrigin(self._request(origin=origin, host=host))
+        self.assertTrue(check(None))
+        self.assertTrue(check('http://example.com'))
+        self.assertTrue(check('http://Example.com:80', 'example.com'))
+        self.assertTrue(check('https://example.com', 'example.com:443'))
+        self.assertTrue(check('http://[::1]:8080', '[::1]:8080'))
+        self.assertFalse(check('http://evil.example'))
+        self.assertFalse(check('http://example.com:8080'))
+        self.assertFalse(check('null'))
+        self.assertFalse(check('http://example.com:x', 'example.com:x'))
+        self.assertFalse(check('http://example.com', None))
+
+
+
+class WebSocketProtocolTests(TestCase):
+    """
+    Tests for L{WebSocketProtocol}.
+    """
+    def setUp(self):
+        self.transport = StringTransport()
+        self.protocol = RecordingProtocol()
+        self.protocol.makeConnection(self.transport)
+
+
+    def test_messageReceived(self):
+        """
+        Masked text and binary frames are unmasked and delivered as messages,
+        even when they arrive a byte at a time.
+        """
+        data = clientFrame(TEXT, 'hello') + clientFrame(BINARY, '\x00\xff')
+        for byte in data:
+            self.protocol.dataReceived(byte)
+        self.assertEqual(self.protocol.messages, ['hello', '\x00\xff'])
+
+
+    def test_longMessages(self):
+        """
+        Messages whose lengths need 16 and 64 bits are received.
+        """
+        medium = 'x' * 300
+        large = 'y' * 70000
+        self.protocol.dataReceived(
+            clientFrame(TEXT, medium) + clientFrame(TEXT, large))
+        self.assertEqual(self.protocol.messages, [medium, large])
+
+
+    def test_fragmentedMessage(self):
+        """
+        A message sent in several frames is delivered once it is complete.
+        """
+        self.protocol.dataReceived(clientFrame(TEXT, 'hel', final=False))
+        self.protocol.dataReceived(clientFrame(PING, 'p'))
+        self.protocol.dataReceived(
+            clientFrame(CONTINUATION, 'lo', final=False))
+        self.assertEqual(self.protocol.messages, [])
+        self.protocol.dataReceived(clientFrame(CONTINUATION, '!'))
+        self.assertEqual(self.protocol.messages, ['hello!'])
+
+
+    def test_sendMessage(self):
+        """
+        L{WebSocketProtocol.sendMessage} writes an unmasked text frame, using
+        a 16 or 64 bit length for longer messages.
+        """
+        self.protocol.sendMessage('hi')
+        self.assertEqual(self.transport.value(), '\x81\x02hi')
+        self.transport.clear()
+        self.protocol.sendMessage('x' * 300)
+        self.assertEqual(
+            self.transport.value(), '\x81\x7e\x01\x2c' + 'x' * 300)
+        self.transport.clear()
+        self.protocol.sendMessage('y' * 70000)
+        self.assertEqual(
+            self.transport.value()[:10],
+            '\x81\x7f' + struct.pack('!Q', 70000))
+
+
+    def test_ping(self):
+        """
+        A ping is answered with a pong carrying the same payload.
+        """
+        self.protocol.dataReceived(clientFrame(PING, 'abc'))
+        self.assertEqual(self.transport.value(), _makeFrame(PONG, 'abc'))
+
+
+    def test_close(self):
+        """
+        A close frame is answered with a close frame and the connection is
+        dropped, after which no more messages are sent.
+        """
+        self.protocol.dataReceived(clientFrame(CLOSE, ''))
+        self.assertEqual(
+            self.transport.value(),
+            _makeFrame(CLOSE, struct.pack('!H', NORMAL_CLOSURE)))
+        self.assertTrue(self.transport.disconnecting)
+        self.protocol.sendMessage('late')
+        self.assertEqual(
+            self.transport.value(),
+            _makeFrame(CLOSE, struct.pack('!H', NORMAL_CLOSURE)))
+
+
+    def test_unmaskedFrame(self):
+        """
+        The connection is closed with a protocol error if the client sends an
+        unmasked frame.
+        """
+        self.protocol.dataReceived(_makeFrame(TEXT, 'hello'))
+        self.assertEqual(self.protocol.messages, [])
+        self.assertEqual(
+            self.transport.value(),
+            _makeFrame(CLOSE, struct.pack('!H', PROTOCOL_ERROR)))
+
+
+    def test_unexpectedContinuation(self):
+        """
+        The connection is closed with a protocol error if the client sends a
+        continuation frame which does not continue a message.
+        """
+        self.protocol.dataReceived(clientFrame(CONTINUATION, 'hello'))
+        self.assertEqual(
+            self.transport.value(),
+            _makeFrame(CLOSE, struct.pack('!H', PROTOCOL_ERROR)))
+
+
+    def test_messageTooBig(self):
+        """
+        The connection is closed if the client sends a frame, or a message in
+        several frames, larger than C{maxMessageSize}.
+        """
+        self.protocol.maxMessageSize = 4
+        self.protocol.dataReceived(clientFrame(TEXT, 'hello')[:2])
+        self.assertEqual(
+            self.transport.value(),
+            _makeFrame(CLOSE, struct.pack('!H', MESSAGE_TOO_BIG)))
+
+        self.setUp()
+        self.protocol.maxMessageSize = 4
+        self.protocol.dataReceived(
+            clientFrame(TEXT, 'abc', final=False) +
+            clientFrame(CONTINUATION, 'de'))
+        self.assertEqual(self.protocol.messages, [])
+        self.assertEqual(
+            self.transport.value(),
+            _makeFrame(CLOSE, struct.pack('!H', MESSAGE_TOO_BIG)))
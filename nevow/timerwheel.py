@@ -0,0 +1,188 @@
+# -*- test-case-name: nevow.test.test_timerwheel -*-
+"""
+A coarse-grained timer for very many timeouts which are mostly cancelled, such
+as those Athena keeps for each connected page.
+"""
+from math import ceil, floor
+
+from twisted.internet import error
+from twisted.python import log
+
+
+
+class _WheelCall(object):
+    """
+    A call scheduled by L{TimerWheel.callLater}.
+
+    @ivar time: The time at which the call was asked to be made.
+    @ivar slot: The number of the slot of the wheel which holds the call.
+    """
+    cancelled = called = False
+
+    def __init__(self, wheel, time, slot, f, args, kw):
+        self.wheel = wheel
+        self.time = time
+        self.slot = slot
+        self.f = f
+        self.args = args
+        self.kw = kw
+
+
+    def getTime(self):
+        """
+        Return the time at which the call was asked to be made.  It is made at
+        the end of the wheel slot which contains this time.
+        """
+        return self.time
+
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+
+    def cancel(self):
+        """
+        Unschedule the call.
+
+        @raise error.AlreadyCancelled: If it has already been cancelled.
+        @raise error.AlreadyCalled: If it has already been made.
+        """
+        if self.cancelled:
+            raise error.AlreadyCancelled()
+        if self.called:
+            raise error.AlreadyCalled()
+        self.cancelled = True
+        self.wheel._remove(self)
+
+
+
+class TimerWheel(object):
+    """
+    A replacement for C{reactor.callLater} for timeouts which need not be
+    exact, which keeps its calls in slots of C{granularity} seconds.
+
+    Scheduling and cancelling a call costs the same however many others are
+    scheduled, and the underlying clock is only asked to wake the wheel at
+    the end of each slot while any calls are scheduled, rather than once for
+    each call.  Calls are made at the end of the slot containing the time
+    they were scheduled for, so up to C{granularity} seconds late, but never
+    early.  Delays shorter than C{granularity} are passed directly to the
+    clock, since they would otherwise be stretched out of all proportion.
+
+    One wheel can be shared by any number of users, for example by passing
+    its L{callLater} as the C{scheduler} of every
+    L{nevow.athena.ReliableMessageDelivery}; see
+    L{nevow.athena.LivePage.transportTimerWheel}.
+
+    @ivar granularity: The length of a slot, in seconds.
+    """
+    def __init__(self, granularity=1.0, clock=None):
+        """
+        @param clock: An L{IReactorTime} provider to schedule the end of each
+            slot with.  If C{None}, the reactor is used.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.granularity = granularity
+        self._clock = clock
+        # Slot numbers mapped to the sets of calls they hold.  Slot n ends at
+        # n * granularity.
+        self._slots = {}
+        # The last slot whose calls have been made.
+        self._lastSlot = self._endedSlot()
+        # The clock's call for the end of the next slot, if any calls are
+        # scheduled.
+        self._tick = None
+
+
+    def _endedSlot(self):
+        """
+        Return the number of the last slot which has ended.
+        """
+        # Allow for rounding errors, so that a tick at the end of a slot
+        # always finds it ended.
+        return int(floor(self._clock.seconds() / self.granularity + 1e-9))
+
+
+    def callLater(self, delay, f, *args, **kw):
+        """
+        Call C{f} with C{args} and C{kw} once C{delay} seconds have passed.
+
+        @return: An object with C{cancel}, C{active} and C{getTime} methods,
+            like an L{IDelayedCall}.
+        """
+        if delay < self.granularity:
+            return self._clock.callLater(delay, f, *args, **kw)
+        if self._tick is None:
+            self._lastSlot = max(self._lastSlot, self._endedSlot())
+            self._scheduleTick()
+        when = self._clock.seconds() + delay
+        slot = max(int(ceil(when / self.granularity)), self._lastSlot + 1)
+        call = _WheelCall(self, when, slot, f, args, kw)
+        calls = self._slots.get(slot)
+        if calls is None:
+            calls = self._slots[slot] = set()
+        calls.add(call)
+        return call
+
+
+    def _remove(self, call):
+        """
+        Forget a cancelled call.
+        """
+        calls = self._slots.get(call.slot)
+        if calls is None:
+            # Its slot is being emptied, and the call will be skipped.
+            return
+        calls.remove(call)
+        if not calls:
+            del self._slots[call.slot]
+            if not self._slots and self._tick is not None:
+                self._tick.cancel()
+                self._tick = None
+
+
+    def _scheduleTick(self):
+        """
+        Have the clock wake the wheel at the end of the next slot.
+        """
+        end = (self._lastSlot + 1) * self.granularity
+        self._tick = self._clock.callLater(
+            max(0, end - self._clock.seconds()), self._advance)
+
+
+    def _advance(self):
+        """
+        Make the calls in the slots which have ended.
+        """
+        self._tick = None
+        now = self._endedSlot()
+        if now - self._lastSlot <= len(self._slots):
+            due = range(self._lastSlot + 1, now + 1)
+        else:
+            # The clock has jumped a long way; look only at occupied slots.
+            due = sorted([slot for slot in self._slots if slot <= now])
+        self._lastSlot = max(now, self._lastSlot)
+        for slot in due:
+            calls = self._slots.pop(slot, None)
+            if calls is None:
+                continue
+            for call in sorted(calls, key=lambda call: call.time):
+                if call.cancelled:
+                    # Cancelled by an earlier call in this slot.
+                    continue
+                call.called = True
+                try:
+                    call.f(*call.args, **call.kw)
+                except:
+                    log.err(None, "Unhandled error in TimerWheel call")
+        if self._slots and self._tick is None:
+            self._scheduleTick()
+
+
+    def getDelayedCalls(self):
+        """
+        Return the calls which are scheduled in the wheel, in no particular
+        order.
+        """
+        return [call for calls in self._slots.values() for call in calls]